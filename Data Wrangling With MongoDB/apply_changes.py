@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Apply an OpenStreetMap change file (.osc) to an existing database.
+# Only the nodes and ways in the <create>, <modify> and <delete> blocks are
+# cleaned (with process_element, and the options load_database used) and their
+# rows replaced or removed, so the run time depends on the size of the change
+# file rather than the map.
+# Changes with a version no newer than the one in the database are skipped.
+# If the database has way geometry, it is recomputed for the changed ways and
+# for the ways using changed nodes, and the R*Tree tables of spatial_index.py
+# (if any) are updated to match.
+
+import collections
+import sqlite3
+import sys
+import xml.etree.cElementTree as ET
+import process_map as pm
+from clean_cache import print_stats
+from load_database import DB_PATH, get_load_options, post_load_indexes
+from postcode_table import print_postcode_stats
+from way_geometry import WAY_GEOMETRY_FIELDS, has_geometry, print_geometry_stats, stored_way_geometry
+from spatial_index import NODE_RTREE_SQL, WAY_RTREE_SQL, has_spatial_index
+
+ACTIONS = ('create', 'modify', 'delete')
+
+# Tables holding the tags (and way nodes) of each element type
+CHILD_TABLES = {'node': ['nodes_tags'],
+                'way': ['ways_tags', 'ways_nodes']}
+
+def get_changes(osc_file):
+    """Yield (action, element) for each node and way in the change file"""
+
+    context = ET.iterparse(osc_file, events=('start', 'end'))
+    _, root = next(context)
+    action = None
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag in ACTIONS:
+                action = elem.tag
+        elif elem.tag in ('node', 'way') and action:
+            yield action, elem
+            root.clear()
+        elif elem.tag in ACTIONS:
+            action = None
+
+def stored_version(db, tag, element_id):
+    # Return version of element in the database or None if it is not present
+    table = 'nodes' if tag == 'node' else 'ways'
+    row = db.execute('SELECT CAST(version AS INTEGER) FROM %s WHERE id=?' % table,
+                     (element_id,)).fetchone()
+    return row[0] if row else None
+
+def delete_element(db, tag, element_id, spatial=False):
+    # Remove element and its tags/nodes (and its R*Tree box if spatial is True)
+    for table in CHILD_TABLES[tag]:
+        db.execute('DELETE FROM %s WHERE id=?' % table, (element_id,))
+    db.execute('DELETE FROM %s WHERE id=?' % ('nodes' if tag == 'node' else 'ways'),
+               (element_id,))
+    if spatial:
+        db.execute('DELETE FROM %s WHERE id=?' % ('nodes_rtree' if tag == 'node' else 'ways_rtree'),
+                   (element_id,))
+
+def insert_rows(db, table, fields, rows):
+    db.executemany('INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(fields),
+                                                       ', '.join('?' * len(fields))),
+                   [tuple(row[field] for field in fields) for row in rows])
+
+def write_element(db, el, spatial=False):
+    # Insert rows of a cleaned element from process_element
+    # (and the R*Tree box of a node if spatial is True)
+    if 'node' in el:
+        node = el['node']
+        insert_rows(db, 'nodes', pm.NODE_FIELDS, [node])
+        insert_rows(db, 'nodes_tags', pm.NODE_TAGS_FIELDS, el['node_tags'])
+        if spatial and node['lat'] is not None and node['lon'] is not None:
+            lat, lon = float(node['lat']), float(node['lon'])
+            db.execute(NODE_RTREE_SQL, (node['id'], lat, lat, lon, lon))
+    else:
+        insert_rows(db, 'ways', pm.WAY_FIELDS, [el['way']])
+        insert_rows(db, 'ways_nodes', pm.WAY_NODES_FIELDS, el['way_nodes'])
+        insert_rows(db, 'ways_tags', pm.WAY_TAGS_FIELDS, el['way_tags'])
+
+def ways_using_node(db, node_id):
+    return [row[0] for row in db.execute('SELECT DISTINCT id FROM ways_nodes WHERE node_id=?', (node_id,))]
+
+def update_geometry(db, way_ids, spatial=False):
+    # Recompute the ways_geometry rows (and R*Tree boxes if spatial is True) of
+    # ways, removing those of deleted ways, and return the number of way nodes not found
+    missing = 0
+    for way_id in way_ids:
+        db.execute('DELETE FROM ways_geometry WHERE id=?', (way_id,))
+        if spatial:
+            db.execute('DELETE FROM ways_rtree WHERE id=?', (way_id,))
+        if stored_version(db, 'way', way_id) is not None:
+            row, way_missing = stored_way_geometry(db, way_id)
+            missing += way_missing
+            if row:
+                insert_rows(db, 'ways_geometry', WAY_GEOMETRY_FIELDS, [row])
+                if spatial:
+                    db.execute(WAY_RTREE_SQL, (way_id, row['min_lat'], row['max_lat'],
+                                               row['min_lon'], row['max_lon']))
+    return missing
+
+def apply_changes(osc_file, db_path=DB_PATH, cache=False, postcodes=None):
+    """
+    Apply the nodes and ways of an osmChange file to the database
+
+    osc_file:  OSM change file to be applied
+    db_path:   Database created by create_database.sql, create_encoded_database.sql
+               or load_database.py
+    cache:     Flag to enable/disable caching of cleaned keys and values
+               (in process_map.CACHE_DIR in the current directory)
+    postcodes: Flag to enable/disable validating and normalising addr:postcode values
+               (None to do as load_database did when it created the database)
+
+    Returns a Counter of elements by (tag, action), including 'stale' skips
+    """
+
+    counts = collections.Counter()
+    clean_key, clean_val, disk = pm.make_cleaners(cache)
+    db = sqlite3.connect(db_path)
+    if postcodes is None:
+        postcodes = get_load_options(db).get('postcodes', False)
+    clean_postcode = pm.make_postcode_cleaner(postcodes)
+    # Indexes needed to find the tags/nodes of an element without a full scan
+    for sql in post_load_indexes(db):
+        db.execute(sql)
+    geometry = has_geometry(db)
+    spatial = has_spatial_index(db)
+    # Ways whose geometry is recomputed once all the changes are in
+    changed_ways = set()
+
+    with db:
+        for action, element in get_changes(osc_file):
+            element_id = int(element.get('id'))
+            version = stored_version(db, element.tag, element_id)
+            if version is not None and version >= int(element.get('version')):
+                # Database already has this or a later version
+                counts[(element.tag, 'stale')] += 1
+                continue
+
+            delete_element(db, element.tag, element_id, spatial)
+            if action != 'delete':
+                write_element(db, pm.process_element(element, clean_key, clean_val, clean_postcode), spatial)
+            counts[(element.tag, action)] += 1
+            if geometry:
+                if element.tag == 'way':
+                    changed_ways.add(element_id)
+                else:
+                    changed_ways.update(ways_using_node(db, element_id))
+        if geometry:
+            missing = update_geometry(db, sorted(changed_ways), spatial)
+    db.close()
+
+    stats = pm.cleaner_stats(clean_key, clean_val, disk)
+    if stats:
+        print_stats(stats)
+    if clean_postcode:
+        print_postcode_stats(clean_postcode.stats())
+    if geometry:
+        print_geometry_stats(missing)
+    return counts
+
+
+if __name__ == "__main__":
+    # Usage: apply_changes.py <oscfile> [database] [cache]
+    filename=sys.argv[1]
+    db_path=sys.argv[2] if len(sys.argv)>2 and sys.argv[2]!='cache' else DB_PATH
+    cache='cache' in sys.argv[2:]
+    counts=apply_changes(filename,db_path,cache)
+    print
+    for (tag,action),count in sorted(counts.iteritems()):
+        print '%-6s %-8s %d' % (tag,action,count)
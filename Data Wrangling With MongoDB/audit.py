@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Run several audits over an OSM file in a single pass.
+# The file is parsed once and each top level element (node, way, relation,
+# bounds etc.) is passed to every analyzer before being cleared, so memory use
+# does not grow with file size however many audits are run.
+# Running this file on its own runs the tag, street type, key and value audits
+# (optionally with a parser backend from osm_parser.BACKENDS).
+
+import sys
+from osm_parser import DEFAULT_BACKEND, iter_elements
+
+class Analyzer(object):
+    """Base class for audits run by run_audits"""
+
+    def begin(self, root):
+        # Called with the root element before any other elements
+        pass
+
+    def process(self, elem):
+        # Called with each complete top level element (and its children)
+        pass
+
+    def report(self):
+        # Print the results
+        pass
+
+def run_audits(osmfile, analyzers, backend=DEFAULT_BACKEND):
+    """Parse osmfile once (with the given backend), passing each top level
+    element to every analyzer"""
+
+    elements = iter_elements(osmfile, backend=backend, root=True)
+    root = next(elements)
+    for analyzer in analyzers:
+        analyzer.begin(root)
+    for elem in elements:
+        for analyzer in analyzers:
+            analyzer.process(elem)
+    return analyzers
+
+def default_analyzers():
+    # Analyzers for each of the audit scripts
+    from audit_tags import TagCounter
+    from audit_street_type import StreetCorrectionAudit, StreetTypeAudit
+    from fix_keys import KeyFixAudit
+    from fix_values import ValueFixAudit
+    return [TagCounter(), StreetTypeAudit(), StreetCorrectionAudit(), KeyFixAudit(), ValueFixAudit()]
+
+
+if __name__ == "__main__":
+    filename=sys.argv[1]
+    backend=sys.argv[2] if len(sys.argv)>2 else DEFAULT_BACKEND
+    for analyzer in run_audits(filename,default_analyzers(),backend):
+        analyzer.report()
@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import xml.etree.cElementTree as ET
-from collections import defaultdict
+# Usage: audit_street_type.py <osmfile> [mapping.csv]
+# (prints the street names with unexpected street types, and with a mapping
+# file also writes ranked corrections of street types and names to it)
+
+from collections import Counter, defaultdict
+import csv
 import re
 import pprint
 import sys
+from audit import Analyzer, run_audits
+from spelling_index import SpellingIndex
 
 # Regular expression
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
@@ -25,20 +31,212 @@ def audit_street_type(street_types, street_name):
 def is_street_name(elem):
     return (elem.attrib['k'] == "addr:street")
 
+class StreetTypeAudit(Analyzer):
+    # Group street names with unexpected street types
+
+    def __init__(self):
+        self.street_types = defaultdict(set)
+
+    def process(self, elem):
+        if elem.tag == "node" or elem.tag == "way":
+            for tag in elem.iter("tag"):
+                if is_street_name(tag):
+                    audit_street_type(self.street_types, tag.attrib['v'])
+
+    def report(self):
+        pprint.pprint(dict(self.street_types))
+
 def audit_street_types(osmfile):
-    osm_file = open(osmfile, "r")
-    street_types = defaultdict(set)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+    audit = StreetTypeAudit()
+    run_audits(osmfile, [audit])
+    return audit.street_types
+
+################################################################################
+# Correction suggestions
+################################################################################
+
+VOCABULARY_MIN_COUNT = 5 # Uses of a street type or name before it is trusted as a correction
+MAX_SUGGESTIONS = 3 # Corrections kept for each street type or name
+MIN_SPELLING_LENGTH = 3 # Shorter words are left to the abbreviations
+TYPE_DISTANCE = 2 # Most edits between a street type and its correction
+NAME_DISTANCE = 1 # Most edits between a street name and its correction
+
+# Columns of the mapping file; reason is case (differs only in case or full
+# stops), abbreviation (letters of an expected type) or spelling (within the
+# edit distance of a more common type or name)
+MAPPING_FIELDS = ['kind', 'original', 'suggestion', 'rank', 'reason', 'distance', 'count', 'suggestion_count']
+MAPPING_PATH = "street_mapping.csv"
+REPORT_LIMIT = 20 # Corrections printed by StreetCorrectionAudit.report
+REASONS = ['case', 'abbreviation', 'spelling']
+
+def normalise(word):
+    # Key of words differing only in case, full stops and spacing
+    return ' '.join(word.replace('.', ' ').lower().split())
+
+def is_abbreviation(short, word):
+    # True if short (two letters or more) is word with some of its letters
+    # left out (but not the first)
+    if len(short) < 2 or short[0] != word[0] or len(short) >= len(word):
+        return False
+    letters = iter(word)
+    return all(c in letters for c in short)
 
+def spellings(counts):
+    # Return {normalised key: (most common spelling, total count)}
+    best = {}
+    totals = Counter()
+    for word, count in counts.iteritems():
+        key = normalise(word)
+        totals[key] += count
+        if key not in best or (count, word) > (counts[best[key]], best[key]):
+            best[key] = word
+    return dict((key, (best[key], totals[key])) for key in best)
+
+class StreetCorrectionAudit(Analyzer):
+    # Count street names, to suggest corrections of their types and spelling
+
+    def __init__(self):
+        self.street_names = Counter()
+
+    def process(self, elem):
         if elem.tag == "node" or elem.tag == "way":
             for tag in elem.iter("tag"):
                 if is_street_name(tag):
-                    audit_street_type(street_types, tag.attrib['v'])
-    osm_file.close()
-    return street_types
+                    self.street_names[tag.attrib['v']] += 1
+
+    def report(self):
+        corrections = suggest_corrections(self.street_names)
+        print '%d street names, %d corrections suggested' % (len(self.street_names), len(corrections))
+        best = [row for row in corrections if row[3] == 1]
+        for row in sorted(best, key=lambda row: -row[6])[:REPORT_LIMIT]:
+            print '    %-5s %-30s -> %-30s %-12s %6d' % (row[0], row[1], row[2], row[4], row[6])
+
+def ranked(kind, original, count, candidates, limit):
+    # Return mapping rows of the best limit candidates (reason, distance,
+    # suggestion, suggestion count, preferred) for original, preferred
+    # candidates (expected street types) first
+    candidates.sort(key=lambda c: (not c[4], REASONS.index(c[0]), c[1], -c[3], c[2]))
+    rows = []
+    seen = set([original])
+    for reason, distance, suggestion, suggestion_count, preferred in candidates:
+        if suggestion not in seen and len(rows) < limit:
+            seen.add(suggestion)
+            rows.append((kind, original, suggestion, len(rows) + 1, reason, distance, count, suggestion_count))
+    return rows
+
+def suggest_type_corrections(type_counts, min_count=VOCABULARY_MIN_COUNT, limit=MAX_SUGGESTIONS):
+    """
+    Return mapping rows suggesting expected (or common) street types for each
+    street type of type_counts {street type: uses} which is not expected
+    """
+    expected_keys = dict((normalise(t), t) for t in expected)
+    # Vocabulary: the expected types, and the types used at least min_count times
+    vocabulary = spellings(type_counts)
+    for key, street_type in expected_keys.iteritems():
+        vocabulary[key] = (street_type, vocabulary.get(key, (None, 0))[1])
+    index = SpellingIndex(TYPE_DISTANCE)
+    for key, (street_type, count) in vocabulary.iteritems():
+        if key in expected_keys or (count >= min_count and key.isalpha()):
+            index.add(key, count)
+
+    rows = []
+    for street_type, count in type_counts.iteritems():
+        if street_type in expected:
+            continue
+        key = normalise(street_type)
+        candidates = []
+        if key in index:
+            target, target_count = vocabulary[key]
+            if target != street_type:
+                candidates.append(('case', 0, target, target_count, key in expected_keys))
+        if key not in expected_keys:
+            for expected_key, target in expected_keys.iteritems():
+                if is_abbreviation(key, expected_key):
+                    candidates.append(('abbreviation', len(expected_key) - len(key), target,
+                                       vocabulary[expected_key][1], True))
+            if len(key) >= MIN_SPELLING_LENGTH:
+                max_distance = 1 if len(key) <= 4 else TYPE_DISTANCE
+                for distance, match, match_count in index.lookup(key, max_distance):
+                    # Common types are only corrected to expected ones
+                    if distance > 0 and (match in expected_keys or
+                                         (match_count > vocabulary[key][1] and
+                                          vocabulary[key][1] < min_count)):
+                        candidates.append(('spelling', distance, vocabulary[match][0], match_count,
+                                           match in expected_keys))
+        rows += ranked('type', street_type, count, candidates, limit)
+    return rows
+
+def suggest_name_corrections(name_counts, min_count=VOCABULARY_MIN_COUNT, limit=MAX_SUGGESTIONS):
+    """
+    Return mapping rows suggesting, for each street name of name_counts
+    {street name: uses}, its most common spelling, and for names used less
+    than min_count times, the common names within NAME_DISTANCE edits
+    """
+    vocabulary = spellings(name_counts)
+    index = SpellingIndex(NAME_DISTANCE)
+    for key, (name, count) in vocabulary.iteritems():
+        if count >= min_count:
+            index.add(key, count)
+
+    rows = []
+    for name, count in name_counts.iteritems():
+        key = normalise(name)
+        target, key_count = vocabulary[key]
+        candidates = []
+        if target != name:
+            candidates.append(('case', 0, target, key_count, True))
+        if key_count < min_count and len(key) >= MIN_SPELLING_LENGTH:
+            for distance, match, match_count in index.lookup(key):
+                if distance > 0 and match_count > key_count:
+                    candidates.append(('spelling', distance, vocabulary[match][0], match_count, True))
+        rows += ranked('name', name, count, candidates, limit)
+    return rows
+
+def suggest_corrections(name_counts, min_count=VOCABULARY_MIN_COUNT, limit=MAX_SUGGESTIONS):
+    """
+    Return mapping rows (as MAPPING_FIELDS) of ranked corrections of the street
+    types and names of name_counts {street name: uses}, most used first
+    """
+    type_counts = Counter()
+    for name, count in name_counts.iteritems():
+        m = street_type_re.search(name)
+        if m:
+            type_counts[m.group()] += count
+    rows = (suggest_type_corrections(type_counts, min_count, limit) +
+            suggest_name_corrections(name_counts, min_count, limit))
+    rows.sort(key=lambda row: (row[0] != 'type', -row[6], row[1], row[3]))
+    return rows
+
+def write_mapping(rows, path=MAPPING_PATH):
+    # Write mapping rows to a csv file for review (delete the rows to leave out)
+    with open(path, 'wb') as mapping_file:
+        writer = csv.writer(mapping_file)
+        writer.writerow(MAPPING_FIELDS)
+        for row in rows:
+            writer.writerow([unicode(v).encode('utf-8') for v in row])
+
+def read_mapping(path=MAPPING_PATH, kind='type'):
+    # Return {original: suggestion} of the best remaining row of each original
+    # of a reviewed mapping file, in the form of process_map.abbr_mapping
+    mapping = {}
+    with open(path, 'rb') as mapping_file:
+        for row in csv.DictReader(mapping_file):
+            if row['kind'] == kind:
+                original = row['original'].decode('utf-8')
+                if original not in mapping:
+                    mapping[original] = row['suggestion'].decode('utf-8')
+    return mapping
 
 
 if __name__ == "__main__":
     filename=sys.argv[1]
-    st_types = audit_street_types(filename)
-    pprint.pprint(dict(st_types))
+    if len(sys.argv)>2:
+        audits = [StreetTypeAudit(), StreetCorrectionAudit()]
+        run_audits(filename, audits)
+        pprint.pprint(dict(audits[0].street_types))
+        corrections = suggest_corrections(audits[1].street_names)
+        write_mapping(corrections, sys.argv[2])
+        print '%d corrections of %d street names written to %s' % (len(corrections), len(audits[1].street_names), sys.argv[2])
+    else:
+        st_types = audit_street_types(filename)
+        pprint.pprint(dict(st_types))
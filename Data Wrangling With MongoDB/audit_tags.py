@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import xml.etree.cElementTree as ET
 import pprint
 import sys
+from audit import Analyzer, run_audits
+from sketch import SpaceSaving, print_top, save_summaries
 
-def count_elem_tags(elem,tag_type=None,tags={}):
+SKETCH_CAPACITY = 1000 # Counters per sketch in approximate mode
+
+def count_elem_tags(elem,tag_type=None,tags=None):
     # Function to return count of top level element if tag_type is None,
     # else count of specified tag (ignores unknown tags)
+    if tags is None:
+        tags={}
     if tag_type==None:
         if elem.tag in tags:
             tags[elem.tag]+=1
@@ -24,20 +29,66 @@ def count_elem_tags(elem,tag_type=None,tags={}):
                         tags[k]=1
     return tags
 
+class TagCounter(Analyzer):
+    # Count all tags (top level elements and their children), node tags and way tags
+
+    def __init__(self):
+        self.tags={}
+        self.node_tags={}
+        self.way_tags={}
+
+    def begin(self,root):
+        self.tags=count_elem_tags(root,tag_type=None,tags=self.tags)
+
+    def process(self,elem):
+        for child in elem.iter():
+            self.tags=count_elem_tags(child,tag_type=None,tags=self.tags)
+        self.node_tags=count_elem_tags(elem,tag_type='node',tags=self.node_tags)
+        self.way_tags=count_elem_tags(elem,tag_type='way',tags=self.way_tags)
+
+    def report(self):
+        print_tags(self.tags,self.node_tags,self.way_tags)
+
+class TagSketch(Analyzer):
+    # Approximate counts of node/way keys and key=value pairs in fixed memory
+    # (top items are reported with bounds on their true counts)
+
+    def __init__(self,capacity=SKETCH_CAPACITY):
+        self.sketches={}
+        for tag_type in ('node','way'):
+            self.sketches[tag_type+' tags']=SpaceSaving(capacity)
+            self.sketches[tag_type+' tag values']=SpaceSaving(capacity)
+
+    def process(self,elem):
+        if elem.tag=='node' or elem.tag=='way':
+            keys=self.sketches[elem.tag+' tags']
+            values=self.sketches[elem.tag+' tag values']
+            for child in elem.iter('tag'):
+                k=child.get('k')
+                keys.add(k)
+                values.add(k+'='+child.get('v'))
+
+    def report(self,k=20):
+        for name,sketch in sorted(self.sketches.iteritems()):
+            print_top(name,sketch,k)
+
+def sketch_tags(filename,capacity=SKETCH_CAPACITY,save_path=None):
+    # Print approximate top node/way keys and values
+    # (sketches saved to save_path can be merged with sketch.py)
+    sketch=TagSketch(capacity)
+    run_audits(filename,[sketch])
+    sketch.report()
+    if save_path:
+        save_summaries(sketch.sketches,save_path)
+
 def count_tags(filename):
     # Count all tags in file
-    tags={}
-    node_tags={}
-    way_tags={}
-    for event,elem in ET.iterparse(filename):
-        tags=count_elem_tags(elem,tag_type=None,tags=tags)
-        node_tags=count_elem_tags(elem,tag_type='node',tags=node_tags)
-        way_tags=count_elem_tags(elem,tag_type='way',tags=way_tags)
-    return tags,node_tags,way_tags
+    counter=TagCounter()
+    run_audits(filename,[counter])
+    return counter.tags,counter.node_tags,counter.way_tags
 
-def audit_tags(filename):
+def print_tags(tags,node_tags,way_tags):
     # Print count of top-level, node and way tags
-    tags,node_tags,way_tags=count_tags(filename)
     print('\nTOP LEVEL ELEMENTS:\n')
     pprint.pprint(tags,indent=2)
     print('\nNODE TAGS:\n')
@@ -45,7 +96,15 @@ def audit_tags(filename):
     print('\nWAY TAGS:\n')
     pprint.pprint(way_tags,indent=2)
 
+def audit_tags(filename):
+    # Print count of top-level, node and way tags
+    print_tags(*count_tags(filename))
+
 
 if __name__ == "__main__":
     filename=sys.argv[1]
-    audit_tags(filename)
+    if len(sys.argv)>2:
+        # Approximate mode: capacity and optional file to save the sketches to
+        sketch_tags(filename,int(sys.argv[2]),sys.argv[3] if len(sys.argv)>3 else None)
+    else:
+        audit_tags(filename)
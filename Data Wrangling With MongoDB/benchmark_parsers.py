@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmark of the osm_parser backends on the same OSM file.
+# Each available backend is timed parsing the nodes and ways alone, cleaning
+# them with process_element, and running the default audits. The cleaned
+# rows and audit results must be identical for every backend, both for the
+# file and for REFERENCES_OSM (ASCII data with character references, whose
+# values are only non-ASCII once the references are replaced).
+#
+# Usage: benchmark_parsers.py <osmfile>
+
+import pprint
+from StringIO import StringIO
+import sys
+import time
+import process_map as pm
+from audit import default_analyzers, run_audits
+from osm_parser import DEFAULT_BACKEND, available_backends
+
+REFERENCES_OSM = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+	<node id="1" version="1" timestamp="2015-01-01T00:00:00Z" changeset="1" uid="1" user="J&#246;rg" lat="53.19" lon="-2.89">
+		<tag k="name" v="&#233;cole de la gare"/>
+		<tag k="name:zh" v="&#x4E2D;&#x6587;"/>
+		<tag k="amenity" v="cafe;restaurant"/>
+		<tag k="cuisine" v="fish &amp; chips"/>
+	</node>
+	<node id="2" version="1" timestamp="2015-01-01T00:00:00Z" changeset="1" uid="2" user="&#65;nne" lat="53.2" lon="-2.9">
+		<tag k="addr:street" v="Caf&#233; St"/>
+	</node>
+	<way id="3" version="1" timestamp="2015-01-01T00:00:00Z" changeset="1" uid="1" user="J&#246;rg">
+		<nd ref="1"/>
+		<nd ref="2"/>
+		<tag k="name" v="Stryd &#374;r Eglwys"/>
+	</way>
+</osm>
+"""
+
+def parse_only(osmfile, backend):
+    # Return number of nodes and ways
+    return sum(1 for _ in pm.get_element(osmfile, ('node', 'way'), backend))
+
+def clean(osmfile, backend):
+    # Return list of cleaned elements
+    return [pm.process_element(element) for element in pm.get_element(osmfile, ('node', 'way'), backend)]
+
+def audit(osmfile, backend):
+    # Return the results of the default audits as text
+    analyzers = run_audits(osmfile, default_analyzers(), backend)
+    return pprint.pformat([analyzer.__dict__ for analyzer in analyzers])
+
+def check_references(backends):
+    # Raise an exception unless every backend gives the same rows and audit
+    # results, with the same str and unicode types, for REFERENCES_OSM
+    expected = None
+    for backend in backends:
+        result = pprint.pformat((clean(StringIO(REFERENCES_OSM), backend),
+                                 audit(StringIO(REFERENCES_OSM), backend)))
+        if expected is None:
+            expected = result
+        elif result != expected:
+            raise Exception('output of %s backend for character references differs from %s' % (backend, backends[0]))
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+def benchmark(osmfile):
+    backends = available_backends()
+    check_references(backends)
+    print '%-8s %12s %12s %12s' % ('Backend', 'Parse (s)', 'Clean (s)', 'Audit (s)')
+    expected = {}
+    for backend in backends:
+        times = []
+        for name, func in (('parse', parse_only), ('clean', clean), ('audit', audit)):
+            result, seconds = timed(func, osmfile, backend)
+            times.append(seconds)
+            if name not in expected:
+                expected[name] = result
+            elif result != expected[name]:
+                raise Exception('%s output of %s backend differs from %s' % (name, backend, backends[0]))
+        print '%-8s %12.2f %12.2f %12.2f' % tuple([backend] + times)
+
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1])
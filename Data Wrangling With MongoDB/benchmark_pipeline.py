@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmark of each stage of the wrangling pipeline on synthetic data.
+# A file of the given size is made with generate_osm and each stage is timed
+# on it, best of a few runs. Key and value caches are
+# turned off so the cleaning code itself is measured. Results are appended to
+# a JSON file with the commit and Python version, and compared with the last
+# run of the same size so regressions show up.
+#
+# Usage: benchmark_pipeline.py [nodes [results.json [repeat]]]
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import process_map as pm
+from audit import default_analyzers, run_audits
+from generate_osm import generate_osm
+from load_database import load_database
+
+RESULTS_PATH = "benchmark_results.json"
+SEED = 0
+REPEAT = 3
+
+def osm_tags(osm_file):
+    # Return list of (key, value) of every node and way tag
+    return [(tag.get('k'), tag.get('v')) for element in pm.get_element(osm_file, ('node', 'way'))
+            for tag in element.iter('tag')]
+
+def parse(osm_file, tags):
+    for _ in pm.get_element(osm_file, ('node', 'way')):
+        pass
+
+def clean_keys(osm_file, tags):
+    fix_key = pm.fix_key
+    for k, v in tags:
+        fix_key(k)
+
+def clean_values(osm_file, tags):
+    fix_vals = pm.fix_vals
+    for k, v in tags:
+        fix_vals(v)
+
+def process_elements(osm_file, tags):
+    for element in pm.get_element(osm_file, ('node', 'way')):
+        pm.process_element(element)
+
+def write_csv(osm_file, tags):
+    pm.write_elements(pm.get_element(osm_file, ('node', 'way')), cache=False)
+
+def write_csv_pipelined(osm_file, tags):
+    pm.write_elements(pm.get_element(osm_file, ('node', 'way')), cache=False, pipelined=True)
+
+def write_csv_gz(osm_file, tags):
+    pm.write_elements(pm.get_element(osm_file, ('node', 'way')), pm.get_output_paths(compress='gz'),
+                      cache=False, pipelined=True, compress='gz')
+
+def write_csv_validated(osm_file, tags):
+    pm.write_elements(pm.get_element(osm_file, ('node', 'way')), validate=True, cache=False)
+
+def audits(osm_file, tags):
+    run_audits(osm_file, default_analyzers())
+
+def load_db(osm_file, tags):
+    load_database(osm_file, 'benchmark.db', cache=False)
+
+# (name, function, what its rate is counted in)
+STAGES = [('parse', parse, 'element'),
+          ('fix_key', clean_keys, 'tag'),
+          ('fix_vals', clean_values, 'tag'),
+          ('process_element', process_elements, 'element'),
+          ('write_csv', write_csv, 'element'),
+          ('write_csv_pipelined', write_csv_pipelined, 'element'),
+          ('write_csv_gz', write_csv_gz, 'element'),
+          ('write_csv_validated', write_csv_validated, 'element'),
+          ('audits', audits, 'element'),
+          ('load_database', load_db, 'element')]
+
+class Quiet(object):
+    """Discard anything printed (load_database and the audits report as they go)"""
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def git_commit():
+    # Return current commit id (None if not in a git repository)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def time_stage(func, osm_file, tags, repeat):
+    # Return the best time of repeat runs
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        with Quiet():
+            func(osm_file, tags)
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+def benchmark(nodes=100000, repeat=REPEAT, seed=SEED, osm_file=None):
+    """
+    Time each stage on a synthetic file of the given number of nodes
+    (or on osm_file if given) and return the results as a dict
+    """
+
+    work_dir = os.path.abspath(tempfile.mkdtemp(prefix='benchmark_', dir='.'))
+    cwd = os.getcwd()
+    try:
+        if osm_file is None:
+            osm_file = os.path.join(work_dir, 'synthetic_%d_%d.osm' % (nodes, seed))
+            counts = generate_osm(osm_file, nodes, seed)
+        else:
+            osm_file = os.path.abspath(osm_file)
+            counts = {}
+        tags = osm_tags(osm_file)
+        counts['element'] = sum(1 for _ in pm.get_element(osm_file, ('node', 'way')))
+        counts['tag'] = len(tags)
+        # Output files are written to the work directory
+        os.chdir(work_dir)
+        stages = []
+        for name, func, unit in STAGES:
+            seconds = time_stage(func, osm_file, tags, repeat)
+            stages.append({'stage': name, 'seconds': round(seconds, 4),
+                           'per_second': round(counts[unit] / seconds) if seconds else None,
+                           'unit': unit})
+        size = os.path.getsize(osm_file)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'nodes': nodes, 'seed': seed, 'repeat': repeat,
+            'bytes': size, 'counts': counts,
+            'stages': stages}
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as results_file:
+        return json.load(results_file)
+
+def save_result(path, result):
+    # Append result to the list of runs in path
+    results = load_results(path)
+    results.append(result)
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=1, sort_keys=True)
+
+def previous_result(results, result):
+    # Return the last run on the same input as result (None if there is none)
+    for previous in reversed(results):
+        if (previous['nodes'], previous['seed'], previous['bytes']) == \
+           (result['nodes'], result['seed'], result['bytes']):
+            return previous
+    return None
+
+def print_result(result, previous=None):
+    print '%d nodes, %d elements, %d tags, %.1f MB (commit %s)' % (
+        result['nodes'], result['counts']['element'], result['counts']['tag'],
+        result['bytes'] / 1e6, result['commit'])
+    if previous:
+        print 'Compared with %s (commit %s)' % (previous['time'], previous['commit'])
+    print '\n%-20s %10s %20s %10s' % ('Stage', 'Seconds', 'Per second', 'Change')
+    before = dict((stage['stage'], stage['seconds']) for stage in previous['stages']) if previous else {}
+    for stage in result['stages']:
+        change = ''
+        if before.get(stage['stage']):
+            change = '%+.1f%%' % (100.0 * (stage['seconds'] / before[stage['stage']] - 1))
+        print '%-20s %10.3f %20s %10s' % (stage['stage'], stage['seconds'],
+                                          '%d %ss' % (stage['per_second'], stage['unit']), change)
+
+
+if __name__ == "__main__":
+    nodes=int(sys.argv[1]) if len(sys.argv)>1 else 100000
+    results_path=sys.argv[2] if len(sys.argv)>2 else RESULTS_PATH
+    repeat=int(sys.argv[3]) if len(sys.argv)>3 else REPEAT
+    result=benchmark(nodes,repeat)
+    print_result(result,previous_result(load_results(results_path),result))
+    save_result(results_path,result)
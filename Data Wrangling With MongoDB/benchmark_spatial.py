@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmark of SpatialIndex queries against a naive scan of the nodes table.
+# Random queries are centred on random nodes of the database. Both methods
+# must return the same nodes.
+#
+# Usage: benchmark_spatial.py <database> [queries]
+
+import random
+import sqlite3
+import sys
+import time
+from spatial_index import SpatialIndex, create_spatial_index
+from way_geometry import haversine
+
+class NaiveScan(object):
+    """The same queries answered by scanning every node"""
+
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path)
+
+    def bbox(self, minlat, minlon, maxlat, maxlon):
+        return self.db.execute("SELECT id, lat, lon FROM nodes WHERE lat BETWEEN ? AND ? "
+                               "AND lon BETWEEN ? AND ?", (minlat, maxlat, minlon, maxlon)).fetchall()
+
+    def radius(self, lat, lon, radius):
+        found = []
+        for node_id, node_lat, node_lon in self.db.execute("SELECT id, lat, lon FROM nodes"):
+            distance = haversine(lat, lon, node_lat, node_lon)
+            if distance <= radius:
+                found.append((distance, node_id, node_lat, node_lon))
+        found.sort()
+        return found
+
+    def nearest(self, lat, lon, k=1):
+        found = [(haversine(lat, lon, node_lat, node_lon), node_id, node_lat, node_lon)
+                 for node_id, node_lat, node_lon in self.db.execute("SELECT id, lat, lon FROM nodes")]
+        found.sort()
+        return found[:k]
+
+    def close(self):
+        self.db.close()
+
+def make_queries(db_path, n, seed=0):
+    # Return n (lat, lon) points at random nodes
+    db = sqlite3.connect(db_path)
+    points = db.execute("SELECT lat, lon FROM nodes").fetchall()
+    db.close()
+    rng = random.Random(seed)
+    return [rng.choice(points) for _ in xrange(n)]
+
+def time_queries(func, queries):
+    # Return (results, milliseconds per query)
+    start = time.time()
+    results = [func(*query) for query in queries]
+    return results, (time.time() - start) * 1000.0 / len(queries)
+
+def benchmark(db_path, n=200):
+    db = sqlite3.connect(db_path)
+    if not db.execute("SELECT name FROM sqlite_master WHERE name='nodes_rtree'").fetchone():
+        create_spatial_index(db)
+    db.close()
+
+    points = make_queries(db_path, n)
+    tests = [('bbox (0.01 deg)', 'bbox',
+              [(lat - 0.005, lon - 0.005, lat + 0.005, lon + 0.005) for lat, lon in points]),
+             ('radius (500 m)', 'radius', [(lat, lon, 500.0) for lat, lon in points]),
+             ('nearest (k=10)', 'nearest', [(lat, lon, 10) for lat, lon in points])]
+
+    index, naive = SpatialIndex(db_path), NaiveScan(db_path)
+    print '%-18s %14s %14s %10s' % ('Query', 'Scan (ms)', 'Index (ms)', 'Speedup')
+    for name, method, queries in tests:
+        expected, scan_ms = time_queries(getattr(naive, method), queries)
+        results, index_ms = time_queries(getattr(index, method), queries)
+        for query, a, b in zip(queries, expected, results):
+            if sorted(a) != sorted(b):
+                raise Exception('Results differ for %s%r' % (method, query))
+        print '%-18s %14.3f %14.3f %9.1fx' % (name, scan_ms, index_ms, scan_ms / index_ms)
+    index.close()
+    naive.close()
+
+
+if __name__ == "__main__":
+    filename=sys.argv[1]
+    queries=int(sys.argv[2]) if len(sys.argv)>2 else 200
+    benchmark(filename,queries)
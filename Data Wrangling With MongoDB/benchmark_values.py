@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Micro-benchmark comparing the original value cleaning functions with the
+# precompiled ValueCleaner rules.
+# Values are taken from the tags of an OSM file if one is given, otherwise a
+# built-in list of typical values is used. Both implementations must give
+# identical output.
+
+import itertools
+import sys
+import time
+import xml.etree.cElementTree as ET
+import fix_values
+
+# Typical values (including ones which trigger each rule)
+sample_values = ['High Street', 'Station Rd', 'Ael Y Bryn', 'Ffordd yr Eglwys',
+                 'the red lion ph', 'St Mary (Cofe)', 'Park Ave', "O'Neill's",
+                 'Fish &amp; Chips', 'CH4 0DR', 'http://www.example.com', 'NE',
+                 'pub', 'restaurant', 'indian', 'Victoria Sq', 'Chester By-Pass',
+                 'Bryn Yn Y Coed', 'Mill Lane', 'cafe']
+
+def legacy_fix_value(v):
+    # Original implementation (compiles each rule for every value)
+    if not fix_values.ignore_vals(v):
+        v=fix_values.remove_unwanted(v)
+        v=fix_values.capitalise(v)
+        v=fix_values.update_abbr(v)
+        v=fix_values.update_welsh(v)
+    return v
+
+def osm_values(osmfile):
+    # Return values of tags which would be cleaned
+    values=[]
+    context=ET.iterparse(osmfile,events=('start','end'))
+    _,root=next(context)
+    for event,elem in context:
+        if event=='end' and elem.tag=='tag' and elem.get('k') in fix_values.to_be_cleaned:
+            values.append(elem.get('v'))
+        elif event=='end' and elem.tag in ('node','way','relation'):
+            root.clear()
+    return values
+
+def time_per_million(func,values):
+    # Return seconds taken per million values
+    start=time.time()
+    for v in values:
+        func(v)
+    return (time.time()-start)*1000000.0/len(values)
+
+def benchmark(values,n=200000):
+    values=list(itertools.islice(itertools.cycle(values),n))
+    for v in set(values):
+        if legacy_fix_value(v)!=fix_values.fix_value(v):
+            raise Exception('Output differs for value: '+repr(v))
+    legacy=time_per_million(legacy_fix_value,values)
+    compiled=time_per_million(fix_values.fix_value,values)
+    print 'Values:          ',len(values),'('+str(len(set(values)))+' distinct)'
+    print 'Original:        ','%.2f s per million values' % legacy
+    print 'Compiled rules:  ','%.2f s per million values' % compiled
+    print 'Speedup:         ','%.1fx' % (legacy/compiled)
+
+
+if __name__ == "__main__":
+    if len(sys.argv)>1:
+        benchmark(osm_values(sys.argv[1]))
+    else:
+        benchmark(sample_values)
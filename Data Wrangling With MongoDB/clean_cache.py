@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Memoization of the key and value cleaning functions.
+# Tag keys and values are very repetitive, so each cleaning function is wrapped
+# in a bounded least recently used cache. Entries are also stored on disk (in a
+# SQLite database named after a hash of the cleaning rules) so that later runs
+# skip cleaning for anything already seen. Changing any of the rule tables
+# (or the code applying them, see process_map.cleaning_rules_hash) changes the
+# hash, so stale results are not reused. The disk cache is only used when asked
+# for (cache=True, or 'cache' on the command line of process_map.py,
+# load_database.py and apply_changes.py), as it writes files to .clean_cache
+# in the current directory.
+
+import collections
+import hashlib
+import os
+import sqlite3
+
+def rules_hash(*tables):
+    # Return a hash identifying a set of rule tables (dicts, lists or regexes)
+    h=hashlib.sha1()
+    for table in tables:
+        if hasattr(table,'pattern'):
+            table=(table.pattern,table.flags)
+        elif isinstance(table,dict):
+            # Order only matters if rules are applied in turn,
+            # but it is always the same for the same table
+            table=table.items()
+        h.update(repr(table))
+    return h.hexdigest()
+
+class DiskCache(object):
+    """Persistent store of cleaned results for one version of the rules"""
+
+    def __init__(self, cache_dir, rules, batch_size=10000):
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Created by another worker
+                pass
+        self.db=sqlite3.connect(os.path.join(cache_dir,rules[:16]+'.db'),timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                        'kind TEXT NOT NULL, '
+                        'k TEXT NOT NULL, '
+                        'v TEXT, '
+                        'PRIMARY KEY (kind, k))')
+        self.db.commit()
+        self.batch_size=batch_size
+        self.pending=[]
+
+    def get(self, kind, k):
+        # Return (found, value)
+        row=self.db.execute('SELECT v FROM cache WHERE kind=? AND k=?',(kind,k)).fetchone()
+        if row is None:
+            return False,None
+        return True,row[0]
+
+    def put(self, kind, k, v):
+        self.pending.append((kind,k,v))
+        if len(self.pending)>=self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO cache VALUES (?,?,?)',self.pending)
+            self.pending=[]
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+class LRUCache(object):
+    """Bounded least recently used cache in front of a one argument function"""
+
+    def __init__(self, func, maxsize=100000, disk=None, kind=None):
+        self.func=func
+        self.maxsize=maxsize
+        self.disk=disk
+        self.kind=kind or func.__name__
+        self.cache=collections.OrderedDict()
+        self.hits=0
+        self.disk_hits=0
+        self.misses=0
+        self.evictions=0
+
+    def __call__(self, x):
+        try:
+            result=self.cache.pop(x)
+            self.hits+=1
+        except KeyError:
+            found=False
+            if self.disk is not None:
+                found,result=self.disk.get(self.kind,x)
+            if found:
+                self.disk_hits+=1
+            else:
+                self.misses+=1
+                result=self.func(x)
+                if self.disk is not None:
+                    self.disk.put(self.kind,x,result)
+            if len(self.cache)>=self.maxsize:
+                self.cache.popitem(last=False)
+                self.evictions+=1
+        # Most recently used entries are at the end
+        self.cache[x]=result
+        return result
+
+    def stats(self):
+        return collections.Counter(hits=self.hits,disk_hits=self.disk_hits,
+                                   misses=self.misses,evictions=self.evictions)
+
+def print_stats(stats):
+    # Print hit/miss/eviction counts for each cache
+    print '\n%-8s %12s %12s %12s %12s' % ('Cache','Hits','Disk hits','Misses','Evictions')
+    for kind in sorted(stats):
+        s=stats[kind]
+        print '%-8s %12d %12d %12d %12d' % (kind,s['hits'],s['disk_hits'],s['misses'],s['evictions'])
@@ -0,0 +1,11 @@
+.open area.db
+.read data_wrangling_schema.sql
+.read encoded_tags_schema.sql
+.mode csv
+.import nodes.csv nodes
+.import tag_keys.csv tag_keys
+.import tag_values.csv tag_values
+.import nodes_tags.csv nodes_tag_ids
+.import ways.csv ways
+.import ways_tags.csv ways_tag_ids
+.import ways_nodes.csv ways_nodes
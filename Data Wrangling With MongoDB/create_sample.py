@@ -1,34 +1,203 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import xml.etree.ElementTree as ET  # Use cElementTree or lxml if too slow
+# Create a sample of an OSM file.
+# By default every k-th top level element is taken. Alternatively a random
+# sample of a target size can be taken (reservoir sampling), and elements can
+# be restricted to a bounding box and/or to those with given tags (in which
+# case every matching element is taken unless k or size is given).
+# With complete_ways every node referenced by a sampled way is also included,
+# so the sample keeps its referential integrity.
+# Memory use depends on the size of the sample rather than the input file.
+
+import argparse
+import os
+import random
+import xml.etree.cElementTree as ET
+from osm_index import OSMIndex, index_paths
+from osm_parser import DEFAULT_BACKEND, available_backends, iter_elements
 
 OSM_FILE = "area.osm"
 SAMPLE_FILE = "sample.osm"
 
 k = 50 # Parameter: take every k-th top level element
+filtered_k = 1 # Parameter: take every k-th element inside the bounding box or with the tags
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag
+ETREE_ELEMENT = type(ET.Element('osm'))
 
-    Reference:
-    http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
-    """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+def get_element(osm_file, tags=('node', 'way', 'relation'), backend=DEFAULT_BACKEND):
+    """Yield element if it is the right type of tag (parsed with the given backend, see osm_parser)"""
+    return iter_elements(osm_file, tags, backend)
+
+def element_text(element):
+    # Return element as XML text (elements of the lxml, expat and PBF readers
+    # are copied to an ElementTree element first)
+    if not isinstance(element, ETREE_ELEMENT):
+        copy = ET.Element(element.tag, dict(element.attrib))
+        for child in element:
+            if isinstance(child.tag, basestring):
+                ET.SubElement(copy, child.tag, dict(child.attrib)).tail = '\n    '
+        # Indent as in an OSM file
+        if len(copy):
+            copy.text = '\n    '
+            copy[-1].tail = '\n  '
+        copy.tail = '\n  '
+        element = copy
+    return ET.tostring(element, encoding='utf-8')
+
+class ElementFilter(object):
+    """Select elements inside a bounding box and/or having given tags"""
+
+    def __init__(self, bbox=None, tags=None):
+        self.bbox = bbox
+        # Tags given as 'key' or 'key=value'
+        self.tags = [tuple(tag.split('=', 1)) for tag in tags or []]
+        # Ids of nodes and ways inside the bounding box
+        self.inside = {'node': set(), 'way': set()}
 
+    def in_bbox(self, element):
+        minlat, minlon, maxlat, maxlon = self.bbox
+        if element.tag == 'node':
+            inside = (minlat <= float(element.get('lat')) <= maxlat and
+                      minlon <= float(element.get('lon')) <= maxlon)
+        elif element.tag == 'way':
+            # Nodes come before ways, so any node inside is already known
+            inside = any(int(nd.get('ref')) in self.inside['node']
+                         for nd in element.iter('nd'))
+        else:
+            inside = any(int(member.get('ref')) in self.inside.get(member.get('type'), ())
+                         for member in element.iter('member'))
+        if inside and element.tag in self.inside:
+            self.inside[element.tag].add(int(element.get('id')))
+        return inside
 
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
+    def has_tags(self, element):
+        for tag in element.iter('tag'):
+            for wanted in self.tags:
+                if tag.get('k') == wanted[0] and (len(wanted) == 1 or tag.get('v') == wanted[1]):
+                    return True
+        return False
 
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
+    def __call__(self, element):
+        if self.bbox and not self.in_bbox(element):
+            return False
+        return not self.tags or self.has_tags(element)
+
+def default_k(filtered):
+    # Return k to use when none is given (filters already select the elements wanted)
+    return filtered_k if filtered else k
+
+def sample_every_k(elements, k):
+    # Yield every k-th element (as text, with its position)
+    for i, element in enumerate(elements):
         if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
+            yield i, element.tag, element.get('id'), element_text(element)
+
+def sample_reservoir(elements, size, seed=None):
+    # Return a random sample of size elements (as text, with their position)
+    rng = random.Random(seed)
+    sample = []
+    for i, element in enumerate(elements):
+        if i < size:
+            j = i
+        else:
+            j = rng.randint(0, i)
+        if j < size:
+            item = (i, element.tag, element.get('id'), element_text(element))
+            if i < size:
+                sample.append(item)
+            else:
+                sample[j] = item
+    sample.sort()
+    return sample
+
+def referenced_nodes(osm_file, node_ids, backend=DEFAULT_BACKEND):
+    # Return {id: text} of the given nodes, using the element index if built
+    found = {}
+    if os.path.exists(index_paths(osm_file, 'node')[0]):
+        index = OSMIndex(osm_file)
+        for node_id in node_ids:
+            element = index.get('node', node_id)
+            if element is not None:
+                # Match the indentation of the other elements
+                element.tail = '\n  '
+                found[node_id] = ET.tostring(element, encoding='utf-8')
+        index.close()
+    else:
+        for element in get_element(osm_file, ('node', 'way'), backend):
+            if element.tag == 'way':
+                # Nodes come before ways, so there are no more to find
+                break
+            node_id = int(element.get('id'))
+            if node_id in node_ids:
+                found[node_id] = element_text(element)
+    return found
+
+def create_sample(osm_file=OSM_FILE, sample_file=SAMPLE_FILE, k=None, size=None,
+                  bbox=None, tags=None, complete_ways=False, seed=None, backend=DEFAULT_BACKEND):
+    """
+    Write a sample of the top level elements of osm_file to sample_file
+
+    k:              Take every k-th element (if size is not given; defaults to
+                    the module's k, or filtered_k if bbox or tags are given)
+    size:           Take a random sample of this many elements
+    bbox:           Only take elements inside (minlat, minlon, maxlat, maxlon)
+    tags:           Only take elements with one of these tags ('key' or 'key=value')
+    complete_ways:  Also take every node referenced by a sampled way
+    seed:           Random seed for a repeatable sample
+    backend:        XML parser to use ('etree', 'lxml' or 'expat', see osm_parser)
+    """
+
+    if k is None:
+        k = default_k(bool(bbox or tags))
+    elements = get_element(osm_file, backend=backend)
+    if bbox or tags:
+        element_filter = ElementFilter(bbox, tags)
+        elements = (element for element in elements if element_filter(element))
+    if size:
+        sample = sample_reservoir(elements, size, seed)
+    else:
+        sample = list(sample_every_k(elements, k))
+
+    if complete_ways:
+        sampled_nodes = set(int(element_id) for _, tag, element_id, _ in sample if tag == 'node')
+        wanted = set()
+        for _, tag, _, text in sample:
+            if tag == 'way':
+                wanted.update(int(nd.get('ref')) for nd in ET.fromstring(text).iter('nd'))
+        extra = referenced_nodes(osm_file, wanted - sampled_nodes, backend)
+        # Nodes first (by id), then the sampled ways and relations in file order
+        nodes = [(int(element_id), text) for _, tag, element_id, text in sample if tag == 'node']
+        nodes.extend(extra.iteritems())
+        sample = ([(None, 'node', node_id, text) for node_id, text in sorted(nodes)] +
+                  [item for item in sample if item[1] != 'node'])
+
+    with open(sample_file, 'wb') as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<osm>\n  ')
+
+        for _, _, _, text in sample:
+            output.write(text)
+
+        output.write('</osm>')
+
 
-    output.write('</osm>')
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create a sample of an OSM file')
+    parser.add_argument('osm_file', nargs='?', default=OSM_FILE)
+    parser.add_argument('sample_file', nargs='?', default=SAMPLE_FILE)
+    parser.add_argument('-k', type=int,
+                        help='take every k-th element (default %d, or %d with --bbox or --tag)' % (k, filtered_k))
+    parser.add_argument('--size', type=int, help='take a random sample of this many elements')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('MINLAT', 'MINLON', 'MAXLAT', 'MAXLON'),
+                        help='only take elements inside the bounding box')
+    parser.add_argument('--tag', action='append', dest='tags', metavar='KEY[=VALUE]',
+                        help='only take elements with this tag (may be repeated)')
+    parser.add_argument('--complete-ways', action='store_true',
+                        help='also take every node referenced by a sampled way')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument('--backend', choices=available_backends(), default=DEFAULT_BACKEND,
+                        help='XML parser to use')
+    args = parser.parse_args()
+    create_sample(args.osm_file, args.sample_file, args.k, args.size, args.bbox, args.tags,
+                  args.complete_ways, args.seed, args.backend)
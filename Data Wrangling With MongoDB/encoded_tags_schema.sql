@@ -0,0 +1,82 @@
+-- Dictionary encoded tags (see tag_dictionary.py), applied after data_wrangling_schema.sql.
+-- The nodes_tags and ways_tags tables are replaced by views with the same
+-- columns over tables of integer ids, so they can still be queried, inserted
+-- into and deleted from as before.
+
+DROP TABLE IF EXISTS nodes_tags;
+DROP TABLE IF EXISTS ways_tags;
+
+CREATE TABLE tag_keys (
+    id INTEGER PRIMARY KEY NOT NULL,
+    key TEXT NOT NULL,
+    type TEXT NOT NULL,
+    UNIQUE (key, type)
+);
+
+CREATE TABLE tag_values (
+    id INTEGER PRIMARY KEY NOT NULL,
+    value TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE nodes_tag_ids (
+    id INTEGER NOT NULL,
+    key_id INTEGER NOT NULL,
+    value_id INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES nodes(id),
+    FOREIGN KEY (key_id) REFERENCES tag_keys(id),
+    FOREIGN KEY (value_id) REFERENCES tag_values(id)
+);
+
+CREATE TABLE ways_tag_ids (
+    id INTEGER NOT NULL,
+    key_id INTEGER NOT NULL,
+    value_id INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES ways(id),
+    FOREIGN KEY (key_id) REFERENCES tag_keys(id),
+    FOREIGN KEY (value_id) REFERENCES tag_values(id)
+);
+
+CREATE VIEW nodes_tags AS
+    SELECT t.id AS id, k.key AS key, v.value AS value, k.type AS type
+    FROM nodes_tag_ids t
+    JOIN tag_keys k ON k.id = t.key_id
+    JOIN tag_values v ON v.id = t.value_id;
+
+CREATE VIEW ways_tags AS
+    SELECT t.id AS id, k.key AS key, v.value AS value, k.type AS type
+    FROM ways_tag_ids t
+    JOIN tag_keys k ON k.id = t.key_id
+    JOIN tag_values v ON v.id = t.value_id;
+
+-- New keys and values are added to the lookup tables (they are never removed)
+CREATE TRIGGER nodes_tags_insert INSTEAD OF INSERT ON nodes_tags
+BEGIN
+    INSERT OR IGNORE INTO tag_keys (key, type) VALUES (NEW.key, NEW.type);
+    INSERT OR IGNORE INTO tag_values (value) VALUES (NEW.value);
+    INSERT INTO nodes_tag_ids
+        SELECT NEW.id, k.id, v.id FROM tag_keys k, tag_values v
+        WHERE k.key = NEW.key AND k.type = NEW.type AND v.value = NEW.value;
+END;
+
+CREATE TRIGGER ways_tags_insert INSTEAD OF INSERT ON ways_tags
+BEGIN
+    INSERT OR IGNORE INTO tag_keys (key, type) VALUES (NEW.key, NEW.type);
+    INSERT OR IGNORE INTO tag_values (value) VALUES (NEW.value);
+    INSERT INTO ways_tag_ids
+        SELECT NEW.id, k.id, v.id FROM tag_keys k, tag_values v
+        WHERE k.key = NEW.key AND k.type = NEW.type AND v.value = NEW.value;
+END;
+
+CREATE TRIGGER nodes_tags_delete INSTEAD OF DELETE ON nodes_tags
+BEGIN
+    DELETE FROM nodes_tag_ids WHERE id = OLD.id
+        AND key_id = (SELECT id FROM tag_keys WHERE key = OLD.key AND type = OLD.type)
+        AND value_id = (SELECT id FROM tag_values WHERE value = OLD.value);
+END;
+
+CREATE TRIGGER ways_tags_delete INSTEAD OF DELETE ON ways_tags
+BEGIN
+    DELETE FROM ways_tag_ids WHERE id = OLD.id
+        AND key_id = (SELECT id FROM tag_keys WHERE key = OLD.key AND type = OLD.type)
+        AND value_id = (SELECT id FROM tag_values WHERE value = OLD.value);
+END;
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Fast replacement for cerberus.Validator on the supplied schema.
+# The schema is compiled once into Python source with a specialised check for
+# each field (required, coercion, null and type rules), so validating an
+# element is a single boolean expression of isinstance calls rather than a walk
+# of the rule tree. The (slower) code building the error messages only runs for
+# elements which fail that expression.
+# FastValidator has the same validate()/errors interface as cerberus, and the
+# errors use the cerberus 1.x messages and layout, so validate_element in
+# process_map works (and reports) exactly as before.
+# Only the rules used by schema.py are supported: required, type, coerce and
+# schema (for dicts and lists of dicts).
+#
+# Run with an OSM file to compare errors and timing with cerberus.
+
+import collections
+import sys
+import time
+
+# Python types accepted for each cerberus type name
+TYPES = {'integer': '(int, long)',
+         'float': '(float, int, long)',
+         'number': '(float, int, long)',
+         'string': 'basestring',
+         'boolean': 'bool',
+         'dict': 'Mapping',
+         'list': 'list'}
+
+SUPPORTED_RULES = set(['required', 'type', 'coerce', 'schema'])
+
+class SchemaCompiler(object):
+    """Generate the source of validation functions for a cerberus schema"""
+
+    def __init__(self):
+        self.lines = []
+        self.constants = {}
+        self.count = 0
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def compile_mapping(self, schema, coerce_last=False):
+        # Emit functions checking a dict against schema and return their number:
+        # _valid_<n> quickly tests whether the dict is valid, and _check_<n>
+        # builds the errors (only called when _valid_<n> fails)
+        # (cerberus reports coercion errors after the other errors for the
+        # items of a list, but before them everywhere else)
+        n = self.count
+        name = '_check_%d' % n
+        self.count += 1
+        fields = {}
+        for field, rules in schema.iteritems():
+            unsupported = set(rules) - SUPPORTED_RULES
+            if unsupported:
+                raise Exception('Unsupported rules for field %r: %s' % (field, sorted(unsupported)))
+            fields[field] = rules
+
+        # Nested schemas are compiled first so their functions are defined
+        nested = {}
+        for field, rules in fields.iteritems():
+            if 'schema' in rules:
+                if rules.get('type') == 'list':
+                    nested[field] = self.compile_mapping(rules['schema']['schema'], True)
+                else:
+                    nested[field] = self.compile_mapping(rules['schema'])
+
+        self.constants['_fields_%d' % n] = frozenset(fields)
+        self.emit(0, 'def _valid_%d(d):' % n)
+        self.emit(1, 'try:')
+        self.emit(2, 'return (type(d) is dict and _fields_%d.issuperset(d)' % n)
+        for field, rules in fields.iteritems():
+            self.emit(4, 'and ' + self.valid_expr(field, rules, nested.get(field)))
+        self.emit(4, ')')
+        self.emit(1, 'except Exception:')
+        self.emit(2, 'return False')
+        self.emit(0, '')
+        self.emit(0, 'def %s(d):' % name)
+        self.emit(1, 'errors = {}')
+        self.emit(1, 'for field in d:')
+        self.emit(2, 'if field not in _fields_%d:' % n)
+        self.emit(3, "errors[field] = ['unknown field']")
+        for field, rules in fields.iteritems():
+            self.compile_field(field, rules, nested.get(field), coerce_last)
+        self.emit(1, 'return errors')
+        self.emit(0, '')
+        return n
+
+    def add_coercer(self, rules):
+        # Return name under which the coerce function is available
+        coercer = '_coerce_%d' % len(self.constants)
+        self.constants[coercer] = rules['coerce']
+        return coercer
+
+    def valid_expr(self, field, rules, nested):
+        # Return expression which is true if field is valid
+        # (missing required fields and failed coercions raise an exception)
+        v = 'd[%r]' % field
+        if 'coerce' in rules:
+            v = '%s(%s)' % (self.add_coercer(rules), v)
+        if nested is not None and rules.get('type') == 'list':
+            expr = '_valid_items(_valid_%d, %s)' % (nested, v)
+        elif nested is not None:
+            expr = '_valid_%d(%s)' % (nested, v)
+        elif 'type' in rules:
+            expr = 'isinstance(%s, %s)' % (v, TYPES[rules['type']])
+        else:
+            expr = '%s is not None' % v
+        if not rules.get('required'):
+            expr = '(%r not in d or %s)' % (field, expr)
+        return expr
+
+    def compile_field(self, field, rules, nested, coerce_last):
+        self.emit(1, 'if %r in d:' % field)
+        self.emit(2, 'v = d[%r]' % field)
+        self.emit(2, 'msgs = []')
+        if 'coerce' in rules:
+            # Coercion is attempted before the null check
+            coercer = self.add_coercer(rules)
+            message = "\"field '%s' cannot be coerced: %%s\" %% e" % field
+            self.emit(2, 'try:')
+            self.emit(3, 'v = %s(v)' % coercer)
+            self.emit(2, 'except Exception as e:')
+            if coerce_last:
+                self.emit(3, 'coerce_msg = ' + message)
+                self.emit(2, 'else:')
+                self.emit(3, 'coerce_msg = None')
+            else:
+                self.emit(3, 'msgs.append(%s)' % message)
+        self.emit(2, 'if v is None:')
+        self.emit(3, "msgs.append('null value not allowed')")
+        if 'type' in rules:
+            if rules['type'] == 'dict':
+                # Avoid the (slow) abstract base class check for plain dicts
+                self.emit(2, 'elif type(v) is not dict and not isinstance(v, Mapping):')
+            else:
+                self.emit(2, 'elif not isinstance(v, %s):' % TYPES[rules['type']])
+            self.emit(3, "msgs.append('must be of %s type')" % rules['type'])
+            if nested is not None and rules['type'] == 'list':
+                self.emit(2, 'else:')
+                self.emit(3, 'items = {}')
+                self.emit(3, 'for i, item in enumerate(v):')
+                self.emit(4, 'if item is None:')
+                self.emit(5, "items[i] = ['null value not allowed']")
+                self.emit(4, 'elif type(item) is not dict and not isinstance(item, Mapping):')
+                self.emit(5, "items[i] = ['must be of dict type']")
+                self.emit(4, 'else:')
+                self.emit(5, 'e = _check_%d(item)' % nested)
+                self.emit(5, 'if e:')
+                self.emit(6, 'items[i] = [e]')
+                self.emit(3, 'if items:')
+                self.emit(4, 'msgs.append(items)')
+            elif nested is not None:
+                self.emit(2, 'else:')
+                self.emit(3, 'e = _check_%d(v)' % nested)
+                self.emit(3, 'if e:')
+                self.emit(4, 'msgs.append(e)')
+        if 'coerce' in rules and coerce_last:
+            self.emit(2, 'if coerce_msg:')
+            self.emit(3, 'msgs.append(coerce_msg)')
+        self.emit(2, 'if msgs:')
+        self.emit(3, 'errors[%r] = msgs' % field)
+        if rules.get('required'):
+            self.emit(1, 'else:')
+            self.emit(2, "errors[%r] = ['required field']" % field)
+
+def valid_items(valid, items):
+    # Return True if items is a list of valid dicts
+    return type(items) is list and all(map(valid, items))
+
+def compile_schema(schema):
+    """Return (check function, generated source) for a cerberus schema"""
+    compiler = SchemaCompiler()
+    n = compiler.compile_mapping(schema)
+    compiler.emit(0, 'def validate(d):')
+    compiler.emit(1, 'if _valid_%d(d):' % n)
+    compiler.emit(2, 'return {}')
+    compiler.emit(1, 'return _check_%d(d)' % n)
+    source = '\n'.join(compiler.lines)
+    namespace = {'Mapping': collections.Mapping, '_valid_items': valid_items}
+    namespace.update(compiler.constants)
+    exec compile(source, '<schema>', 'exec') in namespace
+    return namespace['validate'], source
+
+class FastValidator(object):
+    """Drop-in replacement for cerberus.Validator(...).validate(document, schema)"""
+
+    compiled = {}
+
+    def __init__(self, schema=None):
+        self.schema = schema
+        self.errors = {}
+
+    def check(self, schema):
+        # Return compiled check for schema (compiled on first use)
+        key = id(schema)
+        if key not in FastValidator.compiled:
+            FastValidator.compiled[key] = (schema, compile_schema(schema)[0])
+        return FastValidator.compiled[key][1]
+
+    def validate(self, document, schema=None):
+        self.errors = self.check(schema or self.schema)(document)
+        return not self.errors
+
+    def validate_batch(self, documents, schema=None):
+        # Return list of (index, errors) for the documents which fail
+        check = self.check(schema or self.schema)
+        failures = []
+        for i, document in enumerate(documents):
+            errors = check(document)
+            if errors:
+                failures.append((i, errors))
+        return failures
+
+def compare_with_cerberus(osmfile):
+    # Validate every element of osmfile with both validators and compare
+    import cerberus
+    import process_map as pm
+    elements = [pm.process_element(e) for e in pm.get_element(osmfile, tags=('node', 'way'))]
+    for name, validator in [('cerberus', cerberus.Validator()), ('fast', FastValidator())]:
+        start = time.time()
+        errors = [validator.errors for el in elements
+                  if validator.validate(el, pm.SCHEMA) is not True]
+        print '%-10s %8.2f s  %d invalid elements' % (name, time.time() - start, len(errors))
+        if name == 'cerberus':
+            expected = errors
+    if errors != expected:
+        raise Exception('Errors differ from cerberus')
+
+
+if __name__ == "__main__":
+    if len(sys.argv)>1:
+        compare_with_cerberus(sys.argv[1])
+    else:
+        import schema
+        print compile_schema(schema.schema)[1]
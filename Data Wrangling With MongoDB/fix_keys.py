@@ -6,9 +6,10 @@
 # Keys begining with 'not' will be ignored. This includes notes but they will not be needed anyway.
 # The trailing '_[number]' will be removed from all keys ending in '_[number]'.
 
-import xml.etree.cElementTree as ET
+import collections
 import re
 import sys
+from audit import Analyzer, run_audits
 
 # Regular expressions
 ignore_re=re.compile(r'(^not)|(^todo)|(fixme)',re.IGNORECASE)
@@ -59,21 +60,39 @@ def fix_key(k):
     return k
 
 
-def fix_keys(osmfile):
-    osm_file = open(osmfile, "r")
-    k_count=0
-    k_fixed=0
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
+class KeyFixAudit(Analyzer):
+    # Count keys changed by fix_key
+    # (each change is printed as it is found if echo is set, otherwise
+    # distinct changes are printed with their counts by report)
+
+    def __init__(self,echo=False):
+        self.echo=echo
+        self.k_count=0
+        self.k_fixed=0
+        self.changes=collections.Counter()
+
+    def process(self,elem):
         if elem.tag == "node" or elem.tag == "way":
             for tag in elem.iter("tag"):
-                k_count+=1
+                self.k_count+=1
                 ok=tag.attrib['k']
                 nk=fix_key(ok)
                 if ok!=nk:
-                    print ok,' -> ',nk
-                    k_fixed+=1
-    osm_file.close()
-    print '\n*** Fixed '+str(k_fixed)+' out of '+str(k_count)+' keys ***'
+                    if self.echo:
+                        print ok,' -> ',nk
+                    else:
+                        self.changes[(ok,nk)]+=1
+                    self.k_fixed+=1
+
+    def report(self):
+        for (ok,nk),count in sorted(self.changes.iteritems()):
+            print ok,' -> ',nk,' ('+str(count)+')'
+        print '\n*** Fixed '+str(self.k_fixed)+' out of '+str(self.k_count)+' keys ***'
+
+def fix_keys(osmfile):
+    audit=KeyFixAudit(echo=True)
+    run_audits(osmfile,[audit])
+    audit.report()
     return
 
 if __name__ == "__main__":
@@ -6,9 +6,11 @@
 # Each word will modified to start with a capital letter.
 # Welsh names containing *'Y'*, *'Yr'* and *'Yn'* will be hyphenated, for example *'Ael Y Bryn'* becomes *'Ael-Y-Bryn'*.
 
-import xml.etree.cElementTree as ET
+import collections
 import re
 import sys
+from audit import Analyzer, run_audits
+from value_cleaner import ValueCleaner
 
 # Values to be cleaned
 to_be_cleaned=['addr:street', 'name', 'amenity', 'cuisine']
@@ -96,30 +98,48 @@ def ignore_vals(v):
         ignore=True
     return ignore
         
+# Value cleaning rules compiled once from the tables above
+value_cleaner=ValueCleaner(abbr_mapping,welsh_mapping,unwanted_re,postcode_re,acceptable)
+
 def fix_value(v):
-    if not ignore_vals(v):
-        v=remove_unwanted(v)
-        v=capitalise(v)
-        v=update_abbr(v)
-        v=update_welsh(v)
-    return v
+    # Equivalent to remove_unwanted, capitalise, update_abbr and update_welsh
+    # (unless ignore_vals) but using the precompiled rules
+    return value_cleaner.clean(v)
 
-def fix_values(osmfile):
-    osm_file=open(osmfile,"r")
-    v_count=0
-    v_fixed=0
-    for event,elem in ET.iterparse(osm_file,events=("start",)):
+class ValueFixAudit(Analyzer):
+    # Count values changed by fix_value
+    # (each change is printed as it is found if echo is set, otherwise
+    # distinct changes are printed with their counts by report)
+
+    def __init__(self,echo=False):
+        self.echo=echo
+        self.v_count=0
+        self.v_fixed=0
+        self.changes=collections.Counter()
+
+    def process(self,elem):
         if elem.tag=="node" or elem.tag=="way":
             for tag in elem.iter("tag"):
                 if tag.attrib['k'] in to_be_cleaned:
-                    v_count+=1
+                    self.v_count+=1
                     ov=tag.attrib['v']
                     nv=fix_value(ov)
                     if ov!=nv:
-                        print ov,' -> ',nv
-                        v_fixed+=1
-    osm_file.close()
-    print '\n*** Fixed '+str(v_fixed)+' out of '+str(v_count)+' values ***'
+                        if self.echo:
+                            print ov,' -> ',nv
+                        else:
+                            self.changes[(ov,nv)]+=1
+                        self.v_fixed+=1
+
+    def report(self):
+        for (ov,nv),count in sorted(self.changes.iteritems()):
+            print ov,' -> ',nv,' ('+str(count)+')'
+        print '\n*** Fixed '+str(self.v_fixed)+' out of '+str(self.v_count)+' values ***'
+
+def fix_values(osmfile):
+    audit=ValueFixAudit(echo=True)
+    run_audits(osmfile,[audit])
+    audit.report()
     return
 
 
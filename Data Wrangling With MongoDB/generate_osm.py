@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Generator of synthetic OpenStreetMap XML for benchmarking.
+# The real area.osm cannot be shared, so this writes a file of any size with
+# a similar mix of data: most nodes untagged, ways of a few to a few dozen
+# nodes, and tag keys and values drawn from weighted tables which include
+# everything the cleaning code handles (abbreviations in abbr_mapping, Welsh
+# names in welsh_mapping, name:xx and suffixed keys, fixme/note keys which are
+# dropped, multi-value amenity and cuisine tags, post codes, URLs, non-ASCII
+# and unwanted characters). The same size and seed always give the same file.
+#
+# Usage: generate_osm.py <osmfile> [nodes [seed]]
+
+import bisect
+import random
+import sys
+from xml.sax.saxutils import quoteattr
+
+# Area covered (roughly that of area.osm)
+BOUNDS = (53.10, -3.10, 53.30, -2.80)
+
+# Elements per node
+WAYS_PER_NODE = 0.12
+RELATIONS_PER_NODE = 0.004
+TAGGED_NODES = 0.15 # Fraction of nodes with tags
+
+# (weight, value) tables
+street_names = [(5, 'High'), (4, 'Station'), (4, 'Church'), (3, 'Mill'), (3, 'Park'),
+                (3, 'Victoria'), (2, 'Chester'), (2, 'Wrexham'), (2, 'Bridge'), (2, 'Castle'),
+                (2, 'Ael Y Bryn'), (1, 'Pen Yr Allt'), (1, 'Bryn Yn Y Coed'), (1, 'Ffordd Yr Eglwys'),
+                (1, u'Ffordd Glyndŵr'), (1, u'Tŷ Gwyn'), (1, 'Heol Y Plas'), (1, "St John's")]
+street_types = [(20, 'Street'), (20, 'Road'), (10, 'Lane'), (6, 'Avenue'), (4, 'Close'),
+                (3, 'Way'), (3, 'Drive'), (2, 'Square'), (6, 'Rd'), (2, 'Ave'), (1, 'Sq'),
+                (1, 'Blvd'), (1, 'By-Pass'), (2, 'St'), (4, '')]
+amenities = [(10, 'parking'), (6, 'bench'), (5, 'pub'), (4, 'restaurant'), (4, 'cafe'),
+             (3, 'place_of_worship'), (3, 'school'), (2, 'post_box'), (2, 'fast_food'),
+             (2, 'pub;restaurant'), (1, 'cafe;restaurant'), (1, 'bank')]
+cuisines = [(5, 'indian'), (4, 'chinese'), (4, 'fish_and_chips'), (3, 'italian'),
+            (2, 'pizza'), (2, 'indian;chinese'), (1, 'pizza;kebab;burger'), (1, 'coffee_shop')]
+place_names = [(4, 'The Red Lion PH'), (3, 'the white horse'), (3, 'St Mary (Cofe)'),
+               (2, "O'Neill's"), (2, 'Fish & Chips'), (2, 'Co-op'), (2, 'Tesco Express'),
+               (1, 'Ysgol Y Foryd'), (1, u'Caffi Siôn'), (1, 'The Boat [closed]'),
+               (1, 'Bryn Yn Y Coed'), (1, 'NE Entrance')]
+highways = [(30, 'residential'), (20, 'service'), (12, 'footway'), (8, 'track'),
+            (6, 'unclassified'), (5, 'tertiary'), (3, 'secondary'), (2, 'primary')]
+languages = [(10, 'cy'), (8, 'en'), (2, 'fr'), (1, 'de'), (1, 'ru'), (1, 'zh')]
+sources = [(10, 'bing'), (5, 'survey'), (3, 'OS_OpenData_StreetView'), (2, 'local_knowledge')]
+buildings = [(20, 'yes'), (10, 'house'), (4, 'residential'), (2, 'commercial'), (1, 'church')]
+notes = [(3, 'check name'), (2, 'position approximate'), (1, 'TODO: survey')]
+
+# Tags on tagged nodes and on ways: (weight, key, value table or function name)
+node_keys = [(10, 'amenity', amenities), (6, 'name', 'place'), (4, 'cuisine', cuisines),
+             (6, 'addr:street', 'street'), (5, 'addr:housenumber', 'number'),
+             (4, 'addr:postcode', 'postcode'), (3, 'addr:city', [(3, 'Chester'), (1, 'Flint')]),
+             (3, 'source', sources), (2, 'name:xx', 'place'), (2, 'website', 'website'),
+             (2, 'created_by', [(1, 'JOSM'), (1, 'Potlatch 0.10f')]), (1, 'fixme', notes),
+             (1, 'note', notes), (1, 'name_1', 'place'), (1, 'is_in', [(1, 'Flintshire, Wales')])]
+way_keys = [(20, 'highway', highways), (14, 'name', 'street'), (10, 'building', buildings),
+            (6, 'source', sources), (4, 'name:xx', 'street'), (3, 'addr:street', 'street'),
+            (3, 'addr:housenumber', 'number'), (2, 'amenity', amenities), (2, 'maxspeed', [(1, '30 mph')]),
+            (2, 'oneway', [(1, 'yes')]), (1, 'old_name', 'street'), (1, 'name_1', 'street'),
+            (1, 'FIXME', notes), (1, 'note', notes)]
+
+def weighted(table):
+    # Return function picking a value from a (weight, value...) table with random r
+    total = 0
+    cumulative = []
+    for row in table:
+        total += row[0]
+        cumulative.append(total)
+    items = [row[1:] if len(row) > 2 else row[1] for row in table]
+    def choose(r):
+        return items[bisect.bisect_right(cumulative, r.random() * total)]
+    return choose
+
+class TagMaker(object):
+    """Draw (key, value) pairs from the tables above"""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.node_key = weighted(node_keys)
+        self.way_key = weighted(way_keys)
+        self.street_name = weighted(street_names)
+        self.street_type = weighted(street_types)
+        self.place = weighted(place_names)
+        self.language = weighted(languages)
+        self.tables = {}
+
+    def value(self, kind):
+        rng = self.rng
+        if not isinstance(kind, basestring):
+            if id(kind) not in self.tables:
+                self.tables[id(kind)] = weighted(kind)
+            return self.tables[id(kind)](rng)
+        elif kind == 'street':
+            name = (self.street_name(rng) + ' ' + self.street_type(rng)).strip()
+            # Some names are entered in lower case
+            return name.lower() if rng.random() < 0.05 else name
+        elif kind == 'place':
+            return self.place(rng)
+        elif kind == 'number':
+            return str(rng.randint(1, 200))
+        elif kind == 'postcode':
+            return 'CH%d %d%s' % (rng.randint(1, 8), rng.randint(0, 9),
+                                  ''.join(rng.choice('ABDEFGHJLNPQRSTUWXYZ') for _ in range(2)))
+        elif kind == 'website':
+            return rng.choice(['http://www.', 'https://', 'www.']) + 'example.co.uk'
+
+    def tags(self, choose_key, count):
+        # Return count tags with distinct keys
+        tags = {}
+        for _ in xrange(count * 3):
+            if len(tags) >= count:
+                break
+            key, kind = choose_key(self.rng)
+            if key == 'name:xx':
+                key = 'name:' + self.language(self.rng)
+            if key not in tags:
+                tags[key] = self.value(kind)
+        return sorted(tags.items())
+
+def write_tags(out, tags):
+    for k, v in tags:
+        out.write('\t\t<tag k=%s v=%s/>\n' % (quoteattr(k), quoteattr(v).encode('utf-8')))
+
+def generate_osm(osm_file, nodes=100000, seed=0):
+    """
+    Write a synthetic OSM file with the given number of nodes (and ways and
+    relations in proportion) and return the number of each element written
+    """
+
+    rng = random.Random(seed)
+    maker = TagMaker(rng)
+    minlat, minlon, maxlat, maxlon = BOUNDS
+    # A few users make most of the edits
+    user = weighted([(1.0 / rank, rank) for rank in range(1, 201)])
+    counts = {'node': nodes, 'way': int(nodes * WAYS_PER_NODE),
+              'relation': int(nodes * RELATIONS_PER_NODE), 'tag': 0}
+
+    with open(osm_file, 'wb') as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        out.write('<osm version="0.6" generator="generate_osm.py">\n')
+        out.write('\t<bounds minlat="%.2f" minlon="%.2f" maxlat="%.2f" maxlon="%.2f"/>\n' % BOUNDS)
+
+        def attributes(element_id):
+            uid = user(rng)
+            return ('id="%d" version="%d" timestamp="20%02d-%02d-%02dT%02d:%02d:%02dZ" '
+                    'changeset="%d" uid="%d" user="user_%d"' %
+                    (element_id, rng.randint(1, 6), rng.randint(8, 17), rng.randint(1, 12),
+                     rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59),
+                     rng.randint(0, 59), rng.randint(1, 50000000), uid, uid))
+
+        for node_id in xrange(1, nodes + 1):
+            attrib = '%s lat="%.7f" lon="%.7f"' % (attributes(node_id),
+                                                   rng.uniform(minlat, maxlat),
+                                                   rng.uniform(minlon, maxlon))
+            tags = maker.tags(maker.node_key, rng.randint(1, 5)) if rng.random() < TAGGED_NODES else []
+            if tags:
+                out.write('\t<node %s>\n' % attrib)
+                write_tags(out, tags)
+                out.write('\t</node>\n')
+                counts['tag'] += len(tags)
+            else:
+                out.write('\t<node %s/>\n' % attrib)
+
+        for i in xrange(counts['way']):
+            out.write('\t<way %s>\n' % attributes(nodes + i + 1))
+            # Mostly short ways of nearby nodes, some closed
+            length = min(2 + int(rng.expovariate(0.15)), 200)
+            first = rng.randint(1, max(1, nodes - length))
+            refs = [min(nodes, first + j) for j in xrange(length)]
+            if length > 3 and rng.random() < 0.3:
+                refs.append(refs[0])
+            for ref in refs:
+                out.write('\t\t<nd ref="%d"/>\n' % ref)
+            tags = maker.tags(maker.way_key, rng.randint(1, 6))
+            write_tags(out, tags)
+            counts['tag'] += len(tags)
+            out.write('\t</way>\n')
+
+        for i in xrange(counts['relation']):
+            out.write('\t<relation %s>\n' % attributes(nodes + counts['way'] + i + 1))
+            for _ in xrange(rng.randint(2, 10)):
+                out.write('\t\t<member type="way" ref="%d" role=""/>\n' %
+                          (nodes + rng.randint(1, max(1, counts['way']))))
+            write_tags(out, [('type', 'route'), ('route', 'bus')])
+            counts['tag'] += 2
+            out.write('\t</relation>\n')
+
+        out.write('</osm>\n')
+    return counts
+
+def print_counts(counts):
+    # Print the number of each element written by generate_osm
+    print '\n%-12s %12s' % ('Element', 'Written')
+    for element in ['node', 'way', 'relation', 'tag']:
+        print '%-12s %12d' % (element, counts[element])
+
+
+if __name__ == "__main__":
+    filename=sys.argv[1]
+    nodes=int(sys.argv[2]) if len(sys.argv)>2 else 100000
+    seed=int(sys.argv[3]) if len(sys.argv)>3 else 0
+    print_counts(generate_osm(filename,nodes,seed))
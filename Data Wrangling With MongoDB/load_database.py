@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Load cleaned map data straight into SQLite.
+# Rows from process_map.element_rows are inserted into the data_wrangling_schema.sql
+# tables in large batched transactions, skipping the intermediate csv files and
+# the create_database.sql import. Foreign keys are not enforced during the load
+# (SQLite cannot add them to an existing table, so the schema declares them but
+# they are only checked afterwards) and indexes are created once all rows are in.
+
+import json
+import os
+import sqlite3
+import sys
+import time
+import process_map as pm
+from clean_cache import print_stats
+from fast_validator import FastValidator
+from way_geometry import GeometryBuilder, WAY_GEOMETRY_FIELDS, create_geometry_table, print_geometry_stats
+from spatial_index import create_spatial_index
+from postcode_table import print_postcode_stats
+from summary_tables import build_summaries
+from tag_dictionary import (TagDictionary, ENCODED_INDEXES, TAG_ID_FIELDS, TAG_KEY_FIELDS, TAG_VALUE_FIELDS,
+                            create_encoded_tables, is_encoded)
+
+DB_PATH = "area.db"
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_wrangling_schema.sql")
+
+BATCH_SIZE = 50000 # Rows per table buffered before each executemany
+
+# Settings for bulk loading (the database is rebuilt from scratch if the load fails)
+BULK_PRAGMAS = ["PRAGMA journal_mode=OFF",
+                "PRAGMA synchronous=OFF",
+                "PRAGMA locking_mode=EXCLUSIVE",
+                "PRAGMA temp_store=MEMORY",
+                "PRAGMA cache_size=-200000",
+                "PRAGMA foreign_keys=OFF"]
+
+# Indexes created after the load
+# The tag indexes cover every column used by the report queries, so lookups by
+# element id or by key and value never read the table itself. The ways_nodes
+# (id, position, node_id) index likewise holds the nodes of each way in order,
+# and the node_id index implicitly includes the rowid.
+# (Databases with dictionary encoded tags use tag_dictionary.ENCODED_INDEXES
+# in place of TAG_INDEXES.)
+TAG_INDEXES = ["CREATE INDEX IF NOT EXISTS nodes_tags_id_key ON nodes_tags(id, key, value, type)",
+               "CREATE INDEX IF NOT EXISTS nodes_tags_key_value ON nodes_tags(key, value, type, id)",
+               "CREATE INDEX IF NOT EXISTS ways_tags_id_key ON ways_tags(id, key, value, type)",
+               "CREATE INDEX IF NOT EXISTS ways_tags_key_value ON ways_tags(key, value, type, id)"]
+WAY_NODES_INDEXES = ["CREATE INDEX IF NOT EXISTS ways_nodes_id ON ways_nodes(id, position, node_id)",
+                     "CREATE INDEX IF NOT EXISTS ways_nodes_node_id ON ways_nodes(node_id)"]
+POST_LOAD_INDEXES = TAG_INDEXES + WAY_NODES_INDEXES
+
+# Options of load_database which change the rows written, recorded in the
+# database so that apply_changes.py cleans changes the same way
+LOAD_OPTIONS_SQL = "CREATE TABLE IF NOT EXISTS load_options (name TEXT PRIMARY KEY NOT NULL, value TEXT)"
+
+# Table name, fields and key (as in the process_element dict) for each table
+TABLES = [('nodes', pm.NODE_FIELDS, 'node'),
+          ('nodes_tags', pm.NODE_TAGS_FIELDS, 'node_tags'),
+          ('ways', pm.WAY_FIELDS, 'way'),
+          ('ways_nodes', pm.WAY_NODES_FIELDS, 'way_nodes'),
+          ('ways_tags', pm.WAY_TAGS_FIELDS, 'way_tags')]
+
+# Tables in place of nodes_tags and ways_tags when tags are dictionary encoded
+ENCODED_TABLES = [('nodes', pm.NODE_FIELDS, 'node'),
+                  ('nodes_tag_ids', TAG_ID_FIELDS, 'node_tags'),
+                  ('ways', pm.WAY_FIELDS, 'way'),
+                  ('ways_nodes', pm.WAY_NODES_FIELDS, 'way_nodes'),
+                  ('ways_tag_ids', TAG_ID_FIELDS, 'way_tags'),
+                  ('tag_keys', TAG_KEY_FIELDS, 'tag_keys'),
+                  ('tag_values', TAG_VALUE_FIELDS, 'tag_values')]
+
+# Loaded only when way geometry is computed
+GEOMETRY_TABLE = ('ways_geometry', WAY_GEOMETRY_FIELDS, 'way_geometry')
+
+class TableLoader(object):
+    """Buffer rows for one table and insert them in batches"""
+
+    def __init__(self, db, table, fields, batch_size=BATCH_SIZE):
+        self.db = db
+        self.table = table
+        self.fields = fields
+        self.batch_size = batch_size
+        self.sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(fields),
+                                                        ', '.join('?' * len(fields)))
+        self.rows = []
+        self.count = 0
+        self.seconds = 0.0
+
+    def add(self, row):
+        # row is a tuple in the order of fields
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            start = time.time()
+            self.db.executemany(self.sql, self.rows)
+            self.seconds += time.time() - start
+            self.count += len(self.rows)
+            self.rows = []
+
+def create_database(db_path=DB_PATH, encode_tags=False, geometry=False):
+    # Create an empty database with the supplied schema (replacing any existing file)
+    # (with the encoded tag tables of tag_dictionary if encode_tags is True,
+    # and the ways_geometry table if geometry is True)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    db = sqlite3.connect(db_path, isolation_level=None)
+    for pragma in BULK_PRAGMAS:
+        db.execute(pragma)
+    with open(SCHEMA_PATH) as schema_file:
+        db.executescript(schema_file.read())
+    if encode_tags:
+        create_encoded_tables(db)
+    if geometry:
+        create_geometry_table(db)
+    return db
+
+def save_load_options(db, **options):
+    db.execute(LOAD_OPTIONS_SQL)
+    db.executemany("INSERT OR REPLACE INTO load_options VALUES (?, ?)",
+                   [(name, json.dumps(value)) for name, value in options.iteritems()])
+
+def get_load_options(db):
+    # Return dict of the options saved by load_database (empty if it did not create db)
+    if db.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' "
+                  "AND name = 'load_options'").fetchone()[0] == 0:
+        return {}
+    return dict((name, json.loads(value)) for name, value in db.execute("SELECT name, value FROM load_options"))
+
+def post_load_indexes(db):
+    # Return the indexes to create for the tag tables db has
+    return (ENCODED_INDEXES if is_encoded(db) else TAG_INDEXES) + WAY_NODES_INDEXES
+
+def finish_database(db, summaries=True):
+    # Build indexes (and summary tables), check foreign keys and return the number of violations
+    start = time.time()
+    for sql in post_load_indexes(db):
+        db.execute(sql)
+    if summaries:
+        build_summaries(db)
+    db.execute("ANALYZE")
+    violations = len(db.execute("PRAGMA foreign_key_check").fetchall())
+    db.execute("PRAGMA foreign_keys=ON")
+    return violations, time.time() - start
+
+def print_rates(loaders, seconds):
+    # Print rows and rows/sec for each table
+    print '\n%-12s %12s %12s %14s' % ('Table', 'Rows', 'Insert (s)', 'Rows/sec')
+    for loader in loaders:
+        rate = loader.count / loader.seconds if loader.seconds else 0
+        print '%-12s %12d %12.2f %14.0f' % (loader.table, loader.count, loader.seconds, rate)
+    total = sum(loader.count for loader in loaders)
+    print '%-12s %12d %12.2f %14.0f' % ('Total', total, seconds, total / seconds if seconds else 0)
+
+def load_database(file_in, db_path=DB_PATH, validate=False, cache=False, batch_size=BATCH_SIZE,
+                  geometry=False, spatial=False, postcodes=False, backend=pm.DEFAULT_BACKEND,
+                  summaries=True, encode_tags=False):
+    """
+    Clean each XML element and insert the rows directly into a SQLite database
+
+    file_in:    OSM.xml file to be processed
+    db_path:    Database to be created (any existing file is replaced)
+    validate:   Flag to enable/disable validating the data against the supplied schema
+    cache:      Flag to enable/disable caching of cleaned keys and values
+                (in process_map.CACHE_DIR in the current directory)
+    batch_size: Number of rows inserted per executemany call
+    geometry:   Flag to enable/disable loading the length, centroid and bounding box
+                of each way into the ways_geometry table
+    spatial:    Flag to enable/disable building the R*Tree tables used by
+                spatial_index.SpatialIndex
+    postcodes:  Flag to enable/disable validating and normalising addr:postcode values
+    backend:    XML parser to use ('etree', 'lxml' or 'expat', see osm_parser)
+    summaries:  Flag to enable/disable building the summary tables of summary_tables.py
+                (kept up to date by triggers when the database is changed later)
+    encode_tags: Flag to enable/disable storing tags as key and value ids (see
+                tag_dictionary; nodes_tags and ways_tags become views)
+    """
+
+    start = time.time()
+    db = create_database(db_path, encode_tags, geometry)
+    save_load_options(db, postcodes=postcodes)
+    tables = ENCODED_TABLES if encode_tags else TABLES
+    if geometry:
+        tables = tables + [GEOMETRY_TABLE]
+    loaders = dict((key, TableLoader(db, table, fields, batch_size))
+                   for table, fields, key in tables)
+    if geometry:
+        builder = GeometryBuilder()
+    if encode_tags:
+        dictionary = TagDictionary()
+    clean_key, clean_val, disk = pm.make_cleaners(cache)
+    clean_postcode = pm.make_postcode_cleaner(postcodes)
+
+    if validate:
+        # Instantiate validator, and buffer elements to validate them in batches
+        validator = FastValidator()
+        pending = []
+
+    db.execute("BEGIN")
+    for element in pm.get_element(file_in, ('node', 'way'), backend):
+        # Clean the data
+        rows = pm.element_rows(element, clean_key, clean_val, clean_postcode)
+        if rows:
+            if validate:
+                # Validate
+                pending.append(pm.rows_to_dict(element.tag, rows))
+                if len(pending) >= pm.VALIDATE_BATCH:
+                    pm.validate_elements(pending, validator)
+                    pending = []
+
+            # Add a row for the element and its tags/nodes
+            row, way_nodes, tags = rows
+            if encode_tags:
+                tags = dictionary.encode(tags)
+            if element.tag == 'node':
+                loaders['node'].add(row)
+                loaders['node_tags'].add_many(tags)
+                if geometry:
+                    builder.add_node(row[0], row[1], row[2])
+            else:
+                loaders['way'].add(row)
+                loaders['way_nodes'].add_many(way_nodes)
+                loaders['way_tags'].add_many(tags)
+                if geometry:
+                    geometry_row = builder.way_row(row[0], [n[1] for n in way_nodes])
+                    if geometry_row:
+                        loaders['way_geometry'].add(tuple([geometry_row[field]
+                                                           for field in WAY_GEOMETRY_FIELDS]))
+    if validate:
+        pm.validate_elements(pending, validator)
+    if geometry:
+        builder.close()
+    if encode_tags:
+        tag_keys, tag_values = dictionary.new_rows()
+        loaders['tag_keys'].add_many(tag_keys)
+        loaders['tag_values'].add_many(tag_values)
+    for loader in loaders.itervalues():
+        loader.flush()
+    db.execute("COMMIT")
+
+    violations, index_seconds = finish_database(db, summaries)
+    if spatial:
+        create_spatial_index(db)
+    db.close()
+
+    print_rates([loaders[key] for _, _, key in tables], time.time() - start)
+    print '\nIndexes built in %.2f s, %d foreign key violations' % (index_seconds, violations)
+    stats = pm.cleaner_stats(clean_key, clean_val, disk)
+    if stats:
+        print_stats(stats)
+    if clean_postcode:
+        print_postcode_stats(clean_postcode.stats())
+    if geometry:
+        print_geometry_stats(builder.missing)
+
+
+if __name__ == "__main__":
+    # Usage: load_database.py <osmfile> [database] [cache]
+    filename=sys.argv[1]
+    db_path=sys.argv[2] if len(sys.argv)>2 and sys.argv[2]!='cache' else DB_PATH
+    cache='cache' in sys.argv[2:]
+    load_database(filename,db_path,cache=cache)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Columnar node coordinate files.
+# Node ids, latitudes and longitudes are stored as three fixed width binary
+# columns sorted by id (<prefix>_id.npy, <prefix>_lat.npy and <prefix>_lon.npy).
+# The files use the .npy format so numpy.load(..., mmap_mode='r') can open them
+# directly, but only the standard library is needed to write or read them.
+# NodeCoords memory-maps the columns, so any number of processes can share one
+# copy of the data through the page cache.
+
+import array
+import ast
+import mmap
+import os
+import struct
+import sys
+
+# Typecodes of 64 bit integer and float arrays
+ID_TYPECODE = 'l' if array.array('l').itemsize == 8 else 'q'
+COORD_TYPECODE = 'd'
+
+NPY_MAGIC = '\x93NUMPY\x01\x00'
+BYTE_ORDER = '<' if sys.byteorder == 'little' else '>'
+COLUMNS = ('id', 'lat', 'lon')
+
+def column_paths(prefix):
+    return [prefix + '_' + column + '.npy' for column in COLUMNS]
+
+def write_npy(path, values):
+    # Write array to path as a one dimensional .npy file
+    kind = 'f' if values.typecode in 'fd' else ('u' if values.typecode.isupper() else 'i')
+    descr = BYTE_ORDER + kind + str(values.itemsize)
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, len(values))
+    # Pad so the data starts on a 64 byte boundary
+    header += ' ' * (63 - (len(NPY_MAGIC) + 2 + len(header)) % 64) + '\n'
+    with open(path, 'wb') as npy_file:
+        npy_file.write(NPY_MAGIC + struct.pack('<H', len(header)) + header)
+        values.tofile(npy_file)
+
+def read_npy_header(f):
+    # Return (data offset, length) of a .npy file written by write_npy
+    if f.read(len(NPY_MAGIC)) != NPY_MAGIC:
+        raise Exception('Not a version 1.0 .npy file: ' + f.name)
+    header_len, = struct.unpack('<H', f.read(2))
+    header = ast.literal_eval(f.read(header_len).strip())
+    return len(NPY_MAGIC) + 2 + header_len, header['shape'][0]
+
+class CoordWriter(object):
+    """Collect node coordinates and write them as columns sorted by id"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.ids = array.array(ID_TYPECODE)
+        self.lats = array.array(COORD_TYPECODE)
+        self.lons = array.array(COORD_TYPECODE)
+
+    def add(self, node_id, lat, lon):
+        self.ids.append(int(node_id))
+        self.lats.append(float(lat))
+        self.lons.append(float(lon))
+
+    def extend(self, prefix):
+        # Append the columns previously written with another CoordWriter
+        for column, path in zip((self.ids, self.lats, self.lons), column_paths(prefix)):
+            with open(path, 'rb') as npy_file:
+                _, n = read_npy_header(npy_file)
+                column.fromfile(npy_file, n)
+
+    def close(self):
+        ids, lats, lons = self.ids, self.lats, self.lons
+        # OSM files are normally sorted by id already
+        if any(ids[i] > ids[i + 1] for i in xrange(len(ids) - 1)):
+            order = sorted(xrange(len(ids)), key=ids.__getitem__)
+            ids = array.array(ID_TYPECODE, (ids[i] for i in order))
+            lats = array.array(COORD_TYPECODE, (lats[i] for i in order))
+            lons = array.array(COORD_TYPECODE, (lons[i] for i in order))
+        for column, path in zip((ids, lats, lons), column_paths(self.prefix)):
+            write_npy(path, column)
+
+def merge_coords(prefixes, prefix):
+    # Combine the columns of several CoordWriters (e.g. one per shard)
+    writer = CoordWriter(prefix)
+    for shard_prefix in prefixes:
+        writer.extend(shard_prefix)
+    writer.close()
+
+class Column(object):
+    """Memory-mapped .npy column"""
+
+    def __init__(self, path, typecode):
+        with open(path, 'rb') as npy_file:
+            self.offset, self.length = read_npy_header(npy_file)
+            self.mm = mmap.mmap(npy_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.typecode = typecode
+        self.itemsize = array.array(typecode).itemsize
+        self.fmt = BYTE_ORDER + typecode.replace('l', 'q')
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return struct.unpack_from(self.fmt, self.mm, self.offset + i * self.itemsize)[0]
+
+    def chunk(self, start, end):
+        # Return values start to end as an array
+        values = array.array(self.typecode)
+        values.fromstring(self.mm[self.offset + start * self.itemsize:
+                                  self.offset + end * self.itemsize])
+        return values
+
+    def close(self):
+        self.mm.close()
+
+def bisect_column(column, value):
+    # Return index of the first item >= value in a sorted column
+    lo, hi = 0, len(column)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if column[mid] < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+class NodeCoords(object):
+    """Read-only access to node coordinate columns written by CoordWriter"""
+
+    def __init__(self, prefix):
+        id_path, lat_path, lon_path = column_paths(prefix)
+        self.ids = Column(id_path, ID_TYPECODE)
+        self.lats = Column(lat_path, COORD_TYPECODE)
+        self.lons = Column(lon_path, COORD_TYPECODE)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def bisect(self, node_id):
+        # Return index of the first id >= node_id
+        return bisect_column(self.ids, node_id)
+
+    def get(self, node_id):
+        # Return (lat, lon) of node_id or None if it is not present
+        i = self.bisect(node_id)
+        if i < len(self.ids) and self.ids[i] == node_id:
+            return self.lats[i], self.lons[i]
+        return None
+
+    def id_range(self, min_id, max_id):
+        # Yield (id, lat, lon) for nodes with min_id <= id <= max_id
+        for i in xrange(self.bisect(min_id), len(self.ids)):
+            node_id = self.ids[i]
+            if node_id > max_id:
+                break
+            yield node_id, self.lats[i], self.lons[i]
+
+    def bbox(self, minlat, minlon, maxlat, maxlon, chunk_size=1<<16):
+        # Yield (id, lat, lon) for nodes inside the bounding box
+        # (columns are scanned in chunks so memory use does not grow with file size)
+        for start in xrange(0, len(self.ids), chunk_size):
+            end = min(start + chunk_size, len(self.ids))
+            lats = self.lats.chunk(start, end)
+            lons = self.lons.chunk(start, end)
+            for i in xrange(end - start):
+                if minlat <= lats[i] <= maxlat and minlon <= lons[i] <= maxlon:
+                    yield self.ids[start + i], lats[i], lons[i]
+
+    def close(self):
+        for column in (self.ids, self.lats, self.lons):
+            column.close()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Random access to the elements of an OSM file by id.
+# build_index scans the file once and records the byte offset and length of
+# every node, way and relation. They are stored as columns sorted by id
+# (<osmfile>.index_<type>_id.npy, _offset.npy and _length.npy, in the same
+# format as node_coords), so OSMIndex can memory-map them and find an element
+# with a binary search, then parse just that element's bytes.
+#
+# Usage: osm_index.py <osmfile>                  Build the index
+#        osm_index.py <osmfile> <type> <id>      Print an element
+
+import array
+import mmap
+import os
+import re
+import sys
+import xml.etree.cElementTree as ET
+from node_coords import ID_TYPECODE, Column, bisect_column, write_npy
+
+ELEMENT_TYPES = ('node', 'way', 'relation')
+
+# Opening tag of a top level element (attribute values may contain '>')
+element_re = re.compile(r'<(node|way|relation)((?:\s+[\w:]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*)\s*(/?)>')
+id_re = re.compile(r'\sid\s*=\s*["\'](-?\d+)["\']')
+
+def index_paths(osmfile, tag):
+    prefix = '%s.index_%s_' % (osmfile, tag)
+    return [prefix + column + '.npy' for column in ('id', 'offset', 'length')]
+
+def scan_elements(mm):
+    """Yield (tag, id, offset, length) for each top level element in mm"""
+    for m in element_re.finditer(mm):
+        tag = m.group(1)
+        if m.group(3):
+            end = m.end()
+        else:
+            end = mm.find('</%s>' % tag, m.end()) + len(tag) + 3
+        yield tag, int(id_re.search(m.group(2)).group(1)), m.start(), end - m.start()
+
+def write_index(osmfile, tag, ids, offsets, lengths):
+    # Write columns for one element type, sorted by id
+    if any(ids[i] > ids[i + 1] for i in xrange(len(ids) - 1)):
+        order = sorted(xrange(len(ids)), key=ids.__getitem__)
+        ids = array.array(ID_TYPECODE, (ids[i] for i in order))
+        offsets = array.array(ID_TYPECODE, (offsets[i] for i in order))
+        lengths = array.array('i', (lengths[i] for i in order))
+    for column, path in zip((ids, offsets, lengths), index_paths(osmfile, tag)):
+        write_npy(path, column)
+
+def build_index(osmfile):
+    """Index the offset and length of every node, way and relation in osmfile"""
+    columns = dict((tag, (array.array(ID_TYPECODE), array.array(ID_TYPECODE), array.array('i')))
+                   for tag in ELEMENT_TYPES)
+    with open(osmfile, 'rb') as osm_file:
+        mm = mmap.mmap(osm_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for tag, element_id, offset, length in scan_elements(mm):
+                ids, offsets, lengths = columns[tag]
+                ids.append(element_id)
+                offsets.append(offset)
+                lengths.append(length)
+        finally:
+            mm.close()
+    for tag, (ids, offsets, lengths) in columns.iteritems():
+        write_index(osmfile, tag, ids, offsets, lengths)
+    return dict((tag, len(ids)) for tag, (ids, _, _) in columns.iteritems())
+
+class OSMIndex(object):
+    """Memory-mapped index returning elements of an OSM file by id"""
+
+    def __init__(self, osmfile):
+        self.osm_file = open(osmfile, 'rb')
+        self.mm = mmap.mmap(self.osm_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.columns = {}
+        for tag in ELEMENT_TYPES:
+            id_path, offset_path, length_path = index_paths(osmfile, tag)
+            self.columns[tag] = (Column(id_path, ID_TYPECODE),
+                                 Column(offset_path, ID_TYPECODE),
+                                 Column(length_path, 'i'))
+
+    def position(self, tag, element_id):
+        # Return index of element in the columns for tag, or None
+        ids = self.columns[tag][0]
+        i = bisect_column(ids, element_id)
+        if i < len(ids) and ids[i] == element_id:
+            return i
+        return None
+
+    def raw(self, tag, element_id):
+        # Return the XML text of an element or None if it is not in the file
+        i = self.position(tag, element_id)
+        if i is None:
+            return None
+        _, offsets, lengths = self.columns[tag]
+        return self.mm[offsets[i]:offsets[i] + lengths[i]]
+
+    def get(self, tag, element_id):
+        # Return parsed element or None if it is not in the file
+        text = self.raw(tag, element_id)
+        return ET.fromstring(text) if text is not None else None
+
+    def id_range(self, tag, min_id, max_id):
+        # Yield parsed elements with min_id <= id <= max_id
+        ids, offsets, lengths = self.columns[tag]
+        for i in xrange(bisect_column(ids, min_id), len(ids)):
+            if ids[i] > max_id:
+                break
+            yield ET.fromstring(self.mm[offsets[i]:offsets[i] + lengths[i]])
+
+    def close(self):
+        for column_set in self.columns.itervalues():
+            for column in column_set:
+                column.close()
+        self.mm.close()
+        self.osm_file.close()
+
+
+if __name__ == "__main__":
+    filename=sys.argv[1]
+    if len(sys.argv)>3:
+        if not os.path.exists(index_paths(filename,'node')[0]):
+            build_index(filename)
+        index=OSMIndex(filename)
+        print index.raw(sys.argv[2],int(sys.argv[3]))
+        index.close()
+    else:
+        print build_index(filename)
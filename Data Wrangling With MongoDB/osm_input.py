@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Streaming decompression of .osm.gz and .osm.bz2 input.
+# open_input returns a file-like object giving the uncompressed XML, so the
+# parser backends can read compressed extracts without writing them to disk.
+# Large .bz2 files are often written by parallel compressors (e.g. pbzip2 or
+# lbzip2) as many concatenated streams. Those streams are decompressed by a
+# pool of worker processes, a few at a time and in order; a single stream is
+# decompressed in this process. (The Python 2 BZ2File stops after the first
+# stream, so it is not used.) gzip members are decompressed in order by GzipFile.
+
+import bz2
+import collections
+import gzip
+import itertools
+import mmap
+import multiprocessing
+import os
+import re
+
+READ_SIZE = 1<<20 # Compressed bytes read at a time
+
+# Start of a bzip2 stream: header and magic number of its first block
+bz2_stream_re = re.compile(r'BZh[1-9]1AY&SY')
+
+def compression(path):
+    # Return 'gz', 'bz2' or None from the file name
+    if not isinstance(path, basestring):
+        return None
+    for ext in ('gz', 'bz2'):
+        if path.endswith('.' + ext):
+            return ext
+    return None
+
+class ChunkReader(object):
+    """Read-only file-like object over an iterator of strings"""
+
+    def __init__(self, chunks, close=None):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.pos = 0
+        self.on_close = close
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.pos < size:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                break
+            self.buffer = self.buffer[self.pos:] + chunk
+            self.pos = 0
+        if size < 0:
+            size = len(self.buffer) - self.pos
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def __iter__(self):
+        # Yield lines (e.g. for csv.reader)
+        while True:
+            end = self.buffer.find('\n', self.pos)
+            while end < 0:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.buffer = self.buffer[self.pos:] + chunk
+                self.pos = 0
+                end = self.buffer.find('\n')
+            if end < 0:
+                if self.pos < len(self.buffer):
+                    yield self.read()
+                return
+            line = self.buffer[self.pos:end + 1]
+            self.pos = end + 1
+            yield line
+
+    def close(self):
+        if self.on_close:
+            self.on_close()
+
+def bz2_sequential(f, offset=0):
+    # Yield decompressed data of all the streams in f from offset
+    f.seek(offset)
+    decompressor = bz2.BZ2Decompressor()
+    while True:
+        data = f.read(READ_SIZE)
+        if not data:
+            break
+        while data:
+            try:
+                out = decompressor.decompress(data)
+            except EOFError:
+                # The previous stream ended exactly at the end of the last read
+                decompressor = bz2.BZ2Decompressor()
+                continue
+            if out:
+                yield out
+            data = decompressor.unused_data
+            if data:
+                decompressor = bz2.BZ2Decompressor()
+
+def find_bz2_streams(f):
+    # Return offsets of the possible starts of bzip2 streams in f
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return [m.start() for m in bz2_stream_re.finditer(mm)]
+    finally:
+        mm.close()
+
+def decompress_stream(args):
+    # Return (True, data) if the range holds exactly one complete stream, else (False, None)
+    path, start, end = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        compressed = f.read(end - start)
+    decompressor = bz2.BZ2Decompressor()
+    try:
+        data = decompressor.decompress(compressed)
+        # A complete stream makes any further input an error
+        decompressor.decompress('\0')
+    except EOFError:
+        return not decompressor.unused_data, data
+    except IOError:
+        pass
+    return False, None
+
+def bz2_parallel(path, f, offsets, workers):
+    # Yield decompressed data, streams being decompressed by a pool of workers
+    # (a false stream start in compressed data falls back to sequential decompression)
+    ends = offsets[1:] + [os.path.getsize(path)]
+    jobs = iter([(path, start, end) for start, end in zip(offsets, ends)])
+    pool = multiprocessing.Pool(workers)
+    pending = collections.deque()
+    try:
+        while True:
+            # Keep a few streams ahead of the one being returned
+            for job in itertools.islice(jobs, workers * 2 - len(pending)):
+                pending.append((job[1], pool.apply_async(decompress_stream, (job,))))
+            if not pending:
+                return
+            start, result = pending.popleft()
+            ok, data = result.get()
+            if not ok:
+                break
+            yield data
+        for data in bz2_sequential(f, start):
+            yield data
+    finally:
+        pool.terminate()
+        pool.join()
+
+def open_input(osm_file, workers=1):
+    """
+    Return a file-like object giving the XML of osm_file
+    (decompressing .gz and .bz2 files, with up to workers processes for bz2)
+    """
+    kind = compression(osm_file)
+    if kind == 'gz':
+        return gzip.open(osm_file, 'rb')
+    elif kind == 'bz2':
+        f = open(osm_file, 'rb')
+        offsets = find_bz2_streams(f) if workers > 1 else []
+        if len(offsets) > 1 and offsets[0] == 0:
+            chunks = bz2_parallel(osm_file, f, offsets, workers)
+        else:
+            chunks = bz2_sequential(f)
+        return ChunkReader(chunks, f.close)
+    return osm_file
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Interchangeable XML parser backends for reading the top level elements
+# (node, way, relation etc.) of an OSM file.
+#
+# etree:  xml.etree.cElementTree.iterparse (the original approach)
+# lxml:   lxml.etree.iterparse, filtering tags in C when no root is needed
+#         (only available if lxml is installed)
+# expat:  xml.parsers.expat callbacks building LightElements, which have just
+#         the parts of the Element interface used by these scripts. Top level
+#         elements not in tags are skipped without building anything. Every
+#         element is built by a Python callback, so this backend parses 2-3x
+#         slower than etree and lxml (see benchmark_parsers.py): it is not a
+#         way to make parsing faster.
+#
+# Compressed (.gz, .bz2) and PBF input is also accepted, see iter_elements.
+#
+# Every backend gives the same tags, attributes and children, with attribute
+# values as str when they are ASCII and unicode otherwise (as cElementTree
+# does, judged by the value after character references are replaced), so the
+# output of the cleaning and audit code does not depend on the backend used.
+
+from itertools import izip
+import re
+import xml.etree.cElementTree as ET
+from xml.parsers import expat
+from osm_input import compression, open_input
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+BACKENDS = ('etree', 'lxml', 'expat')
+DEFAULT_BACKEND = 'etree'
+
+READ_SIZE = 1<<16 # Bytes read at a time by the expat backend
+
+def available_backends():
+    return [backend for backend in BACKENDS if backend != 'lxml' or lxml_etree is not None]
+
+def open_file(osm_file):
+    # Return (file object, True if opened here) for a file name or file-like object
+    if hasattr(osm_file, 'read'):
+        return osm_file, False
+    return open(osm_file, 'rb'), True
+
+################################################################################
+# etree backend
+################################################################################
+
+def iter_etree(osm_file, tags=None, root=False):
+    context = ET.iterparse(osm_file, events=('start', 'end'))
+    _, root_elem = next(context)
+    if root:
+        yield root_elem
+    depth = 1
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                if tags is None or elem.tag in tags:
+                    yield elem
+                root_elem.clear()
+
+################################################################################
+# lxml backend
+################################################################################
+
+def clear_lxml(elem):
+    # Free a processed element and any earlier siblings
+    elem.clear()
+    parent = elem.getparent()
+    while elem.getprevious() is not None:
+        del parent[0]
+
+def iter_lxml(osm_file, tags=None, root=False):
+    if lxml_etree is None:
+        raise Exception('The lxml backend needs lxml to be installed')
+    f, opened = open_file(osm_file)
+    try:
+        if tags is not None and not root:
+            # Only top level elements can have these tags, so let lxml filter them
+            # (relations are included so they are cleared too, even if not wanted)
+            for _, elem in lxml_etree.iterparse(f, events=('end',), tag=set(tags) | set(['relation'])):
+                if elem.tag in tags:
+                    yield elem
+                clear_lxml(elem)
+        else:
+            context = lxml_etree.iterparse(f, events=('start', 'end'))
+            _, root_elem = next(context)
+            if root:
+                yield root_elem
+            depth = 1
+            for event, elem in context:
+                if event == 'start':
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 1:
+                        if tags is None or elem.tag in tags:
+                            yield elem
+                        clear_lxml(elem)
+    finally:
+        if opened:
+            f.close()
+
+################################################################################
+# expat backend
+################################################################################
+
+non_ascii = re.compile(r'[\x80-\xff]').search
+
+class LightElement(object):
+    """Minimal stand-in for an ElementTree Element (tag, attributes and children)"""
+
+    __slots__ = ('tag', 'attrib', 'children', 'get')
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = []
+        # get(key, default=None) straight from the attribute dict
+        self.get = attrib.get
+
+    def getchildren(self):
+        return self.children
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def iter(self, tag=None):
+        # Yield this element and its descendants in document order
+        if tag is None or self.tag == tag:
+            yield self
+        for child in self.children:
+            for elem in child.iter(tag):
+                yield elem
+
+    def keys(self):
+        return self.attrib.keys()
+
+    def items(self):
+        return self.attrib.items()
+
+class ExpatHandler(object):
+    """Build LightElements for the top level elements wanted"""
+
+    def __init__(self, tags):
+        self.tags = tags
+        self.root = None
+        self.stack = []
+        self.depth = 0
+        self.ready = []
+        # Non-ASCII names and values are very repetitive, so their conversion is cached
+        self.strings = {}
+
+    def text(self, s):
+        # Return UTF-8 s as str if it is ASCII (as cElementTree does), otherwise unicode
+        try:
+            return self.strings[s]
+        except KeyError:
+            try:
+                s.decode('ascii')
+                t = s
+            except UnicodeDecodeError:
+                t = s.decode('utf-8')
+            if len(self.strings) < 100000:
+                self.strings[s] = t
+            return t
+
+    def start(self, name, attrs):
+        # attrs is [name, value, ...] as UTF-8 str, only decoded if one of them
+        # (or the tag) is not ASCII
+        if non_ascii(name + ''.join(attrs)):
+            text = self.text
+            name = text(name)
+            attrs = map(text, attrs)
+        pairs = iter(attrs)
+        attrs = dict(izip(pairs, pairs))
+        stack = self.stack
+        if stack:
+            elem = LightElement(name, attrs)
+            stack[-1].children.append(elem)
+            stack.append(elem)
+        else:
+            self.depth += 1
+            if self.depth == 2:
+                if self.tags is None or name in self.tags:
+                    stack.append(LightElement(name, attrs))
+            elif self.depth == 1:
+                self.root = LightElement(name, attrs)
+
+    def end(self, name):
+        stack = self.stack
+        if stack:
+            elem = stack.pop()
+            if not stack:
+                self.ready.append(elem)
+                self.depth -= 1
+        else:
+            self.depth -= 1
+
+def iter_expat(osm_file, tags=None, root=False):
+    handler = ExpatHandler(tags)
+    parser = expat.ParserCreate()
+    # Names and values are passed to the handler as UTF-8 str
+    parser.returns_unicode = False
+    parser.ordered_attributes = True
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    f, opened = open_file(osm_file)
+    try:
+        root_sent = not root
+        while True:
+            data = f.read(READ_SIZE)
+            parser.Parse(data, not data)
+            if not root_sent and handler.root is not None:
+                yield handler.root
+                root_sent = True
+            if handler.ready:
+                ready, handler.ready = handler.ready, []
+                for elem in ready:
+                    yield elem
+            if not data:
+                break
+    finally:
+        if opened:
+            f.close()
+
+################################################################################
+# Backend selection
+################################################################################
+
+PARSERS = {'etree': iter_etree, 'lxml': iter_lxml, 'expat': iter_expat}
+
+def is_pbf(osm_file):
+    return isinstance(osm_file, basestring) and osm_file.endswith('.pbf')
+
+def iter_elements(osm_file, tags=None, backend=DEFAULT_BACKEND, root=False, workers=1):
+    """
+    Yield the top level elements of osm_file using the given backend
+
+    tags:     Only yield elements with one of these tags (all if None)
+    root:     Yield the root element (without its children) first
+    workers:  Processes used to decompress .bz2 or decode .pbf input
+
+    .osm.gz and .osm.bz2 files are decompressed as they are read and .osm.pbf
+    files are read with osm_pbf (whatever the backend).
+    """
+    if backend not in PARSERS:
+        raise Exception('Unknown parser backend: %s (choose from %s)' % (backend, ', '.join(BACKENDS)))
+    if is_pbf(osm_file):
+        from osm_pbf import iter_pbf
+        return iter_pbf(osm_file, tags, root, workers)
+    if compression(osm_file):
+        return iter_compressed(osm_file, tags, backend, root, workers)
+    return PARSERS[backend](osm_file, tags, root)
+
+def iter_compressed(osm_file, tags, backend, root, workers):
+    f = open_input(osm_file, workers)
+    try:
+        for elem in PARSERS[backend](f, tags, root):
+            yield elem
+    finally:
+        f.close()
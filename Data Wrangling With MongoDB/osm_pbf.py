@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Reader for OpenStreetMap PBF files (.osm.pbf).
+# A PBF file is a sequence of blobs, each holding a zlib compressed protocol
+# buffer block of a few thousand nodes, ways or relations with its own string
+# table. Blobs are read in order here and decoded by a pool of worker
+# processes, a few at a time. Workers return plain (tag, attributes, children)
+# tuples, which are turned back into osm_parser.LightElements with the same
+# attributes and children as the XML of the same data, so the cleaning and
+# audit code works on PBF input unchanged.
+# Only the standard library is used: the few protocol buffer messages needed
+# are decoded by hand (see https://wiki.openstreetmap.org/wiki/PBF_Format).
+
+import collections
+import itertools
+import multiprocessing
+import struct
+import time
+import zlib
+from osm_parser import LightElement
+
+# Features a reader must support to decode the file
+SUPPORTED_FEATURES = set(['OsmSchema-V0.6', 'DenseNodes', 'HistoricalInformation'])
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+################################################################################
+# Protocol buffer decoding
+################################################################################
+
+def read_varint(buf, pos):
+    # Return (value, position after it)
+    result = 0
+    shift = 0
+    while True:
+        b = ord(buf[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def signed(n):
+    # int32/int64 fields: negative numbers are encoded as 64 bit two's complement
+    return n - (1 << 64) if n >= (1 << 63) else n
+
+def zigzag(n):
+    # sint32/sint64 fields
+    return (n >> 1) ^ -(n & 1)
+
+def fields(buf):
+    """Yield (field number, value) of a message (varints as int, others as str)"""
+    pos, end = 0, len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise Exception('Unsupported protocol buffer wire type: %d' % wire_type)
+        yield key >> 3, value
+
+def packed(buf):
+    # Return list of the varints in a packed repeated field
+    # (read_varint inlined, as most fields hold many small numbers)
+    values = []
+    append = values.append
+    data = bytearray(buf)
+    pos, end = 0, len(data)
+    while pos < end:
+        b = data[pos]
+        pos += 1
+        if b < 0x80:
+            append(b)
+            continue
+        result = b & 0x7f
+        shift = 7
+        while True:
+            b = data[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        append(result)
+    return values
+
+def packed_sint(buf):
+    return [zigzag(n) for n in packed(buf)]
+
+def delta_decode(values):
+    # Running sum of delta coded values
+    total = 0
+    result = []
+    for value in values:
+        total += value
+        result.append(total)
+    return result
+
+################################################################################
+# Blocks
+################################################################################
+
+def text(s):
+    # UTF-8 string as str if it is ASCII (as cElementTree does), otherwise unicode
+    try:
+        s.decode('ascii')
+        return s
+    except UnicodeDecodeError:
+        return s.decode('utf-8')
+
+def format_coord(nanodegrees, decimals):
+    # Exact decimal text of a coordinate in units of 1e-9 degrees
+    sign = '-' if nanodegrees < 0 else ''
+    whole, frac = divmod(abs(nanodegrees), 10 ** 9)
+    return '%s%d.%s' % (sign, whole, ('%09d' % frac)[:decimals])
+
+def format_timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+class Block(object):
+    """Settings and string table of a PrimitiveBlock"""
+
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+        for field, value in fields(data):
+            if field == 1:
+                self.strings = [text(s) for f, s in fields(value) if f == 1]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.date_granularity = value
+            elif field == 19:
+                self.lat_offset = signed(value)
+            elif field == 20:
+                self.lon_offset = signed(value)
+        # Decimal places needed for the coordinates (7 for the usual granularity)
+        self.decimals = 9 - len(str(self.granularity)) + len(str(self.granularity).rstrip('0'))
+
+    def lat(self, lat):
+        return format_coord(self.lat_offset + self.granularity * lat, self.decimals)
+
+    def lon(self, lon):
+        return format_coord(self.lon_offset + self.granularity * lon, self.decimals)
+
+    def info(self, attrib, version, timestamp, changeset, uid, user_sid):
+        # Add the metadata attributes in the same form as the XML
+        attrib['version'] = str(version)
+        attrib['timestamp'] = format_timestamp(timestamp * self.date_granularity // 1000)
+        attrib['changeset'] = str(changeset)
+        attrib['uid'] = str(uid)
+        attrib['user'] = self.strings[user_sid]
+
+    def tags(self, keys, vals):
+        return [('tag', {'k': self.strings[k], 'v': self.strings[v]}) for k, v in zip(keys, vals)]
+
+def decode_info(block, attrib, data):
+    info = {1: -1, 2: 0, 3: 0, 4: 0, 5: 0}
+    for field, value in fields(data):
+        if field in info:
+            info[field] = value
+    if info[1] != -1:
+        block.info(attrib, signed(info[1]), signed(info[2]), signed(info[3]),
+                   signed(info[4]), info[5])
+
+def decode_dense(block, data, elements):
+    ids = lats = lons = keys_vals = []
+    info = None
+    for field, value in fields(data):
+        if field == 1:
+            ids = delta_decode(packed_sint(value))
+        elif field == 5:
+            info = value
+        elif field == 8:
+            lats = delta_decode(packed_sint(value))
+        elif field == 9:
+            lons = delta_decode(packed_sint(value))
+        elif field == 10:
+            keys_vals = packed(value)
+    # DenseInfo columns: version, timestamp, changeset, uid and user_sid
+    columns = None
+    if info is not None:
+        columns = dict((field, [0] * len(ids)) for field in (1, 2, 3, 4, 5))
+        for field, value in fields(info):
+            if field == 1:
+                columns[field] = [signed(n) for n in packed(value)]
+            elif field in (2, 3, 4, 5):
+                columns[field] = delta_decode(packed_sint(value))
+        columns = zip(*[columns[field] for field in (1, 2, 3, 4, 5)])
+    kv = 0
+    for i, node_id in enumerate(ids):
+        attrib = {'id': str(node_id), 'lat': block.lat(lats[i]), 'lon': block.lon(lons[i])}
+        if columns:
+            block.info(attrib, *columns[i])
+        # Keys and values of each node are followed by a 0
+        tags = []
+        while kv < len(keys_vals) and keys_vals[kv] != 0:
+            tags.append(('tag', {'k': block.strings[keys_vals[kv]],
+                                 'v': block.strings[keys_vals[kv + 1]]}))
+            kv += 2
+        kv += 1
+        elements.append(('node', attrib, tags))
+
+def decode_element(block, tag, data, elements):
+    # Decode a Node, Way or Relation message
+    element_id, keys, vals, info = 0, [], [], None
+    lat = lon = 0
+    refs, roles, memids, types = [], [], [], []
+    for field, value in fields(data):
+        if field == 1:
+            element_id = zigzag(value) if tag == 'node' else signed(value)
+        elif field == 2:
+            keys = packed(value)
+        elif field == 3:
+            vals = packed(value)
+        elif field == 4:
+            info = value
+        elif field == 8:
+            if tag == 'node':
+                lat = zigzag(value)
+            elif tag == 'way':
+                refs = delta_decode(packed_sint(value))
+            else:
+                roles = [signed(n) for n in packed(value)]
+        elif field == 9:
+            if tag == 'node':
+                lon = zigzag(value)
+            else:
+                memids = delta_decode(packed_sint(value))
+        elif field == 10:
+            types = packed(value)
+    attrib = {'id': str(element_id)}
+    if tag == 'node':
+        attrib['lat'] = block.lat(lat)
+        attrib['lon'] = block.lon(lon)
+    if info is not None:
+        decode_info(block, attrib, info)
+    children = []
+    if tag == 'way':
+        children = [('nd', {'ref': str(ref)}) for ref in refs]
+    elif tag == 'relation':
+        children = [('member', {'type': MEMBER_TYPES[t], 'ref': str(ref), 'role': block.strings[r]})
+                    for t, ref, r in zip(types, memids, roles)]
+    elements.append((tag, attrib, children + block.tags(keys, vals)))
+
+# Field number of each element type in a PrimitiveGroup
+GROUP_FIELDS = {1: 'node', 2: 'dense', 3: 'way', 4: 'relation'}
+
+def decode_block(data, tags=None):
+    """Return list of (tag, attrib, children) for the elements of a PrimitiveBlock"""
+    block = Block(data)
+    elements = []
+    for group in block.groups:
+        for field, value in fields(group):
+            kind = GROUP_FIELDS.get(field)
+            if kind == 'dense':
+                if tags is None or 'node' in tags:
+                    decode_dense(block, value, elements)
+            elif kind is not None and (tags is None or kind in tags):
+                decode_element(block, kind, value, elements)
+    return elements
+
+def decode_header(data):
+    # Return the root and bounds elements from an OSMHeader block
+    required = [text(value) for field, value in fields(data) if field == 4]
+    unsupported = set(required) - SUPPORTED_FEATURES
+    if unsupported:
+        raise Exception('Unsupported PBF features: ' + ', '.join(sorted(unsupported)))
+    attrib = {'version': '0.6'}
+    bounds = None
+    for field, value in fields(data):
+        if field == 16:
+            attrib['generator'] = text(value)
+        elif field == 1:
+            box = dict((f, zigzag(v)) for f, v in fields(value))
+            bounds = ('bounds', {'minlon': format_coord(box.get(1, 0), 7),
+                                 'maxlon': format_coord(box.get(2, 0), 7),
+                                 'maxlat': format_coord(box.get(3, 0), 7),
+                                 'minlat': format_coord(box.get(4, 0), 7)}, [])
+    return ('osm', attrib, []), bounds
+
+################################################################################
+# File
+################################################################################
+
+def read_blobs(f):
+    """Yield (type, blob) for each blob in a PBF file"""
+    while True:
+        size = f.read(4)
+        if not size:
+            return
+        header = dict(fields(f.read(struct.unpack('>I', size)[0])))
+        yield header[1], f.read(header[3])
+
+def blob_data(blob):
+    # Return the uncompressed contents of a Blob
+    blob_fields = dict(fields(blob))
+    if 1 in blob_fields:
+        return blob_fields[1]
+    elif 3 in blob_fields:
+        return zlib.decompress(blob_fields[3])
+    raise Exception('Unsupported PBF blob compression (only raw and zlib are supported)')
+
+def decode_blob(args):
+    # Worker: decode one OSMData blob
+    blob, tags = args
+    return decode_block(blob_data(blob), tags)
+
+def light_element(tag, attrib, children):
+    elem = LightElement(tag, attrib)
+    elem.children = [LightElement(child_tag, child_attrib) for child_tag, child_attrib in children]
+    return elem
+
+def iter_pbf(osm_file, tags=None, root=False, workers=1):
+    """
+    Yield the elements of a PBF file as LightElements
+
+    tags:     Only yield elements with one of these tags (all if None)
+    root:     Yield the root element (without its children) first
+    workers:  Number of processes decoding blocks (1 decodes in this process)
+    """
+    f = open(osm_file, 'rb')
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        blobs = read_blobs(f)
+        blob_type, blob = next(blobs)
+        if blob_type != 'OSMHeader':
+            raise Exception('%s does not start with an OSMHeader block' % osm_file)
+        root_elem, bounds = decode_header(blob_data(blob))
+        if root:
+            yield light_element(*root_elem)
+        if bounds and (tags is None or 'bounds' in tags):
+            yield light_element(*bounds)
+
+        jobs = ((blob, tags) for blob_type, blob in blobs if blob_type == 'OSMData')
+        if pool is None:
+            decoded = itertools.imap(decode_blob, jobs)
+        else:
+            decoded = decode_in_order(pool, jobs, workers * 2)
+        for elements in decoded:
+            for element in elements:
+                yield light_element(*element)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        f.close()
+
+def decode_in_order(pool, jobs, ahead):
+    # Yield results of decode_blob for each job in order, with up to ahead in progress
+    # (Pool.imap would read the whole file into its task queue)
+    pending = collections.deque()
+    for job in jobs:
+        pending.append(pool.apply_async(decode_blob, (job,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
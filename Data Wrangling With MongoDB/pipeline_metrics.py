@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Optional instrumentation of a process_map run.
+# PipelineMetrics keeps cumulative timers for each stage (parse, clean,
+# validate, write), counts of elements, tags and rows by type, and counts of
+# the cleaning rules fired. Timing works like a stopwatch with laps: starting
+# a stage stops the previous one, so each element costs one clock read per
+# stage. Progress (elements per second, input bytes read and peak RSS) is
+# logged every few seconds, and report() gives everything as a dict for the
+# final JSON report. Nothing here is used unless metrics are turned on.
+
+import collections
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LOG_INTERVAL = 5.0 # Seconds between progress lines
+RULE_CACHE_SIZE = 100000 # Distinct keys/values whose rules are remembered
+
+def peak_rss():
+    # Return peak resident set size of this process in MB (None if unknown)
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+class CountingFile(object):
+    """Read-only file wrapper counting the bytes read, for progress reporting"""
+
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+class PipelineMetrics(object):
+    """Stage timers, counters and progress of a run"""
+
+    def __init__(self, input_size=None, log_interval=LOG_INTERVAL, log_file=None):
+        self.started = time.time()
+        self.timers = collections.Counter()
+        self.counts = collections.Counter()
+        self.rules = collections.Counter()
+        self.stage = None
+        self.stage_start = None
+        # Set to a CountingFile to report how much of the input has been read
+        self.input = None
+        self.input_size = input_size
+        self.log_interval = log_interval
+        self.next_log = self.started + log_interval if log_interval else None
+        self.log_file = log_file or sys.stderr
+        self.merged_rss = None
+        self.merged_bytes = None
+
+    def start(self, stage):
+        # Stop the current stage (if any) and start timing stage
+        now = time.time()
+        if self.stage is not None:
+            self.timers[self.stage] += now - self.stage_start
+        self.stage = stage
+        self.stage_start = now
+
+    def stop(self):
+        self.start(None)
+
+    def timed(self, elements):
+        # Yield elements, timing the parser as the 'parse' stage
+        elements = iter(elements)
+        while True:
+            self.start('parse')
+            try:
+                element = next(elements)
+            except StopIteration:
+                self.stop()
+                return
+            yield element
+
+    def element(self, tag, rows):
+        # Count an element and the rows made from it by process_map.element_rows
+        counts = self.counts
+        counts[tag] += 1
+        counts[tag + '_tags'] += len(rows[2])
+        if tag == 'way':
+            counts['way_nodes'] += len(rows[1])
+        if self.next_log is not None and self.stage_start >= self.next_log:
+            self.log()
+            self.next_log = self.stage_start + self.log_interval
+
+    def count_rules(self, clean, classify):
+        """
+        Return clean wrapped to count the rules classify(x) says clean(x) fires
+        (the rules of each distinct x are worked out once)
+        """
+        fired = {}
+        rules = self.rules
+        def clean_counted(x):
+            try:
+                names = fired[x]
+            except KeyError:
+                names = classify(x)
+                if len(fired) < RULE_CACHE_SIZE:
+                    fired[x] = names
+            for name in names:
+                rules[name] += 1
+            return clean(x)
+        return clean_counted
+
+    def elements(self):
+        return self.counts['node'] + self.counts['way']
+
+    def bytes_read(self):
+        if self.input is not None:
+            return self.input.bytes_read
+        return self.merged_bytes
+
+    def log(self, message=None):
+        elapsed = time.time() - self.started
+        elements = self.elements()
+        line = '[%8.1fs] %d elements (%.0f/s)' % (elapsed, elements, elements / elapsed if elapsed else 0)
+        bytes_read = self.bytes_read()
+        if bytes_read is not None:
+            line += ', %.1f' % (bytes_read / 1e6)
+            if self.input_size:
+                line += ' of %.1f MB (%.1f%%)' % (self.input_size / 1e6, 100.0 * bytes_read / self.input_size)
+            else:
+                line += ' MB'
+        rss = peak_rss()
+        if rss is not None:
+            line += ', peak RSS %.0f MB' % rss
+        if message:
+            line += ', ' + message
+        print >> self.log_file, line
+
+    def merge(self, report):
+        # Add the timers and counts of another run's report (e.g. a worker process)
+        self.timers.update(report['stages'])
+        self.counts.update(report['counts'])
+        self.rules.update(report['rules'])
+        if report.get('peak_rss_mb') is not None:
+            self.merged_rss = max(self.merged_rss, report['peak_rss_mb'])
+        if report.get('input_bytes') is not None:
+            self.merged_bytes = (self.merged_bytes or 0) + report['input_bytes']
+
+    def report(self, **extra):
+        """Return the metrics as a dict (stage times are summed across workers,
+        if their reports were merged)"""
+        self.stop()
+        elapsed = time.time() - self.started
+        report = {'seconds': round(elapsed, 3),
+                  'elements_per_second': round(self.elements() / elapsed) if elapsed else None,
+                  'stages': dict((stage, round(seconds, 3)) for stage, seconds in self.timers.iteritems()),
+                  'counts': dict(self.counts),
+                  'rules': dict(self.rules),
+                  'input_bytes': self.input_size,
+                  'bytes_read': self.bytes_read(),
+                  'peak_rss_mb': peak_rss()}
+        if self.merged_rss is not None:
+            report['worker_peak_rss_mb'] = self.merged_rss
+        report.update(extra)
+        return report
+
+def write_report(path, report):
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=1, sort_keys=True)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Background threads for the input and output of process_map.
+# Parsing and cleaning hold the GIL, so they stay on the main thread, but
+# reading (and decompressing) the input, formatting csv rows, compressing
+# them and writing the files can overlap with them:
+#
+# ReadAheadFile:   a reader thread keeps a few blocks of input ready
+# WriterStage:     a writer thread formats the batches of rows of
+#                  process_map.RowWriters as csv (in the order they were queued)
+# CompressedFile:  a compressor thread gzip or zstd compresses and writes
+#                  what is written to the file
+#
+# Stages are connected by bounded queues, so a slow stage blocks the one
+# feeding it rather than letting data pile up in memory. An error in a
+# thread is raised again in the main thread at its next put() or close().
+
+import Queue
+import gzip
+import sys
+import threading
+import zlib
+from osm_input import ChunkReader
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+QUEUE_SIZE = 8 # Blocks or batches waiting between two stages
+READ_BLOCK = 1<<20 # Bytes read ahead at a time
+COMPRESS_BLOCK = 1<<20 # Bytes passed to the compressor at a time
+GZIP_LEVEL = 1 # Fast, so compression keeps up with the cleaning
+ZSTD_LEVEL = 3
+
+COMPRESSIONS = ('gz', 'zst')
+
+def compressed_path(path, compress=None):
+    # Return the name of output file path compressed with compress ('gz', 'zst' or None)
+    return path + '.' + compress if compress else path
+
+class Stage(threading.Thread):
+    """Thread passing each item put on a bounded queue to handle(item)"""
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = Queue.Queue(queue_size)
+        self.error = None
+        self.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                # After an error, items are discarded so put() never blocks
+                if self.error is None:
+                    self.handle(item)
+            except Exception:
+                self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+    def handle(self, item):
+        raise NotImplementedError
+
+    def check(self):
+        # Raise any error from the thread in the calling thread
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+
+    def put(self, item):
+        self.check()
+        self.queue.put(item)
+
+    def sync(self):
+        # Wait until everything queued so far has been handled
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        self.check()
+
+################################################################################
+# Reader
+################################################################################
+
+class ReadAheadFile(object):
+    """Read-only file-like object over file f, read in a background thread"""
+
+    def __init__(self, f, block_size=READ_BLOCK, queue_size=QUEUE_SIZE):
+        self.f = f
+        self.block_size = block_size
+        self.blocks = Queue.Queue(queue_size)
+        self.error = None
+        self.stopped = False
+        self.reader = ChunkReader(self.iter_blocks())
+        self.thread = threading.Thread(target=self.read_blocks)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read_blocks(self):
+        try:
+            while not self.stopped:
+                block = self.f.read(self.block_size)
+                self.blocks.put(block)
+                if not block:
+                    return
+        except Exception:
+            self.error = sys.exc_info()
+            self.blocks.put('')
+
+    def iter_blocks(self):
+        while True:
+            block = self.blocks.get()
+            if not block:
+                if self.error is not None:
+                    raise self.error[0], self.error[1], self.error[2]
+                return
+            yield block
+
+    def read(self, size=-1):
+        return self.reader.read(size)
+
+    def close(self):
+        self.stopped = True
+        # Make room for a block the thread may be waiting to queue
+        while self.thread.is_alive():
+            try:
+                self.blocks.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self.f.close()
+
+################################################################################
+# Writers
+################################################################################
+
+class CompressedFile(Stage):
+    """Write-only file compressed with gzip or zstd in a background thread"""
+
+    def __init__(self, path, compress, block_size=COMPRESS_BLOCK, queue_size=QUEUE_SIZE):
+        if compress == 'gz':
+            # wbits 31 gives the gzip format
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        elif compress == 'zst':
+            if zstandard is None:
+                raise Exception('zstd compression needs the zstandard module to be installed')
+            self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        else:
+            raise Exception('Unknown compression: %s (choose from %s)' % (compress, ', '.join(COMPRESSIONS)))
+        self.f = open(path, 'wb')
+        self.block_size = block_size
+        self.buffer = []
+        self.buffered = 0
+        Stage.__init__(self, queue_size)
+
+    def handle(self, data):
+        self.f.write(self.compressor.compress(data))
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self.put(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        try:
+            if self.buffer:
+                self.put(''.join(self.buffer))
+                self.buffer = []
+            Stage.close(self)
+            self.f.write(self.compressor.flush())
+        finally:
+            self.f.close()
+
+class WriterStage(Stage):
+    """Thread writing the batches of rows of any number of process_map.RowWriters"""
+
+    def handle(self, item):
+        row_writer, rows = item
+        row_writer.write(rows)
+
+################################################################################
+# Reading the output back
+################################################################################
+
+def open_csv(path):
+    # Open an output file of process_map for reading, decompressing .gz and .zst files
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    elif path.endswith('.zst'):
+        if zstandard is None:
+            raise Exception('Reading %s needs the zstandard module to be installed' % path)
+        f = open(path, 'rb')
+        return ChunkReader(zstandard.ZstdDecompressor().read_to_iter(f), f.close)
+    return open(path, 'rb')
@@ -1,35 +1,217 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-# Requires installation of postcode.io library
+# Postcode lookups using a local postcode table (postcode_table.POSTCODE_CSV) if
+# there is one, otherwise the postcodes.io API (or a compatible server such as
+# postcode_server.py, given as POSTCODES_URL or the url argument).
+# PostcodeClient looks up many postcodes or coordinates at once: results
+# already in its cache are returned straight away and the rest are sent in bulk
+# requests of up to BULK_SIZE, several at a time, retrying failed requests with
+# exponential backoff. Results are kept on disk (keyed by normalised postcode or
+# by coordinates rounded to COORD_DIGITS decimal places) so later runs only ask
+# for new ones.
+#
+# Usage: postcode.py [osmfile [url]]   Validate every addr:postcode in osmfile
 
-from lib import PostCodeClient
 import json
+import os
+import socket
+import sys
+import time
+import urllib2
+import xml.etree.cElementTree as ET
+from multiprocessing.pool import ThreadPool
+from clean_cache import DiskCache, rules_hash
+from postcode_table import POSTCODE_CSV, PostcodeTable
 
-client = PostCodeClient()
+POSTCODES_URL = "https://api.postcodes.io"
+CACHE_DIR = ".postcode_cache"
+
+BULK_SIZE = 100 # Most postcodes or coordinates allowed in one request
+WORKERS = 8 # Requests in flight at once
+RETRIES = 5 # Attempts per request before giving up
+BACKOFF = 0.5 # Seconds before the first retry (doubled for each retry)
+TIMEOUT = 30 # Seconds to wait for a response
+COORD_DIGITS = 5 # Decimal places coordinates are rounded to (about 1 m)
+
+# Responses worth retrying (rate limited or server errors)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+def postcode_key(postcode):
+    # Upper case without spaces, as used for cache keys
+    return ''.join(postcode.split()).upper()
+
+def coord_key(longitude, latitude):
+    return '%.*f,%.*f' % (COORD_DIGITS, float(longitude), COORD_DIGITS, float(latitude))
+
+def chunks(items, size):
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+class PostcodeClient(object):
+    """Bulk, cached and concurrent postcode lookups"""
+
+    def __init__(self, url=POSTCODES_URL, workers=WORKERS, cache=True,
+                 retries=RETRIES, backoff=BACKOFF, timeout=TIMEOUT):
+        self.url = url.rstrip('/')
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # Results from different servers are kept apart
+        self.disk = DiskCache(CACHE_DIR, rules_hash(self.url, COORD_DIGITS)) if cache else None
+        self.memory = {}
+        self.requests = 0
+        self.failures = 0
+
+    def post(self, path, payload):
+        # POST payload as JSON and return the decoded response, retrying on failure
+        body = json.dumps(payload)
+        for attempt in xrange(self.retries):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                request = urllib2.Request(self.url + path, body, {'Content-Type': 'application/json'})
+                self.requests += 1
+                return json.load(urllib2.urlopen(request, timeout=self.timeout))
+            except urllib2.HTTPError as e:
+                if e.code not in RETRY_STATUS:
+                    raise
+            except (urllib2.URLError, socket.error):
+                pass
+            self.failures += 1
+        raise Exception('No response from %s%s after %d attempts' % (self.url, path, self.retries))
+
+    def cached(self, kind, keys):
+        # Return ({key: result} found in the cache, [keys not found])
+        found, missing = {}, []
+        for key in keys:
+            if (kind, key) in self.memory:
+                found[key] = self.memory[kind, key]
+                continue
+            hit = False
+            if self.disk is not None:
+                hit, value = self.disk.get(kind, key)
+            if hit:
+                found[key] = self.memory[kind, key] = json.loads(value)
+            else:
+                missing.append(key)
+        return found, missing
+
+    def store(self, kind, key, result):
+        self.memory[kind, key] = result
+        if self.disk is not None:
+            self.disk.put(kind, key, json.dumps(result))
+
+    def lookup(self, kind, keys, fetch):
+        # Return {key: result}, calling fetch(batch) -> [(key, result)] for keys not cached
+        found, missing = self.cached(kind, set(keys))
+        if missing:
+            pool = ThreadPool(min(self.workers, len(missing) // BULK_SIZE + 1))
+            try:
+                for results in pool.imap_unordered(fetch, chunks(missing, BULK_SIZE)):
+                    for key, result in results:
+                        self.store(kind, key, result)
+                        found[key] = result
+            finally:
+                pool.close()
+                pool.join()
+            if self.disk is not None:
+                self.disk.flush()
+        return found
+
+    def fetch_postcodes(self, postcodes):
+        # Bulk lookup; the result for a postcode which does not exist is null
+        data = self.post('/postcodes', {'postcodes': postcodes})
+        return [(postcode_key(r['query']), r['result'] is not None) for r in data['result']]
+
+    def fetch_nearest(self, keys):
+        # Bulk reverse geocode of 'lon,lat' keys (results are in the same order)
+        geolocations = []
+        for key in keys:
+            longitude, latitude = key.split(',')
+            geolocations.append({'longitude': float(longitude), 'latitude': float(latitude),
+                                 'limit': 1})
+        data = self.post('/postcodes', {'geolocations': geolocations})
+        results = []
+        for key, r in zip(keys, data['result']):
+            if r['result']:
+                results.append((key, (r['result'][0]['postcode'],
+                                      round(r['result'][0]['distance'], 2))))
+            else:
+                results.append((key, None))
+        return results
+
+    def validate_many(self, postcodes):
+        """Return {postcode: True if it exists} for each of postcodes"""
+        results = self.lookup('validate', [postcode_key(p) for p in postcodes],
+                              self.fetch_postcodes)
+        return dict((p, results[postcode_key(p)]) for p in postcodes)
+
+    def nearest_many(self, coords):
+        """Return {(longitude, latitude): (postcode, distance) or None} for each of coords"""
+        results = self.lookup('nearest', [coord_key(lon, lat) for lon, lat in coords],
+                              self.fetch_nearest)
+        return dict(((lon, lat), results[coord_key(lon, lat)] and tuple(results[coord_key(lon, lat)]))
+                    for lon, lat in coords)
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+client = None
+table = None
+
+def get_client():
+    global client
+    if client is None:
+        client = PostcodeClient()
+    return client
+
+def get_table():
+    # Return the local postcode table, or None if there is no POSTCODE_CSV
+    global table
+    if table is None and os.path.exists(POSTCODE_CSV):
+        table = PostcodeTable(POSTCODE_CSV)
+    return table
 
 def nearest_postcode(longitude=None,latitude=None):
     # Return nearest postcode and distance
-    data=json.loads(client.getLocationBasedPostcodes(lon=str(longitude),lang=str(latitude)))
-    if data['status']==200:
-        # Return the first (closest) result
-        return (data['result'][0]['postcode'],round(data['result'][0]['distance'],2))
-    else:
-        return None
-    
+    if get_table() is not None:
+        return table.nearest_postcode(longitude,latitude)
+    return get_client().nearest_many([(longitude,latitude)])[(longitude,latitude)]
+
 def validate_postcode(postcode):
     # Return True if postcode is valid, False otherwise
-    data=json.loads(client.validatePostCode(postcode))
-    if data['status']==200:
-        return (data['result'])
-    else:
-        return False
+    if get_table() is not None:
+        return table.validate_postcode(postcode)
+    return get_client().validate_many([postcode])[postcode]
+
+def osm_postcodes(osmfile):
+    # Return the set of addr:postcode values in osmfile
+    postcodes=set()
+    context=ET.iterparse(osmfile,events=('start','end'))
+    _,root=next(context)
+    for event,elem in context:
+        if event=='end' and elem.tag=='tag' and elem.get('k')=='addr:postcode':
+            postcodes.add(elem.get('v'))
+        elif event=='end' and elem.tag in ('node','way','relation'):
+            root.clear()
+    return postcodes
 
 
 if __name__ == "__main__":
-    print '\nNearest postcode to longitude -2.9800493 and latitude=53.1721903:'
-    nearest_postcode(longitude=-2.9800493,latitude=53.1721903)
-    print '\nDoes CH4 0DR exist?'
-    validate_postcode('CH4 0DR')
-    print '\nDoes CH9 0ZZ exist?'
-    validate_postcode('CH9 0ZZ')
+    if len(sys.argv)>1:
+        client=PostcodeClient(sys.argv[2]) if len(sys.argv)>2 else get_client()
+        start=time.time()
+        results=client.validate_many(osm_postcodes(sys.argv[1]))
+        print len(results),'postcodes checked in %.1f s (%d requests, %d retried)' % (
+            time.time()-start,client.requests,client.failures)
+        print 'Not found:',sorted(p for p,valid in results.iteritems() if not valid)
+    else:
+        print '\nNearest postcode to longitude -2.9800493 and latitude=53.1721903:'
+        print nearest_postcode(longitude=-2.9800493,latitude=53.1721903)
+        print '\nDoes CH4 0DR exist?'
+        print validate_postcode('CH4 0DR')
+        print '\nDoes CH9 0ZZ exist?'
+        print validate_postcode('CH9 0ZZ')
+    get_client().close()
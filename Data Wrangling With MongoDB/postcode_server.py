@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Local stand-in for the postcodes.io bulk endpoints, for testing PostcodeClient
+# without using the real service.
+# Postcodes and their coordinates are read from a csv file in the same format
+# as postcode_table.POSTCODE_CSV (a few built-in ones are used otherwise).
+# A fraction of requests can be made to fail, to exercise the client's retries.
+#
+# Usage: postcode_server.py [port [postcodes.csv [fail_rate]]]
+
+import BaseHTTPServer
+import SocketServer
+import csv
+import json
+import random
+import sys
+from postcode import postcode_key
+from postcode_table import POSTCODE_COLUMNS, LATITUDE_COLUMNS, LONGITUDE_COLUMNS, find_column
+from way_geometry import haversine
+
+PORT = 8765
+
+sample_postcodes = [('CH4 0DR', 53.1721903, -2.9800493),
+                    ('CH1 1AA', 53.1900000, -2.8910000),
+                    ('LL11 1AA', 53.0460000, -2.9930000)]
+
+def load_postcodes(path):
+    # Return list of (postcode, latitude, longitude) from a csv file
+    with open(path, 'rb') as csv_file:
+        reader = csv.DictReader(csv_file)
+        columns = [find_column(reader.fieldnames, names)
+                   for names in (POSTCODE_COLUMNS, LATITUDE_COLUMNS, LONGITUDE_COLUMNS)]
+        return [(row[columns[0]], float(row[columns[1]]), float(row[columns[2]])) for row in reader]
+
+class PostcodeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, postcodes=sample_postcodes, fail_rate=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, PostcodeHandler)
+        self.postcodes = postcodes
+        self.by_postcode = dict((postcode_key(p), (p, lat, lon)) for p, lat, lon in postcodes)
+        self.fail_rate = fail_rate
+        self.requests = 0
+
+    def lookup(self, postcode):
+        found = self.by_postcode.get(postcode_key(postcode))
+        if found is None:
+            return None
+        return {'postcode': found[0], 'latitude': found[1], 'longitude': found[2]}
+
+    def nearest(self, geolocation):
+        # Brute force search (the stand-in only needs to be correct)
+        lat, lon = geolocation['latitude'], geolocation['longitude']
+        radius = geolocation.get('radius', 100)
+        found = sorted((haversine(lat, lon, p_lat, p_lon), p, p_lat, p_lon)
+                       for p, p_lat, p_lon in self.postcodes)
+        found = [{'postcode': p, 'latitude': p_lat, 'longitude': p_lon, 'distance': d}
+                 for d, p, p_lat, p_lon in found[:geolocation.get('limit', 10)] if d <= radius]
+        return found or None
+
+class PostcodeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+        server.requests += 1
+        if random.random() < server.fail_rate:
+            self.reply(503, {'status': 503, 'error': 'Service unavailable'})
+            return
+        payload = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+        if self.path.split('?')[0] != '/postcodes':
+            self.reply(404, {'status': 404, 'error': 'Resource not found'})
+        elif 'postcodes' in payload:
+            self.reply(200, {'status': 200, 'result': [{'query': p, 'result': server.lookup(p)}
+                                                       for p in payload['postcodes']]})
+        elif 'geolocations' in payload:
+            self.reply(200, {'status': 200, 'result': [{'query': g, 'result': server.nearest(g)}
+                                                       for g in payload['geolocations']]})
+        else:
+            self.reply(400, {'status': 400, 'error': 'Invalid JSON submitted'})
+
+    def reply(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == "__main__":
+    port=int(sys.argv[1]) if len(sys.argv)>1 else PORT
+    postcodes=load_postcodes(sys.argv[2]) if len(sys.argv)>2 else sample_postcodes
+    fail_rate=float(sys.argv[3]) if len(sys.argv)>3 else 0.0
+    server=PostcodeServer(('localhost',port),postcodes,fail_rate)
+    print 'Serving',len(postcodes),'postcodes on http://localhost:%d' % port
+    server.serve_forever()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Offline postcode validation and nearest postcode lookup.
+# PostcodeTable loads a csv of postcodes and their centroids (e.g. the ONS
+# Postcode Directory, or any file with postcode, latitude and longitude
+# columns). Postcodes are held as one string of fixed width sorted entries, so
+# validation is a binary search, and centroids are bucketed in a grid of
+# GRID_SIZE degree cells, so the nearest postcode is found by searching the
+# cells around a point in rings until no closer one can exist (or, as with
+# the postcodes.io API, none within RADIUS metres).
+# PostcodeCleaner checks the format of addr:postcode values, normalises them to
+# 'OUT IN' and (if a table is given) checks that they exist.
+#
+# Usage: postcode_table.py <postcodes.csv> [postcode | longitude latitude [radius]]
+
+import array
+import collections
+import csv
+import math
+import re
+import sys
+import time
+from way_geometry import EARTH_RADIUS, haversine
+
+POSTCODE_CSV = "postcodes.csv"
+
+GRID_SIZE = 0.01 # Grid cell size in degrees
+WIDTH = 7 # Longest postcode without its space
+METRES_PER_DEGREE = math.radians(1) * EARTH_RADIUS # Along a meridian
+RADIUS = 100 # Metres searched for the nearest postcode (the postcodes.io default)
+
+# Column names used for postcode, latitude and longitude by different sources
+POSTCODE_COLUMNS = ('postcode', 'pcds', 'pcd')
+LATITUDE_COLUMNS = ('latitude', 'lat')
+LONGITUDE_COLUMNS = ('longitude', 'long', 'lon')
+
+# UK postcode format: outward code (area, district) and inward code (sector, unit)
+strict_postcode_re = re.compile(r'^([A-Z]{1,2}[0-9][A-Z0-9]?|GIR)([0-9][A-Z]{2})$')
+
+def normalise_postcode(postcode):
+    # Return postcode as 'OUT IN' or None if it is not in a valid format
+    m = strict_postcode_re.match(''.join(postcode.split()).upper())
+    if m is None:
+        return None
+    return m.group(1) + ' ' + m.group(2)
+
+def find_column(fieldnames, names):
+    for name in names:
+        if name in fieldnames:
+            return name
+    raise Exception('No column named any of: ' + ', '.join(names))
+
+class PostcodeTable(object):
+    """Postcodes and centroids loaded from a csv file"""
+
+    def __init__(self, path=POSTCODE_CSV):
+        rows = []
+        with open(path, 'rb') as csv_file:
+            reader = csv.DictReader(csv_file)
+            postcode_col = find_column(reader.fieldnames, POSTCODE_COLUMNS)
+            lat_col = find_column(reader.fieldnames, LATITUDE_COLUMNS)
+            lon_col = find_column(reader.fieldnames, LONGITUDE_COLUMNS)
+            for row in reader:
+                postcode = normalise_postcode(row[postcode_col])
+                if postcode:
+                    rows.append((postcode.replace(' ', '').ljust(WIDTH), row[lat_col], row[lon_col]))
+        rows.sort()
+
+        # Sorted postcodes as one string and centroids in the same order
+        self.keys = ''.join(key for key, _, _ in rows)
+        self.count = len(rows)
+        self.lats = array.array('d')
+        self.lons = array.array('d')
+        self.grid = collections.defaultdict(lambda: array.array('i'))
+        for i, (_, lat, lon) in enumerate(rows):
+            try:
+                lat, lon = float(lat), float(lon)
+            except ValueError:
+                lat = lon = float('nan')
+            self.lats.append(lat)
+            self.lons.append(lon)
+            # Postcodes without a location (e.g. ONS uses latitude 99.999999) are not in the grid
+            if -90 <= lat <= 90 and -180 <= lon <= 180:
+                self.grid[self.cell(lat, lon)].append(i)
+        self.grid = dict(self.grid)
+
+    def __len__(self):
+        return self.count
+
+    def cell(self, lat, lon):
+        return int(math.floor(lat / GRID_SIZE)), int(math.floor(lon / GRID_SIZE))
+
+    def key(self, i):
+        return self.keys[i * WIDTH:(i + 1) * WIDTH]
+
+    def postcode(self, i):
+        key = self.key(i).rstrip()
+        return key[:-3] + ' ' + key[-3:]
+
+    def find(self, postcode):
+        # Return index of a normalised postcode or None
+        key = postcode.replace(' ', '').ljust(WIDTH)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.key(lo) == key:
+            return lo
+        return None
+
+    def validate_postcode(self, postcode):
+        # Return True if postcode is valid, False otherwise
+        postcode = normalise_postcode(postcode)
+        return postcode is not None and self.find(postcode) is not None
+
+    def nearest_postcode(self, longitude=None, latitude=None, radius=RADIUS):
+        # Return nearest postcode and distance within radius metres, or None if there is none
+        # (the search stops once the rings of cells are further away than radius)
+        lat, lon = float(latitude), float(longitude)
+        row, col = self.cell(lat, lon)
+        best = None
+        if not self.grid:
+            return None
+        # Distance a postcode must be within to be the nearest so far
+        limit = radius
+        for ring in xrange(int(360 / GRID_SIZE)):
+            if ring:
+                # Unsearched points are outside the cells of the rings searched so far
+                # (measured east-west at the highest latitude reached, where it is shortest)
+                lat_gap = min(lat - (row - ring + 1) * GRID_SIZE, (row + ring) * GRID_SIZE - lat)
+                lon_gap = min(lon - (col - ring + 1) * GRID_SIZE, (col + ring) * GRID_SIZE - lon)
+                coslat = math.cos(math.radians(min(abs(lat) + ring * GRID_SIZE, 90.0)))
+                if limit < math.radians(min(lat_gap, lon_gap * coslat)) * EARTH_RADIUS:
+                    break
+            for r in xrange(row - ring, row + ring + 1):
+                # Whole row at the top and bottom of the ring, otherwise just its ends
+                step = 1 if abs(r - row) == ring else 2 * ring
+                for c in xrange(col - ring, col + ring + 1, step):
+                    for i in self.grid.get((r, c), ()):
+                        # The north-south distance alone rules most points out cheaply
+                        if abs(self.lats[i] - lat) * METRES_PER_DEGREE > limit:
+                            continue
+                        d = haversine(lat, lon, self.lats[i], self.lons[i])
+                        if d <= limit and (best is None or d < best[0]):
+                            best = (d, i)
+                            limit = d
+        if best is None:
+            return None
+        return (self.postcode(best[1]), round(best[0], 2))
+
+class PostcodeCleaner(object):
+    """Normalise addr:postcode values, counting those which are valid or not"""
+
+    def __init__(self, table=None):
+        self.table = table
+        self.counts = collections.Counter()
+
+    def __call__(self, v):
+        # Return normalised postcode, or None if it is not valid
+        postcode = normalise_postcode(v)
+        if postcode is None:
+            self.counts['bad_format'] += 1
+            return None
+        if self.table is not None and self.table.find(postcode) is None:
+            self.counts['unknown'] += 1
+            return None
+        self.counts['valid'] += 1
+        if postcode != v:
+            self.counts['normalised'] += 1
+        return postcode
+
+    def stats(self):
+        return collections.Counter(self.counts)
+
+def print_postcode_stats(counts):
+    print '\n%-12s %10s %10s %10s %10s' % ('Postcodes', 'Valid', 'Normalised', 'Bad format', 'Unknown')
+    print '%-12s %10d %10d %10d %10d' % ('addr', counts['valid'], counts['normalised'],
+                                          counts['bad_format'], counts['unknown'])
+
+
+if __name__ == "__main__":
+    start=time.time()
+    table=PostcodeTable(sys.argv[1])
+    print len(table),'postcodes loaded in %.2f s' % (time.time()-start)
+    if len(sys.argv)==3:
+        print table.validate_postcode(sys.argv[2])
+    elif len(sys.argv)>3:
+        radius=float(sys.argv[4]) if len(sys.argv)>4 else RADIUS
+        print table.nearest_postcode(longitude=float(sys.argv[2]),latitude=float(sys.argv[3]),radius=radius)
@@ -2,13 +2,30 @@
 # -*- coding: utf-8 -*-
 
 import csv
-import codecs
+import collections
+import json
+import multiprocessing
+import os
 import pprint
 import re
+import shutil
+import tempfile
+import time
 import xml.etree.cElementTree as ET
-import cerberus
 import schema
 import sys
+from fast_validator import FastValidator
+import value_cleaner as value_cleaner_module
+from value_cleaner import ValueCleaner
+from clean_cache import DiskCache, LRUCache, rules_hash, print_stats
+from node_coords import CoordWriter, merge_coords
+from way_geometry import GeometryBuilder, WAY_GEOMETRY_FIELDS, geometry_from_csv, print_geometry_stats
+from postcode_table import POSTCODE_CSV, PostcodeCleaner, PostcodeTable, print_postcode_stats
+from osm_parser import DEFAULT_BACKEND, iter_elements, is_pbf
+from osm_input import compression, open_input
+from pipeline_metrics import CountingFile, PipelineMetrics, write_report
+from tag_dictionary import TagDictionary, TAG_ID_FIELDS, TAG_KEY_FIELDS, TAG_VALUE_FIELDS
+from pipeline_stages import CompressedFile, ReadAheadFile, WriterStage, compressed_path
 
 # Output files
 NODES_PATH = "nodes.csv"
@@ -16,6 +33,31 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+OUTPUT_PATHS = [NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH]
+TAG_KEYS_PATH = "tag_keys.csv"
+TAG_VALUES_PATH = "tag_values.csv"
+# With dictionary encoded tags (see tag_dictionary)
+ENCODED_OUTPUT_PATHS = OUTPUT_PATHS + [TAG_KEYS_PATH, TAG_VALUES_PATH]
+WAY_GEOMETRY_PATH = "ways_geometry.csv"
+NODE_COORDS_PREFIX = "nodes" # Binary coordinate columns nodes_id.npy, nodes_lat.npy & nodes_lon.npy
+METRICS_PATH = "process_map_metrics.json"
+
+# Checkpoints
+CHECKPOINT_PATH = "process_map.checkpoint"
+CHECKPOINT_BYTES = 1<<26 # Input bytes processed between checkpoints
+
+# CSV output buffering
+WRITE_BATCH = 10000 # Rows buffered for each file before they are written
+WRITE_BUFFER = 1<<20 # Bytes buffered by each output file
+VALIDATE_BATCH = 1000 # Elements validated at a time
+
+# Regular expression matching the start of a top level element
+# (used to split the input into shards for parallel processing)
+element_start_re=re.compile(r'<(node|way|relation)[\s/>]')
+
+# Cleaning cache
+CACHE_DIR = ".clean_cache"
+CACHE_SIZE = 100000 # Maximum entries held in memory for each cleaning function
 
 # Regular expressions
 unwanted_re=re.compile(r'[\[\]().\']|(amp;)')
@@ -32,6 +74,9 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+OUTPUT_FIELDS = [NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, WAY_TAGS_FIELDS]
+ENCODED_OUTPUT_FIELDS = [NODE_FIELDS, TAG_ID_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, TAG_ID_FIELDS,
+                         TAG_KEY_FIELDS, TAG_VALUE_FIELDS]
 
 # Keys known to contain multiple values
 multival_keys = ['amenity', 'cuisine']
@@ -106,50 +151,34 @@ def fix_key(k):
 # value cleaning functions
 ################################################################################
 
-def remove_unwanted(v):
-    # Remove unwanted characters
-    return re.sub(unwanted_re,'',v)
+# Value cleaning rules compiled once from the tables above
+value_cleaner=ValueCleaner(abbr_mapping,welsh_mapping,unwanted_re,postcode_re,acceptable)
 
-def capitalise(v):
-    # Begin each word with a capital letter
-    return v.title()
-
-def update_abbr(v):
-    # Expand abbreviations
-    for old_str,new_str in abbr_mapping.iteritems():
-        v_re=re.compile(r'\b'+old_str+r'\b')
-        m = v_re.search(v)
-        if m:
-            v=re.sub(r'\b'+old_str+r'\b',new_str,v)
-    return v
-
-def update_welsh(v):
-    # Correct hyphenation in Welsh names
-    for old_str,new_str in welsh_mapping.iteritems():
-        v_re=re.compile(r'\b'+old_str+r'\b')
-        m = v_re.search(v)
-        if m:
-            v=re.sub(r'\b'+old_str+r'\b',new_str,v)
-    return v
-
-def ignore_vals(v):
-    # Ignore post codes, URLs & acceptable abbreviations
-    ignore=False
-    if postcode_re.search(v):
-        ignore=True
-    elif v.startswith('www') or v.startswith('http'):
-        ignore=True
-    elif v in acceptable:
-        ignore=True
-    return ignore
-        
 def fix_vals(v):
-    if not ignore_vals(v):
-        v=remove_unwanted(v)
-        v=capitalise(v)
-        v=update_abbr(v)
-        v=update_welsh(v)
-    return v
+    # Remove unwanted characters, capitalise, expand abbreviations and correct
+    # Welsh hyphenation (unless v is a post code, URL or acceptable value)
+    # (fix_values.py keeps the original step by step functions)
+    return value_cleaner.clean(v)
+
+################################################################################
+# rule counting functions (for metrics)
+################################################################################
+
+def key_rules(k):
+    # Return names of the rules fix_key applies to k
+    if ignore_re.search(k):
+        return ['key_dropped']
+    fired = []
+    new_k=re.sub(suffix_re,'',k)
+    if new_k!=k:
+        fired.append('suffix_removed')
+    if new_k.startswith('name:') and update_lang(new_k)!=new_k:
+        fired.append('lang_rewritten')
+    return fired
+
+def value_rules(v):
+    # Return names of the rules fix_vals applies to v
+    return value_cleaner.rules(v)
 
 ################################################################################
 # tag formatting function
@@ -169,36 +198,27 @@ def format_tag(k,v):
 # element processing function
 ################################################################################
 
-def process_element(element):
-    # Clean and shape node or way XML element to Python dict
+def element_rows(element, clean_key=fix_key, clean_val=fix_vals, clean_postcode=None):
+    # Clean and shape node or way XML element to tuples in the order of the
+    # *_FIELDS lists: (node or way row, way node rows, tag rows)
+    # (None for any other element, and no way node rows for a node)
+    get = element.get
+    if element.tag == 'node':
+        row = tuple([get(field) for field in NODE_FIELDS])
+        is_way = False
+    elif element.tag == 'way':
+        row = tuple([get(field) for field in WAY_FIELDS])
+        is_way = True
+    else:
+        return None
 
-    node_attribs = {}
-    way_attribs = {}
+    element_id = get('id')
     way_nodes = []
     tags = []
-
-    # Node and Way elements
-    if element.tag == 'node':
-        for field in NODE_FIELDS:
-            node_attribs[field]=element.get(field)
-    elif element.tag == 'way':
-        for field in WAY_FIELDS:
-            way_attribs[field]=element.get(field)
-        pos=0
-        for child in element.getchildren():
-            if child.tag=='nd':
-                way_node={}
-                way_node['id']=element.get('id')
-                way_node['node_id']=child.get('ref')
-                way_node['position']=pos
-                pos+=1
-                way_nodes.append(way_node)
-
-    # Secondary tags
+    pos = 0
     for child in element.getchildren():
-        if child.tag=='tag':
-            tag={}
-            k=fix_key(child.get('k'))
+        if child.tag == 'tag':
+            k=clean_key(child.get('k'))
             if k!=None:
                 c=child.get('v')
                 # If value contains multiple entries separated by ';'
@@ -208,32 +228,44 @@ def process_element(element):
                 else:
                     vals=[c]
                 for v in vals:
-                    k,v,t=format_tag(k,v)
-                    v=fix_vals(v)
-                    tag['id']=element.get('id')
-                    tag['key']=k
-                    tag['value']=v
-                    tag['type']=t
-                    tags.append(tag)
-
-    if element.tag == 'node':
-        return {'node': node_attribs, 'node_tags': tags}
-    elif element.tag == 'way':
-        return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+                    key,v,t=format_tag(k,v)
+                    if clean_postcode and key=='postcode' and t=='addr':
+                        # Invalid post codes are cleaned like any other value
+                        v=clean_postcode(v) or clean_val(v)
+                    else:
+                        v=clean_val(v)
+                    tags.append((element_id, key, v, t))
+        elif is_way and child.tag == 'nd':
+            way_nodes.append((element_id, child.get('ref'), pos))
+            pos += 1
+    return row, way_nodes, tags
+
+def rows_to_dict(tag, rows):
+    # Shape rows from element_rows to the dict of process_element
+    row, way_nodes, tags = rows
+    if tag == 'node':
+        return {'node': dict(zip(NODE_FIELDS, row)),
+                'node_tags': [dict(zip(NODE_TAGS_FIELDS, t)) for t in tags]}
+    return {'way': dict(zip(WAY_FIELDS, row)),
+            'way_nodes': [dict(zip(WAY_NODES_FIELDS, n)) for n in way_nodes],
+            'way_tags': [dict(zip(WAY_TAGS_FIELDS, t)) for t in tags]}
+
+def process_element(element, clean_key=fix_key, clean_val=fix_vals, clean_postcode=None):
+    # Clean and shape node or way XML element to Python dict
+    # (clean_key and clean_val may be cached versions of fix_key and fix_vals,
+    # clean_postcode normalises addr:postcode values, returning None if invalid)
+    rows = element_rows(element, clean_key, clean_val, clean_postcode)
+    if rows:
+        return rows_to_dict(element.tag, rows)
 
 ################################################################################
 # Helper functions
 ################################################################################
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
-
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+def get_element(osm_file, tags=('node', 'way', 'relation'), backend=DEFAULT_BACKEND, workers=1):
+    """Yield element if it is the right type of tag (parsed with the given backend,
+    or decompressed/decoded with up to workers processes for .gz, .bz2 and .pbf input)"""
+    return iter_elements(osm_file, tags, backend, workers=workers)
 
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema"""
@@ -244,75 +276,707 @@ def validate_element(element, validator, schema=SCHEMA):
         
         raise Exception(message_string.format(field, error_string))
 
-class UnicodeDictWriter(csv.DictWriter, object):
-    """Extend csv.DictWriter to handle Unicode input"""
+def validate_elements(elements, validator, schema=SCHEMA):
+    """Raise ValidationError for the first element in a batch which does not match schema"""
+    failures = validator.validate_batch(elements, schema)
+    if failures:
+        validate_element(elements[failures[0][0]], validator, schema)
+
+class RangeFile(object):
+    """Read-only file-like object exposing a byte range of an OSM file as a
+    complete XML document (wrapped in its own <osm> root element)"""
+
+    def __init__(self, filename, start, end):
+        self.f = open(filename, 'rb')
+        self.f.seek(start)
+        self.end = end
+        self.remaining = end - start
+        self.head = '<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n'
+        self.tail = '</osm>\n'
+
+    def read(self, size=65536):
+        data = ''
+        if self.head:
+            data, self.head = self.head, ''
+        if self.remaining > 0:
+            chunk = self.f.read(min(size, self.remaining))
+            self.remaining -= len(chunk)
+            data += chunk
+            if not chunk:
+                self.remaining = 0
+        if not data and self.tail:
+            data, self.tail = self.tail, ''
+        return data
+
+    def close(self):
+        self.f.close()
+
+def find_element_start(osm_file, offset, block_size=1<<20):
+    """Return offset of first top level element starting at or after offset"""
+    osm_file.seek(offset)
+    overlap = ''
+    while True:
+        block = osm_file.read(block_size)
+        if not block:
+            return None
+        data = overlap + block
+        m = element_start_re.search(data)
+        if m:
+            return offset - len(overlap) + m.start()
+        # Keep the end of the block in case a tag is split across blocks
+        overlap = data[-16:]
+        offset += len(block)
+
+def find_data_end(osm_file, size):
+    """Return offset of the closing root tag (where the data ends)"""
+    osm_file.seek(max(0, size - 4096))
+    tail = osm_file.read()
+    return size - len(tail) + tail.rfind('</osm>')
+
+def find_shards(file_in, shards):
+    """Split file_in into (start, end) byte ranges aligned to top level elements"""
+    size = os.path.getsize(file_in)
+    with open(file_in, 'rb') as osm_file:
+        end = find_data_end(osm_file, size)
+        first = find_element_start(osm_file, 0)
+        if first is None or first >= end:
+            return []
+        starts = [first]
+        for i in range(1, shards):
+            pos = find_element_start(osm_file, max(first, size * i // shards))
+            if pos is not None and starts[-1] < pos < end:
+                starts.append(pos)
+    return zip(starts, starts[1:] + [end])
+
+def find_segments(file_in, start, segment_size):
+    """Split file_in from offset start into (start, end) byte ranges of about
+    segment_size bytes aligned to top level elements"""
+    size = os.path.getsize(file_in)
+    starts = []
+    with open(file_in, 'rb') as osm_file:
+        end = find_data_end(osm_file, size)
+        pos = find_element_start(osm_file, start)
+        while pos is not None and pos < end:
+            starts.append(pos)
+            pos = find_element_start(osm_file, pos + segment_size)
+    return zip(starts, starts[1:] + [end])
+
+################################################################################
+# Checkpoints
+################################################################################
+
+class Checkpoint(object):
+    """
+    Record of how far a run has got (input offset, last element and the size of
+    each output file), saved after every segment of about segment_size bytes of
+    input so that an interrupted run can be resumed
+    """
+
+    def __init__(self, file_in, paths, options, path=CHECKPOINT_PATH, segment_size=CHECKPOINT_BYTES):
+        self.file_in = os.path.abspath(file_in)
+        self.paths = paths
+        # Options which change the output (a run can only be resumed with the same ones)
+        self.options = options
+        self.path = path
+        self.segment_size = segment_size
+        stat = os.stat(file_in)
+        self.input = {'input': self.file_in, 'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+        self.offset = 0
+        self.last_element = None
+        self.resumed = False
+        self.range = None
+        # Set by write_elements: flushes the outputs and returns their sizes
+        self.flush = None
+
+    def load(self):
+        """
+        Truncate the outputs to their size at the saved checkpoint and continue
+        from there (returns False, changing nothing, if there is no checkpoint)
+        """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as checkpoint_file:
+            saved = json.load(checkpoint_file)
+        for key, value in self.input.iteritems():
+            if saved[key] != value:
+                raise Exception('Checkpoint %s is for a different input file (%s differs)' % (self.path, key))
+        if saved['options'] != self.options:
+            raise Exception('Checkpoint %s was made with different options: %s' % (self.path, saved['options']))
+        for path, size in saved['outputs']:
+            if not os.path.exists(path) or os.path.getsize(path) < size:
+                raise Exception('Output file %s is shorter than at checkpoint %s' % (path, self.path))
+        for path, size in saved['outputs']:
+            with open(path, 'r+b') as output_file:
+                output_file.truncate(size)
+        self.offset = saved['offset']
+        self.last_element = saved['last_element']
+        self.resumed = True
+        return True
+
+    def save(self, sizes):
+        # Write the checkpoint to a temporary file then rename it, so a crash
+        # leaves either the previous checkpoint or this one
+        checkpoint = dict(self.input, offset=self.offset, last_element=self.last_element,
+                          options=self.options, outputs=zip(self.paths, sizes),
+                          time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file, indent=1, sort_keys=True)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(temp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def elements(self, tags=('node', 'way'), backend=DEFAULT_BACKEND):
+        """Yield elements from the checkpoint offset on, saving a checkpoint
+        once every element of a segment has been written"""
+        for start, end in find_segments(self.file_in, self.offset, self.segment_size):
+            self.range = RangeFile(self.file_in, start, end)
+            try:
+                for element in get_element(self.range, tags, backend):
+                    # Some backends clear the element once it has been processed
+                    last_element = [element.tag, element.get('id')]
+                    yield element
+                    self.last_element = last_element
+            finally:
+                self.range.close()
+            self.offset = end
+            self.save(self.flush())
+
+    @property
+    def bytes_read(self):
+        # Input bytes read so far (for pipeline_metrics progress lines)
+        if self.range is None:
+            return self.offset
+        return self.range.end - self.range.remaining
+
+def coords_from_csv(nodes_path, prefix, header=False):
+    # Write node coordinate columns from nodes.csv as written by process_map
+    writer = CoordWriter(prefix)
+    with open(nodes_path, 'rb') as nodes_file:
+        reader = csv.reader(nodes_file)
+        if header:
+            next(reader, None)
+        for row in reader:
+            writer.add(row[0], row[1], row[2])
+    writer.close()
+
+def encode_row(row):
+    # Return row with any unicode fields encoded as UTF-8 (most rows have none)
+    for v in row:
+        if isinstance(v, unicode):
+            return tuple([v.encode('utf-8') if isinstance(v, unicode) else v for v in row])
+    return row
+
+class RowWriter(object):
+    """Buffer tuple rows for one csv file and write them in batches
+    (on the thread of a pipeline_stages.WriterStage if stage is given)"""
+
+    def __init__(self, csv_file, fields, batch_size=WRITE_BATCH, stage=None):
+        self.writer = csv.writer(csv_file)
+        self.fields = fields
+        self.batch_size = batch_size
+        self.stage = stage
+        self.rows = []
+
+    def writeheader(self):
+        self.send([self.fields])
 
     def writerow(self, row):
-        super(UnicodeDictWriter, self).writerow({
-            k: (v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in row.iteritems()
-        })
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
 
     def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.send(self.rows)
+            self.rows = []
+
+    def send(self, rows):
+        if self.stage:
+            self.stage.put((self, rows))
+        else:
+            self.write(rows)
+
+    def write(self, rows):
+        self.writer.writerows(map(encode_row, rows))
+
+def get_output_paths(encode_tags=False, compress=None):
+    # Return the output files (see write_elements) for the given options
+    paths = ENCODED_OUTPUT_PATHS if encode_tags else OUTPUT_PATHS
+    return [compressed_path(path, compress) for path in paths]
+
+def open_output(path, append=False, compress=None):
+    # Open an output csv file (compressed in a background thread if compress is given)
+    if compress:
+        return CompressedFile(path, compress)
+    return open(path, 'ab' if append else 'wb', WRITE_BUFFER)
 
 ################################################################################
 # Main function
 ################################################################################
 
-def process_map(file_in,validate=False,header=False):
+def module_source(module_file):
+    # Return the source of a module, given its __file__ (.py or .pyc)
+    with open(os.path.splitext(module_file)[0] + '.py') as source_file:
+        return source_file.read()
+
+def cleaning_rules_hash():
+    # Hash of everything which determines the output of fix_key and fix_vals
+    # (the rule tables, and the source of this module and value_cleaner.py,
+    # so any change to the code applying them, constants included, counts)
+    return rules_hash(lang_mapping, abbr_mapping, welsh_mapping, acceptable,
+                      unwanted_re, ignore_re, suffix_re, postcode_re, multival_keys,
+                      module_source(__file__), module_source(value_cleaner_module.__file__))
+
+def make_cleaners(cache=False):
+    # Return key and value cleaning functions and their disk cache
+    # (plain fix_key and fix_vals and no disk cache if cache is False)
+    if not cache:
+        return fix_key, fix_vals, None
+    disk = DiskCache(CACHE_DIR, cleaning_rules_hash())
+    return LRUCache(fix_key, CACHE_SIZE, disk, 'key'), LRUCache(fix_vals, CACHE_SIZE, disk, 'value'), disk
+
+def cleaner_stats(clean_key, clean_val, disk):
+    # Close the disk cache and return the statistics of cleaners from make_cleaners
+    if disk is None:
+        return {}
+    disk.close()
+    return {'key': clean_key.stats(), 'value': clean_val.stats()}
+
+def make_postcode_cleaner(postcodes=False):
+    # Return PostcodeCleaner (checking against POSTCODE_CSV if it exists) or None
+    if not postcodes:
+        return None
+    return PostcodeCleaner(PostcodeTable(POSTCODE_CSV) if os.path.exists(POSTCODE_CSV) else None)
+
+def write_elements(elements, paths=OUTPUT_PATHS, validate=False, header=False, cache=False,
+                   coords_prefix=None, geometry_path=None, postcodes=False, metrics=None,
+                   checkpoint=None, encode_tags=False, pipelined=False, compress=None):
     """
-    Iteratively process each XML element and write to csv(s)
+    Clean each XML element and write to the csv files listed in paths
+    (and node coordinate columns starting with coords_prefix if given,
+    and the geometry of each way to geometry_path if given)
 
-    file_in:   OSM.xml file to be processed
-    validate:  Flag to enable/disable validating the data against the supplied schema
-               (Validation is ~ 10X slower)
-    header:    Flag to enable/disable writing the header row
-               (Headers cause problems when importing data into an existing SQL table)
-    """
+    If encode_tags is True tags are written as key and value ids, and paths
+    should be as ENCODED_OUTPUT_PATHS, ending with the tag_keys and tag_values
+    lookup tables
 
-    with codecs.open(NODES_PATH, 'wb') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'wb') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'wb') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'wb') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'wb') as way_tags_file:
+    If pipelined is True rows are formatted and written by a background thread.
+    If compress is 'gz' or 'zst' the files are compressed, each in a background
+    thread (paths should then end in '.gz' or '.zst', and checkpoints are not
+    supported).
 
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
+    Stage times, counts and rules fired are added to metrics if given
+    (a pipeline_metrics.PipelineMetrics)
 
+    If checkpoint is given, elements should come from checkpoint.elements(), which
+    saves a checkpoint after each segment of input. A resumed checkpoint's outputs
+    are appended to rather than replaced.
+
+    Returns the key and value cache statistics (empty if cache is False),
+    the post code counts (if postcodes is True) and the number of way nodes
+    missing from the geometry (if geometry_path is given)
+    """
+
+    clean_key, clean_val, disk = make_cleaners(cache)
+    clean_postcode = make_postcode_cleaner(postcodes)
+    key_cleaner, val_cleaner = clean_key, clean_val
+    if metrics:
+        elements = metrics.timed(elements)
+        key_cleaner = metrics.count_rules(clean_key, key_rules)
+        val_cleaner = metrics.count_rules(clean_val, value_rules)
+    if coords_prefix:
+        coord_writer = CoordWriter(coords_prefix)
+    if geometry_path:
+        geometry = GeometryBuilder()
+        geometry_file = open(geometry_path, 'wb')
+        geometry_writer = csv.DictWriter(geometry_file, WAY_GEOMETRY_FIELDS)
         if header:
+            geometry_writer.writeheader()
+
+    if checkpoint and compress:
+        raise Exception('Checkpoints are not supported with compressed output')
+    append = checkpoint is not None and checkpoint.resumed
+    if encode_tags:
+        dictionary = TagDictionary()
+        if append:
+            # Reuse the ids already written (their lookup rows are in the files)
+            dictionary.add_csv(paths[5], paths[6], header)
+            dictionary.new_rows()
+    stage = WriterStage() if pipelined else None
+    files = []
+    try:
+        files.extend(open_output(path, append, compress) for path in paths)
+        writers = [RowWriter(f, fields, stage=stage) for f, fields in
+                   zip(files, ENCODED_OUTPUT_FIELDS if encode_tags else OUTPUT_FIELDS)]
+        nodes_writer, node_tags_writer, ways_writer, way_nodes_writer, way_tags_writer = writers[:5]
+
+        if header and not append:
             # Write headers
-            nodes_writer.writeheader()
-            node_tags_writer.writeheader()
-            ways_writer.writeheader()
-            way_nodes_writer.writeheader()
-            way_tags_writer.writeheader()
+            for writer in writers:
+                writer.writeheader()
 
         if validate:
             # Instantiate validator
-            validator=cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
+            validator=FastValidator()
+        # Elements waiting to be validated as a batch
+        pending=[]
+
+        def validate_pending():
+            # Validate the buffered elements, raising an exception for the first invalid one
+            if pending:
+                validate_elements(pending, validator)
+                del pending[:]
+
+        if checkpoint:
+            def flush_outputs():
+                # Write out everything buffered and return the size of each file
+                # (validating first, so a checkpoint never covers invalid rows)
+                validate_pending()
+                for writer in writers:
+                    writer.flush()
+                if stage:
+                    stage.sync()
+                for f in files:
+                    f.flush()
+                    os.fsync(f.fileno())
+                return [os.fstat(f.fileno()).st_size for f in files]
+            checkpoint.flush = flush_outputs
+            if not append:
+                checkpoint.save(flush_outputs())
+
+        for element in elements:
+            if metrics:
+                metrics.start('clean')
             # Clean the data
-            el = process_element(element)
-            if el:
+            rows = element_rows(element, key_cleaner, val_cleaner, clean_postcode)
+            if rows:
                 if validate:
                     # Validate
-                    validate_element(el, validator)
+                    if metrics:
+                        metrics.start('validate')
+                    pending.append(rows_to_dict(element.tag, rows))
+                    if len(pending) >= VALIDATE_BATCH:
+                        validate_pending()
 
                 # Write to CSV files
+                if metrics:
+                    metrics.start('write')
+                    metrics.element(element.tag, rows)
+                row, way_nodes, tags = rows
+                if encode_tags:
+                    tags = dictionary.encode(tags)
+                    if dictionary.new_keys or dictionary.new_values:
+                        tag_keys, tag_values = dictionary.new_rows()
+                        writers[5].writerows(tag_keys)
+                        writers[6].writerows(tag_values)
                 if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+                    nodes_writer.writerow(row)
+                    node_tags_writer.writerows(tags)
+                    if coords_prefix:
+                        coord_writer.add(row[0], row[1], row[2])
+                    if geometry_path:
+                        geometry.add_node(row[0], row[1], row[2])
+                else:
+                    ways_writer.writerow(row)
+                    way_nodes_writer.writerows(way_nodes)
+                    way_tags_writer.writerows(tags)
+                    if geometry_path:
+                        geometry_row = geometry.way_row(row[0], [n[1] for n in way_nodes])
+                        if geometry_row:
+                            geometry_writer.writerow(geometry_row)
+
+        if pending:
+            if metrics:
+                metrics.start('validate')
+            validate_pending()
+        if metrics:
+            metrics.start('write')
+        for writer in writers:
+            writer.flush()
+        if stage:
+            stage.close()
+    finally:
+        try:
+            if stage:
+                stage.close()
+        finally:
+            for f in files:
+                f.close()
+
+    if coords_prefix:
+        coord_writer.close()
+    if geometry_path:
+        geometry.close()
+        geometry_file.close()
+    if metrics:
+        metrics.stop()
+    stats = cleaner_stats(clean_key, clean_val, disk)
+    if clean_postcode:
+        stats['postcode'] = clean_postcode.stats()
+    if geometry_path:
+        stats['geometry'] = geometry.missing
+    return stats
+
+def shard_path(shard_dir, index, path):
+    return os.path.join(shard_dir, '%05d_%s' % (index, os.path.basename(path)))
+
+def process_shard(args):
+    """Process one byte range of the input file into its own set of csv files"""
+    file_in, start, end, shard_dir, index, options = args
+    paths = [shard_path(shard_dir, index, path) for path in get_output_paths(options.get('encode_tags'))]
+    options = dict(options)
+    if options.get('coords_prefix'):
+        options['coords_prefix'] = shard_path(shard_dir, index, options['coords_prefix'])
+    # Workers do not log progress, their metrics are reported back when done
+    metrics = PipelineMetrics(end - start, log_interval=None) if options.pop('metrics', False) else None
+    shard = RangeFile(file_in, start, end)
+    if options.get('pipelined'):
+        shard = ReadAheadFile(shard)
+    try:
+        backend = options.pop('backend', DEFAULT_BACKEND)
+        stats = write_elements(get_element(shard, ('node', 'way'), backend), paths, metrics=metrics,
+                               **options)
+    finally:
+        shard.close()
+    return paths, options.get('coords_prefix'), stats, metrics.report() if metrics else None
+
+def merge_encoded_tags(shard_paths, files):
+    """
+    Write the tags of each shard (lists of files as ENCODED_OUTPUT_PATHS) in
+    order to the open output files, renumbering the key and value ids of every
+    shard into those of a single TagDictionary
+    """
+    dictionary = TagDictionary()
+    node_tags_writer, way_tags_writer, tag_keys_writer, tag_values_writer = writers = \
+        [RowWriter(files[i], ENCODED_OUTPUT_FIELDS[i]) for i in (1, 4, 5, 6)]
+    for shard in shard_paths:
+        key_ids, value_ids = dictionary.add_csv(shard[5], shard[6])
+        for path, writer in ((shard[1], node_tags_writer), (shard[4], way_tags_writer)):
+            with open(path, 'rb') as shard_file:
+                for element_id, key_id, value_id in csv.reader(shard_file):
+                    writer.writerow((element_id, key_ids[key_id], value_ids[value_id]))
+    tag_keys, tag_values = dictionary.new_rows()
+    tag_keys_writer.writerows(tag_keys)
+    tag_values_writer.writerows(tag_values)
+    for writer in writers:
+        writer.flush()
+
+def process_map_parallel(file_in, validate=False, header=False, workers=None, cache=False,
+                         coords_prefix=None, geometry_path=None, postcodes=False,
+                         backend=DEFAULT_BACKEND, metrics=None, encode_tags=False, pipelined=False,
+                         compress=None):
+    """
+    Process file_in in shards across a pool of worker processes, then merge the
+    shard csv files in their original order (renumbering the tag ids of each
+    shard if encode_tags is True, and compressing the merged files if compress
+    is given)
+
+    Ways in one shard refer to nodes in others, so way geometry is computed
+    from the merged nodes and ways_nodes csv files
+
+    The metrics of each worker are merged into metrics if given, logging
+    progress as each shard is finished
+
+    Returns the combined cache statistics (and post code counts) of all workers
+    """
+
+    workers = workers or multiprocessing.cpu_count()
+    # Use more shards than workers to even out the load
+    shards = find_shards(file_in, workers * 4)
+    shard_dir = tempfile.mkdtemp(prefix='process_map_', dir='.')
+    pool = multiprocessing.Pool(workers)
+    try:
+        options = dict(validate=validate, cache=cache, coords_prefix=coords_prefix,
+                       postcodes=postcodes, backend=backend, metrics=bool(metrics),
+                       encode_tags=encode_tags, pipelined=pipelined)
+        jobs = [(file_in, start, end, shard_dir, i, options)
+                for i, (start, end) in enumerate(shards)]
+        results = []
+        for result in pool.imap(process_shard, jobs, chunksize=1):
+            results.append(result)
+            if metrics:
+                metrics.merge(result[3])
+                metrics.log('shard %d of %d' % (len(results), len(jobs)))
+        pool.close()
+
+        stats = {}
+        for _, _, shard_stats, _ in results:
+            for kind, counts in shard_stats.iteritems():
+                stats.setdefault(kind, collections.Counter()).update(counts)
+
+        if metrics:
+            metrics.start('merge')
+
+        # Write headers (if required) then concatenate shards in order
+        output_paths = get_output_paths(encode_tags, compress)
+        files = []
+        try:
+            files.extend(open_output(path, compress=compress) for path in output_paths)
+            if header:
+                for f, fields in zip(files, ENCODED_OUTPUT_FIELDS if encode_tags else OUTPUT_FIELDS):
+                    RowWriter(f, fields).writeheader()
+            for i, out_file in enumerate(files[:len(OUTPUT_PATHS)]):
+                if encode_tags and i in (1, 4):
+                    continue
+                for paths, _, _, _ in results:
+                    with open(paths[i], 'rb') as shard_file:
+                        shutil.copyfileobj(shard_file, out_file, 1<<20)
+            if encode_tags:
+                merge_encoded_tags([paths for paths, _, _, _ in results], files)
+        finally:
+            for f in files:
+                f.close()
+        if coords_prefix:
+            merge_coords([prefix for _, prefix, _, _ in results], coords_prefix)
+        if geometry_path:
+            if metrics:
+                metrics.start('geometry')
+            stats['geometry'] = geometry_from_csv(output_paths[0], output_paths[3], geometry_path, header)
+        if metrics:
+            metrics.stop()
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    return stats
+
+def process_map_checkpointed(file_in, validate=False, header=False, cache=False, coords_prefix=None,
+                             geometry_path=None, postcodes=False, backend=DEFAULT_BACKEND,
+                             metrics=None, resume=False, encode_tags=False, pipelined=False):
+    """
+    Process file_in in segments, saving a checkpoint after each one
+    (continuing from the last checkpoint if resume is True and there is one)
+
+    Node coordinates and way geometry are made from the finished csv files, so
+    they do not need to be checkpointed
+
+    Returns the cache statistics (and post code counts) of this run
+    """
+
+    options = dict(header=header, postcodes=postcodes, rules=cleaning_rules_hash(), encode_tags=encode_tags)
+    output_paths = get_output_paths(encode_tags)
+    checkpoint = Checkpoint(file_in, output_paths, options)
+    if resume and checkpoint.load():
+        if checkpoint.last_element:
+            print 'Resuming from byte %d, after %s %s' % (checkpoint.offset, checkpoint.last_element[0],
+                                                         checkpoint.last_element[1])
+        else:
+            print 'Resuming from the start'
+    if metrics:
+        metrics.input = checkpoint
+    stats = write_elements(checkpoint.elements(('node', 'way'), backend), output_paths, validate, header,
+                           cache, postcodes=postcodes, metrics=metrics, checkpoint=checkpoint,
+                           encode_tags=encode_tags, pipelined=pipelined)
+    if coords_prefix:
+        coords_from_csv(OUTPUT_PATHS[0], coords_prefix, header)
+    if geometry_path:
+        stats['geometry'] = geometry_from_csv(OUTPUT_PATHS[0], OUTPUT_PATHS[3], geometry_path, header)
+    # Finished, so there is nothing to resume
+    checkpoint.remove()
+    return stats
+
+def process_map(file_in,validate=False,header=False,workers=1,cache=False,coords=False,
+                geometry=False,postcodes=False,backend=DEFAULT_BACKEND,metrics=False,
+                checkpoint=False,resume=False,encode_tags=False,pipelined=False,compress=None):
+    """
+    Iteratively process each XML element and write to csv(s)
+
+    file_in:   OSM.xml file to be processed
+    validate:  Flag to enable/disable validating the data against the supplied schema
+               (Uses the compiled FastValidator rather than cerberus)
+    header:    Flag to enable/disable writing the header row
+               (Headers cause problems when importing data into an existing SQL table)
+    workers:   Number of worker processes (None uses all cores)
+               (If > 1 the file is split into shards which are processed in parallel,
+               or for compressed and PBF input, decompressed/decoded in parallel)
+    cache:     Flag to enable/disable caching of cleaned keys and values
+               (Cached results are written to CACHE_DIR in the current directory and
+               reused by later runs until the cleaning rules or code change, see
+               cleaning_rules_hash)
+    coords:    Flag to enable/disable writing node coordinates as binary columns
+               (Sorted by id, see node_coords.NodeCoords for reading them)
+    geometry:  Flag to enable/disable writing the length, centroid and bounding box
+               of each way to WAY_GEOMETRY_PATH
+    postcodes: Flag to enable/disable validating and normalising addr:postcode values
+               (Against the postcodes in POSTCODE_CSV if it exists, otherwise format only)
+    backend:   XML parser to use ('etree', 'lxml' or 'expat', see osm_parser)
+    metrics:   Flag to enable/disable logging progress to stderr and writing stage
+               times, counts and rules fired to METRICS_PATH (see pipeline_metrics)
+    checkpoint: Flag to enable/disable saving a checkpoint to CHECKPOINT_PATH after
+               every CHECKPOINT_BYTES of input (uncompressed XML and one worker only)
+    resume:    Flag to enable/disable continuing from the checkpoint of an interrupted
+               run (output files are cut back to their size at the checkpoint;
+               starts from the beginning if there is no checkpoint)
+    encode_tags: Flag to enable/disable writing tags as ids into TAG_KEYS_PATH and
+               TAG_VALUES_PATH (see tag_dictionary; load with create_encoded_database.sql)
+    pipelined: Flag to enable/disable reading the input and formatting and writing
+               the csv files in background threads (see pipeline_stages)
+    compress:  'gz' or 'zst' to write compressed csv files (e.g. nodes.csv.gz),
+               compressed in background threads, or None (not with checkpoints)
+    """
+
+    coords_prefix = NODE_COORDS_PREFIX if coords else None
+    geometry_path = WAY_GEOMETRY_PATH if geometry else None
+    run_metrics = PipelineMetrics(os.path.getsize(file_in)) if metrics else None
+    if checkpoint or resume:
+        if workers != 1 or compression(file_in) or is_pbf(file_in) or compress:
+            raise Exception('Checkpoints are only supported for uncompressed XML processed by one worker '
+                            'into uncompressed csv files')
+        stats = process_map_checkpointed(file_in, validate, header, cache, coords_prefix, geometry_path,
+                                         postcodes, backend, run_metrics, resume, encode_tags, pipelined)
+    elif workers == 1 or compression(file_in) or is_pbf(file_in):
+        # Compressed and PBF input can not be split into shards by byte offset
+        workers = workers or multiprocessing.cpu_count()
+        source = file_in
+        if metrics and not (compression(file_in) or is_pbf(file_in)):
+            # Count bytes read to show progress through the file
+            source = run_metrics.input = CountingFile(file_in)
+        if pipelined and not is_pbf(file_in):
+            # Read (and decompress) the input in a background thread
+            if source is file_in:
+                source = open_input(file_in, workers) if compression(file_in) else open(file_in, 'rb')
+            source = ReadAheadFile(source)
+        try:
+            stats = write_elements(get_element(source, ('node', 'way'), backend, workers),
+                                   get_output_paths(encode_tags, compress),
+                                   validate, header, cache, coords_prefix, geometry_path, postcodes,
+                                   run_metrics, encode_tags=encode_tags, pipelined=pipelined,
+                                   compress=compress)
+        finally:
+            if source is not file_in:
+                source.close()
+    else:
+        stats = process_map_parallel(file_in, validate, header, workers, cache, coords_prefix,
+                                     geometry_path, postcodes, backend, run_metrics, encode_tags,
+                                     pipelined, compress)
+    if metrics:
+        run_metrics.log('done')
+        write_report(METRICS_PATH, run_metrics.report(input=file_in, workers=workers,
+                                                      validate=validate, caches=stats))
+
+    postcode_stats = stats.pop('postcode', None)
+    geometry_missing = stats.pop('geometry', None)
+    if stats:
+        print_stats(stats)
+    if postcode_stats:
+        print_postcode_stats(postcode_stats)
+    if geometry_missing is not None:
+        print_geometry_stats(geometry_missing)
 
 if __name__ == "__main__":
+    # Usage: process_map.py <osmfile> [workers] [cache]
     filename=sys.argv[1]
-    process_map(filename,validate=False,header=False)
+    workers=int(sys.argv[2]) if len(sys.argv)>2 and sys.argv[2].isdigit() else 1
+    cache='cache' in sys.argv[2:]
+    process_map(filename,validate=False,header=False,workers=workers,cache=cache)
     
\ No newline at end of file
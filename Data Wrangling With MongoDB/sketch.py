@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Approximate heavy hitter counting in fixed memory.
+# SpaceSaving keeps at most `capacity` counters. When a new item arrives and
+# all counters are in use, the smallest counter is given to the new item and
+# its old count is recorded as the new item's possible overcount (error).
+# For every item kept, the true count lies between count - error and count,
+# and any item not kept occurred at most min_count() times.
+# Summaries from different files or shards can be merged, and saved as JSON.
+#
+# Run with saved summaries to merge them and print the top items.
+
+import heapq
+import json
+import sys
+
+class SpaceSaving(object):
+    """Space-Saving heavy hitter summary with a fixed number of counters"""
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        # Min-heap of (count, item); entries are left behind when a count
+        # changes and skipped when they reach the top
+        self.heap = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, item, count=1):
+        self.total += count
+        counts = self.counts
+        if item in counts:
+            counts[item] += count
+        elif len(counts) < self.capacity:
+            counts[item] = count
+            self.errors[item] = 0
+        else:
+            min_count, min_item = self.pop_min()
+            del counts[min_item]
+            del self.errors[min_item]
+            counts[item] = min_count + count
+            self.errors[item] = min_count
+        heapq.heappush(self.heap, (counts[item], item))
+        if len(self.heap) > 4 * self.capacity:
+            self.rebuild_heap()
+
+    def rebuild_heap(self):
+        self.heap = [(count, item) for item, count in self.counts.iteritems()]
+        heapq.heapify(self.heap)
+
+    def discard_stale(self):
+        while self.heap and self.counts.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    def pop_min(self):
+        # Remove and return (count, item) of the smallest counter
+        self.discard_stale()
+        return heapq.heappop(self.heap)
+
+    def min_count(self):
+        # Upper bound on the count of any item not in the summary
+        if len(self.counts) < self.capacity:
+            return 0
+        self.discard_stale()
+        return self.heap[0][0]
+
+    def top(self, k=None):
+        # Return list of (item, count, error) in descending order of count
+        items = sorted(self.counts.iteritems(), key=lambda x: (-x[1], x[0]))
+        return [(item, count, self.errors[item]) for item, count in items[:k]]
+
+    def merge(self, other):
+        """Return a new summary of the combined streams of self and other"""
+        merged = SpaceSaving(max(self.capacity, other.capacity))
+        min_self, min_other = self.min_count(), other.min_count()
+        combined = []
+        for item in set(self.counts) | set(other.counts):
+            # An item missing from a full summary may have occurred up to min_count times
+            count = self.counts.get(item, min_self) + other.counts.get(item, min_other)
+            error = self.errors.get(item, min_self) + other.errors.get(item, min_other)
+            combined.append((count, error, item))
+        combined.sort(key=lambda x: (-x[0], x[2]))
+        for count, error, item in combined[:merged.capacity]:
+            merged.counts[item] = count
+            merged.errors[item] = error
+        merged.total = self.total + other.total
+        merged.rebuild_heap()
+        return merged
+
+    def to_dict(self):
+        return {'capacity': self.capacity, 'total': self.total,
+                'items': [[item, count, error] for item, count, error in self.top()]}
+
+    @classmethod
+    def from_dict(cls, d):
+        summary = cls(d['capacity'])
+        summary.total = d['total']
+        for item, count, error in d['items']:
+            summary.counts[item] = count
+            summary.errors[item] = error
+        summary.rebuild_heap()
+        return summary
+
+def save_summaries(summaries, path):
+    # Save dict of named summaries as JSON
+    with open(path, 'w') as f:
+        json.dump(dict((name, s.to_dict()) for name, s in summaries.iteritems()), f)
+
+def load_summaries(path):
+    with open(path) as f:
+        return dict((name, SpaceSaving.from_dict(d)) for name, d in json.load(f).iteritems())
+
+def merge_summaries(paths):
+    # Merge named summaries saved in several files
+    merged = {}
+    for path in paths:
+        for name, summary in load_summaries(path).iteritems():
+            merged[name] = merged[name].merge(summary) if name in merged else summary
+    return merged
+
+def print_top(name, summary, k=20):
+    # Print top k items with lower and upper bounds on their counts
+    print '\n%s (%d in total, items not shown occur <= %d times):\n' % (
+        name.upper(), summary.total, summary.min_count())
+    for item, count, error in summary.top(k):
+        print '  %-40s %10d  (%d - %d)' % (item, count, count - error, count)
+
+
+if __name__ == "__main__":
+    for name, summary in sorted(merge_summaries(sys.argv[1:]).iteritems()):
+        print_top(name, summary)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Spatial queries over the cleaned nodes in the database.
+# create_spatial_index adds SQLite R*Tree tables alongside the schema:
+# nodes_rtree holds a point box for every node and ways_rtree the bounding box
+# of every way in ways_geometry (if way geometry was loaded). R*Tree stores
+# 32 bit floats, rounded outwards, so results are checked against the exact
+# coordinates in nodes/ways_geometry.
+# SpatialIndex answers bounding box, radius and k-nearest queries using them.
+# apply_changes.py keeps the R*Tree tables up to date as nodes and ways change.
+#
+# Usage: spatial_index.py <database>     Build the R*Tree tables
+
+import math
+import sqlite3
+import sys
+from way_geometry import EARTH_RADIUS, haversine, has_geometry
+
+RTREE_TABLES = ["DROP TABLE IF EXISTS nodes_rtree",
+                "DROP TABLE IF EXISTS ways_rtree",
+                "CREATE VIRTUAL TABLE nodes_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)",
+                "CREATE VIRTUAL TABLE ways_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)",
+                "INSERT INTO nodes_rtree SELECT id, lat, lat, lon, lon FROM nodes "
+                "WHERE lat IS NOT NULL AND lon IS NOT NULL"]
+WAYS_RTREE_SQL = "INSERT INTO ways_rtree SELECT id, min_lat, max_lat, min_lon, max_lon FROM ways_geometry"
+
+NODES_BBOX_SQL = """SELECT n.id, n.lat, n.lon FROM nodes_rtree r JOIN nodes n ON n.id = r.id
+                    WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?
+                    AND n.lat BETWEEN ? AND ? AND n.lon BETWEEN ? AND ?"""
+
+WAYS_BBOX_SQL = """SELECT g.id, g.min_lat, g.min_lon, g.max_lat, g.max_lon
+                   FROM ways_rtree r JOIN ways_geometry g ON g.id = r.id
+                   WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?
+                   AND g.max_lat >= ? AND g.min_lat <= ? AND g.max_lon >= ? AND g.min_lon <= ?"""
+
+# Rows added for one node or way (by apply_changes)
+NODE_RTREE_SQL = "INSERT INTO nodes_rtree VALUES (?, ?, ?, ?, ?)"
+WAY_RTREE_SQL = "INSERT INTO ways_rtree VALUES (?, ?, ?, ?, ?)"
+
+NEAREST_START_RADIUS = 100.0 # Metres searched first by nearest (doubled until enough found)
+
+def create_spatial_index(db):
+    # (Re)build the R*Tree tables from nodes and ways_geometry (if it exists)
+    for sql in RTREE_TABLES:
+        db.execute(sql)
+    if has_geometry(db):
+        db.execute(WAYS_RTREE_SQL)
+    db.commit()
+
+def has_spatial_index(db):
+    # Return True if db has the R*Tree tables
+    return db.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' "
+                      "AND name = 'nodes_rtree'").fetchone()[0] > 0
+
+def radius_bbox(lat, lon, radius):
+    # Return (minlat, minlon, maxlat, maxlon) of a box containing the circle
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    coslat = math.cos(math.radians(min(abs(lat) + dlat, 90.0)))
+    dlon = 180.0 if coslat < 1e-9 else min(dlat / coslat, 180.0)
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+class SpatialIndex(object):
+    """Bounding box, radius and nearest node queries using the R*Tree tables"""
+
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path)
+        self.count = self.db.execute("SELECT count(*) FROM nodes_rtree").fetchone()[0]
+
+    def bbox(self, minlat, minlon, maxlat, maxlon):
+        # Return list of (id, lat, lon) of nodes inside the bounding box
+        return self.db.execute(NODES_BBOX_SQL, (minlat, maxlat, minlon, maxlon,
+                                                minlat, maxlat, minlon, maxlon)).fetchall()
+
+    def ways_bbox(self, minlat, minlon, maxlat, maxlon):
+        # Return list of (id, min_lat, min_lon, max_lat, max_lon) of ways overlapping the box
+        return self.db.execute(WAYS_BBOX_SQL, (minlat, maxlat, minlon, maxlon,
+                                               minlat, maxlat, minlon, maxlon)).fetchall()
+
+    def radius(self, lat, lon, radius):
+        # Return list of (distance, id, lat, lon) of nodes within radius metres, nearest first
+        found = []
+        for node_id, node_lat, node_lon in self.bbox(*radius_bbox(lat, lon, radius)):
+            distance = haversine(lat, lon, node_lat, node_lon)
+            if distance <= radius:
+                found.append((distance, node_id, node_lat, node_lon))
+        found.sort()
+        return found
+
+    def nearest(self, lat, lon, k=1):
+        # Return list of (distance, id, lat, lon) of the k nearest nodes
+        k = min(k, self.count)
+        radius = NEAREST_START_RADIUS
+        while True:
+            found = self.radius(lat, lon, radius)
+            # Every node within radius is found, so the first k are the nearest
+            if len(found) >= k or radius > math.pi * EARTH_RADIUS:
+                return found[:k]
+            radius *= 2
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == "__main__":
+    filename=sys.argv[1]
+    db=sqlite3.connect(filename)
+    create_spatial_index(db)
+    print db.execute("SELECT count(*) FROM nodes_rtree").fetchone()[0],'nodes and',
+    print db.execute("SELECT count(*) FROM ways_rtree").fetchone()[0],'ways indexed'
+    db.close()
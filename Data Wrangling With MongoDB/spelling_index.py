@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Lookup of words within a small edit distance, by symmetric deletion.
+# Each word added is stored under every string made by deleting up to
+# max_distance of its characters. Two words within that distance of each
+# other always share one of these strings, so a lookup only generates the
+# deletions of the query and checks the few words stored under them: the
+# time per lookup depends on the length of the query, not on the number of
+# words. (A BK-tree finds the same words, but visits a large part of the tree
+# for each lookup, which is too slow in Python for hundreds of thousands of
+# names.) Candidates are checked with the optimal string alignment distance,
+# i.e. Levenshtein distance counting a transposition as one edit.
+
+import collections
+
+def deletions(word, distance):
+    # Return set of strings made by deleting up to distance characters of word
+    found = set([word])
+    current = found
+    for _ in range(distance):
+        current = set(w[:i] + w[i + 1:] for w in current for i in range(len(w)))
+        found |= current
+    return found
+
+def osa_distance(a, b, max_distance=None):
+    # Return optimal string alignment distance between a and b
+    # (or max_distance + 1 as soon as it is known to be more than max_distance)
+    if a == b:
+        return 0
+    limit = max(len(a), len(b)) if max_distance is None else max_distance
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before = None
+    previous = range(len(b) + 1)
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        ca = a[i - 1]
+        for j in range(1, len(b) + 1):
+            d = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != b[j - 1]))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == b[j - 1]:
+                d = min(d, before[j - 2] + 1)
+            current[j] = d
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+class SpellingIndex(object):
+    """Words and their counts, looked up by edit distance (up to max_distance)"""
+
+    def __init__(self, max_distance=1):
+        self.max_distance = max_distance
+        self.counts = {}
+        self.words = collections.defaultdict(list)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, word):
+        return word in self.counts
+
+    def add(self, word, count=1):
+        if word in self.counts:
+            self.counts[word] += count
+            return
+        self.counts[word] = count
+        for deleted in deletions(word, self.max_distance):
+            self.words[deleted].append(word)
+
+    def lookup(self, word, max_distance=None):
+        """
+        Return [(distance, word, count)] of the words within max_distance of
+        word (at most the index's max_distance), closest then most common first
+        """
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+        candidates = set()
+        for deleted in deletions(word, max_distance):
+            candidates.update(self.words.get(deleted, ()))
+        found = []
+        for candidate in candidates:
+            distance = osa_distance(word, candidate, max_distance)
+            if distance <= max_distance:
+                found.append((distance, -self.counts[candidate], candidate))
+        found.sort()
+        return [(distance, candidate, -count) for distance, count, candidate in found]
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Materialized summary tables for the standard report queries.
+# tag_summary counts the nodes and ways with each (key, value, type) tag,
+# user_summary the nodes and ways last edited by each user and
+# element_summary the number of nodes and ways, so the report queries (top
+# amenities, cuisines, users, streets, post codes...) read a few rows instead
+# of scanning and grouping the tag and element tables.
+# The tables are built in one pass over the covering indexes after a bulk
+# load, then kept up to date by triggers, so later changes (e.g. from
+# apply_changes.py) only adjust the counts of the rows they touch.
+#
+# Usage: summary_tables.py <database> [compare]
+# (builds the indexes and summaries if they are missing, then prints the report,
+# with the time of each query against the base tables as well if compare is given)
+
+import sqlite3
+import sys
+import time
+from tag_dictionary import decoded_fields, is_encoded
+
+SUMMARY_SCHEMA = ["""CREATE TABLE IF NOT EXISTS tag_summary (
+                         key TEXT NOT NULL,
+                         value TEXT NOT NULL,
+                         type TEXT NOT NULL,
+                         nodes INTEGER NOT NULL,
+                         ways INTEGER NOT NULL,
+                         PRIMARY KEY (key, value, type)
+                     ) WITHOUT ROWID""",
+                  """CREATE TABLE IF NOT EXISTS user_summary (
+                         user TEXT PRIMARY KEY NOT NULL,
+                         nodes INTEGER NOT NULL,
+                         ways INTEGER NOT NULL
+                     ) WITHOUT ROWID""",
+                  """CREATE TABLE IF NOT EXISTS element_summary (
+                         tag TEXT PRIMARY KEY NOT NULL,
+                         count INTEGER NOT NULL
+                     ) WITHOUT ROWID"""]
+
+# (Summary column counted, and for each table of tags and elements)
+TAG_TABLES = [('nodes_tags', 'nodes'), ('ways_tags', 'ways')]
+ELEMENT_TABLES = [('nodes', 'nodes', 'node'), ('ways', 'ways', 'way')]
+# Tables the triggers are on when tags are dictionary encoded (see tag_dictionary)
+ENCODED_TAG_TABLES = [('nodes_tag_ids', 'nodes'), ('ways_tag_ids', 'ways')]
+
+def tag_fields(row, encoded=False):
+    # SQL for the key, value and type of row (NEW or OLD) of a tag table
+    if encoded:
+        return decoded_fields(row)
+    return ('%s.key' % row, '%s.value' % row, '%s.type' % row)
+
+# Statements adding (sign 1) or removing (sign -1) one row of table from the summaries
+# (NULL keys, values, types and users are counted as '')
+def tag_count_sql(column, fields, sign):
+    key = "IFNULL(%s, ''), IFNULL(%s, ''), IFNULL(%s, '')" % fields
+    match = "key = IFNULL(%s, '') AND value = IFNULL(%s, '') AND type = IFNULL(%s, '')" % fields
+    if sign > 0:
+        return ["INSERT OR IGNORE INTO tag_summary VALUES (%s, 0, 0)" % key,
+                "UPDATE tag_summary SET %s = %s + 1 WHERE %s" % (column, column, match)]
+    return ["UPDATE tag_summary SET %s = %s - 1 WHERE %s" % (column, column, match),
+            "DELETE FROM tag_summary WHERE %s AND nodes = 0 AND ways = 0" % match]
+
+def element_count_sql(column, tag, row, sign):
+    match = "user = IFNULL(%s.user, '')" % row
+    if sign > 0:
+        return ["INSERT OR IGNORE INTO user_summary VALUES (IFNULL(%s.user, ''), 0, 0)" % row,
+                "UPDATE user_summary SET %s = %s + 1 WHERE %s" % (column, column, match),
+                "UPDATE element_summary SET count = count + 1 WHERE tag = '%s'" % tag]
+    return ["UPDATE user_summary SET %s = %s - 1 WHERE %s" % (column, column, match),
+            "DELETE FROM user_summary WHERE %s AND nodes = 0 AND ways = 0" % match,
+            "UPDATE element_summary SET count = count - 1 WHERE tag = '%s'" % tag]
+
+def summary_triggers(encoded=False):
+    # Return CREATE TRIGGER statements keeping the summaries up to date
+    triggers = []
+    tables = [(table, lambda row, sign, column=column: tag_count_sql(column, tag_fields(row, encoded), sign))
+              for table, column in (ENCODED_TAG_TABLES if encoded else TAG_TABLES)]
+    tables += [(table, lambda row, sign, column=column, tag=tag: element_count_sql(column, tag, row, sign))
+               for table, column, tag in ELEMENT_TABLES]
+    for table, count_sql in tables:
+        for event, statements in (('INSERT', count_sql('NEW', 1)),
+                                  ('DELETE', count_sql('OLD', -1)),
+                                  ('UPDATE', count_sql('OLD', -1) + count_sql('NEW', 1))):
+            triggers.append('CREATE TRIGGER IF NOT EXISTS %s_summary_%s AFTER %s ON %s BEGIN %s; END'
+                            % (table, event.lower(), event, table, '; '.join(statements)))
+    return triggers
+
+def drop_triggers(db):
+    for table in [t[0] for t in TAG_TABLES + ENCODED_TAG_TABLES + ELEMENT_TABLES]:
+        for event in ('insert', 'delete', 'update'):
+            db.execute('DROP TRIGGER IF EXISTS %s_summary_%s' % (table, event))
+
+def build_summaries(db):
+    """
+    (Re)build the summary tables from the base tables and create the triggers
+    which maintain them (the covering indexes of load_database.post_load_indexes
+    should exist first)
+    """
+
+    start = time.time()
+    with db:
+        drop_triggers(db)
+        for sql in SUMMARY_SCHEMA:
+            db.execute(sql)
+        for table in ('tag_summary', 'user_summary', 'element_summary'):
+            db.execute('DELETE FROM %s' % table)
+        db.execute("""INSERT INTO tag_summary
+                      SELECT key, value, type, SUM(nodes), SUM(ways) FROM (
+                          SELECT IFNULL(key, '') AS key, IFNULL(value, '') AS value,
+                                 IFNULL(type, '') AS type, COUNT(*) AS nodes, 0 AS ways
+                          FROM nodes_tags GROUP BY 1, 2, 3
+                          UNION ALL
+                          SELECT IFNULL(key, ''), IFNULL(value, ''), IFNULL(type, ''), 0, COUNT(*)
+                          FROM ways_tags GROUP BY 1, 2, 3)
+                      GROUP BY 1, 2, 3""")
+        db.execute("""INSERT INTO user_summary
+                      SELECT user, SUM(nodes), SUM(ways) FROM (
+                          SELECT IFNULL(user, '') AS user, COUNT(*) AS nodes, 0 AS ways
+                          FROM nodes GROUP BY 1
+                          UNION ALL
+                          SELECT IFNULL(user, ''), 0, COUNT(*) FROM ways GROUP BY 1)
+                      GROUP BY 1""")
+        db.execute("""INSERT INTO element_summary
+                      SELECT 'node', COUNT(*) FROM nodes UNION ALL SELECT 'way', COUNT(*) FROM ways""")
+        for sql in summary_triggers(is_encoded(db)):
+            db.execute(sql)
+    return time.time() - start
+
+def has_summaries(db):
+    return db.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' "
+                      "AND name = 'nodes_summary_insert'").fetchone()[0] > 0
+
+################################################################################
+# Report
+################################################################################
+
+def top_tags_sql(key, tag_type, limit=10):
+    # (summary query, equivalent query on the base tables) for the most common values of a tag
+    summary = ("SELECT value, nodes + ways AS count FROM tag_summary WHERE key = '%s' AND type = '%s' "
+               "ORDER BY count DESC, value LIMIT %d" % (key, tag_type, limit))
+    base = ("SELECT value, COUNT(*) AS count FROM (SELECT value FROM nodes_tags WHERE key = '%s' AND type = '%s' "
+            "UNION ALL SELECT value FROM ways_tags WHERE key = '%s' AND type = '%s') "
+            "GROUP BY value ORDER BY count DESC, value LIMIT %d" % (key, tag_type, key, tag_type, limit))
+    return summary, base
+
+REPORT_QUERIES = [
+    ('Nodes and ways',
+     "SELECT tag, count FROM element_summary ORDER BY tag",
+     "SELECT 'node', COUNT(*) FROM nodes UNION ALL SELECT 'way', COUNT(*) FROM ways"),
+    ('Unique users',
+     "SELECT 'users', COUNT(*) FROM user_summary",
+     "SELECT 'users', COUNT(*) FROM (SELECT IFNULL(user, '') FROM nodes UNION SELECT IFNULL(user, '') FROM ways)"),
+    ('Top contributing users',
+     "SELECT user, nodes + ways AS count FROM user_summary ORDER BY count DESC, user LIMIT 10",
+     "SELECT user, COUNT(*) AS count FROM (SELECT IFNULL(user, '') AS user FROM nodes "
+     "UNION ALL SELECT IFNULL(user, '') FROM ways) "
+     "GROUP BY user ORDER BY count DESC, user LIMIT 10"),
+    ('Top amenities',) + top_tags_sql('amenity', 'regular'),
+    ('Top cuisines',) + top_tags_sql('cuisine', 'regular'),
+    ('Top streets',) + top_tags_sql('street', 'addr'),
+    ('Top post codes',) + top_tags_sql('postcode', 'addr'),
+    ('Top cities',) + top_tags_sql('city', 'addr')]
+
+def report(db, compare=False):
+    """Print the standard report from the summary tables (and check each query
+    against the base tables, printing both times, if compare is True)"""
+    for title, summary_sql, base_sql in REPORT_QUERIES:
+        start = time.time()
+        rows = db.execute(summary_sql).fetchall()
+        seconds = time.time() - start
+        line = '\n%s (%.4f s' % (title, seconds)
+        if compare:
+            start = time.time()
+            base_rows = db.execute(base_sql).fetchall()
+            line += ', %.4f s from the base tables' % (time.time() - start)
+            if base_rows != rows:
+                raise Exception('%s differs from the base tables: %r != %r' % (title, rows, base_rows))
+        print line + ')'
+        for label, count in rows:
+            print '    %-40s %10d' % (label, count)
+
+
+if __name__ == "__main__":
+    from load_database import post_load_indexes
+    db=sqlite3.connect(sys.argv[1])
+    compare=len(sys.argv)>2 and sys.argv[2]=='compare'
+    if not has_summaries(db):
+        for sql in post_load_indexes(db):
+            db.execute(sql)
+        print 'Summary tables built in %.2f s' % build_summaries(db)
+        db.execute("ANALYZE")
+    report(db,compare)
+    db.close()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Dictionary encoding of tags.
+# A handful of keys (addr:street, amenity, name, source...) and a long tail of
+# repeated values make up most tag rows, so rather than storing the strings in
+# every row, tags can be written as integer ids into two lookup tables:
+# tag_keys (a key and its type) and tag_values. TagDictionary hands out the ids
+# as tags are written, holding a single copy of each distinct string.
+# encoded_tags_schema.sql replaces the nodes_tags and ways_tags tables with
+# views of the same name and columns, so queries (and apply_changes.py) which
+# use them need no changes.
+#
+# Usage: tag_dictionary.py <osmfile>
+# (writes and loads the file with plain and encoded tags, and compares the
+# size of the tag data and the time of some tag queries)
+
+import csv
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+ENCODED_SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "encoded_tags_schema.sql")
+
+# CSV fields to match the encoded tables
+TAG_ID_FIELDS = ['id', 'key_id', 'value_id']
+TAG_KEY_FIELDS = ['id', 'key', 'type']
+TAG_VALUE_FIELDS = ['id', 'value']
+
+# Indexes created after the load, in place of those on nodes_tags and ways_tags
+ENCODED_INDEXES = ["CREATE INDEX IF NOT EXISTS nodes_tag_ids_id_key ON nodes_tag_ids(id, key_id, value_id)",
+                   "CREATE INDEX IF NOT EXISTS nodes_tag_ids_key_value ON nodes_tag_ids(key_id, value_id, id)",
+                   "CREATE INDEX IF NOT EXISTS ways_tag_ids_id_key ON ways_tag_ids(id, key_id, value_id)",
+                   "CREATE INDEX IF NOT EXISTS ways_tag_ids_key_value ON ways_tag_ids(key_id, value_id, id)"]
+
+class TagDictionary(object):
+    """
+    Integer ids of tag keys (with their type) and values, numbered from 1 in
+    the order they are first seen. Lookup table rows for ids handed out since
+    the last call to new_rows() are kept in new_keys and new_values.
+    """
+
+    def __init__(self):
+        self.keys = {}
+        self.values = {}
+        self.new_keys = []
+        self.new_values = []
+
+    def key_id(self, key, tag_type):
+        key_id = self.keys.get((key, tag_type))
+        if key_id is None:
+            key_id = self.keys[(key, tag_type)] = len(self.keys) + 1
+            self.new_keys.append((key_id, key, tag_type))
+        return key_id
+
+    def value_id(self, value):
+        value_id = self.values.get(value)
+        if value_id is None:
+            value_id = self.values[value] = len(self.values) + 1
+            self.new_values.append((value_id, value))
+        return value_id
+
+    def encode(self, tags):
+        # Return tag rows (id, key, value, type) from process_map.element_rows
+        # as (id, key_id, value_id)
+        keys = self.keys
+        values = self.values
+        rows = []
+        for element_id, key, value, tag_type in tags:
+            key_id = keys.get((key, tag_type)) or self.key_id(key, tag_type)
+            value_id = values.get(value) or self.value_id(value)
+            rows.append((element_id, key_id, value_id))
+        return rows
+
+    def new_rows(self):
+        # Return and forget the new tag_keys and tag_values rows
+        rows = self.new_keys, self.new_values
+        self.new_keys, self.new_values = [], []
+        return rows
+
+    def add_csv(self, keys_path, values_path, header=False):
+        """
+        Add the keys and values of lookup csv files written by another
+        TagDictionary, and return dicts mapping their ids (as read from the
+        csv files) to the ids of this one
+        """
+        maps = []
+        for path, add in ((keys_path, lambda row: self.key_id(row[1].decode('utf-8'), row[2].decode('utf-8'))),
+                          (values_path, lambda row: self.value_id(row[1].decode('utf-8')))):
+            with open(path, 'rb') as csv_file:
+                reader = csv.reader(csv_file)
+                if header:
+                    next(reader, None)
+                maps.append(dict((row[0], add(row)) for row in reader))
+        return maps
+
+def is_encoded(db):
+    # Return True if db stores tags as in encoded_tags_schema.sql
+    return db.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' "
+                      "AND name = 'tag_keys'").fetchone()[0] > 0
+
+def create_encoded_tables(db):
+    # Replace the tag tables of an empty database with the encoded tables and views
+    with open(ENCODED_SCHEMA_PATH) as schema_file:
+        db.executescript(schema_file.read())
+
+def decoded_fields(row):
+    # SQL giving the key, value and type of row (NEW or OLD in a trigger) of an encoded table
+    return ('(SELECT key FROM tag_keys WHERE id = %s.key_id)' % row,
+            '(SELECT value FROM tag_values WHERE id = %s.value_id)' % row,
+            '(SELECT type FROM tag_keys WHERE id = %s.key_id)' % row)
+
+################################################################################
+# Comparison of plain and encoded tags
+################################################################################
+
+# Queries run against both databases through the nodes_tags and ways_tags names
+SCAN_QUERIES = [('Count tags by key',
+                 "SELECT key, type, COUNT(*) FROM nodes_tags GROUP BY key, type "
+                 "UNION ALL SELECT key, type, COUNT(*) FROM ways_tags GROUP BY key, type"),
+                ('Search all values',
+                 "SELECT COUNT(*) FROM (SELECT value FROM nodes_tags UNION ALL SELECT value FROM ways_tags) "
+                 "WHERE value LIKE '%Road%'"),
+                ('Values of one key',
+                 "SELECT value, COUNT(*) FROM ways_tags WHERE key = 'highway' AND type = 'regular' "
+                 "GROUP BY value ORDER BY value"),
+                ('Tags of 1000 ways',
+                 "SELECT * FROM ways_tags WHERE id IN (SELECT id FROM ways ORDER BY id LIMIT 1000) "
+                 "ORDER BY id, key, value, type")]
+
+def tag_csv_bytes(osm_file, work_dir, encode_tags):
+    # Write the csv files and return the bytes used by tags (with the lookup tables if encoded)
+    import process_map as pm
+    paths = [os.path.join(work_dir, os.path.basename(path))
+             for path in (pm.ENCODED_OUTPUT_PATHS if encode_tags else pm.OUTPUT_PATHS)]
+    pm.write_elements(pm.get_element(osm_file, ('node', 'way')), paths, cache=False,
+                      encode_tags=encode_tags)
+    return sum(os.path.getsize(paths[i]) for i in [1, 4, 5, 6] if i < len(paths))
+
+def time_query(db, sql, repeat=3):
+    # Return rows and best time of repeat runs (with a warm page cache)
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        rows = db.execute(sql).fetchall()
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return rows, best
+
+def compare(osm_file):
+    """Print the size of the tag data and the time of SCAN_QUERIES with plain and encoded tags"""
+    from load_database import load_database
+    work_dir = os.path.abspath(tempfile.mkdtemp(prefix='tag_dictionary_', dir='.'))
+    try:
+        sizes = []
+        dbs = []
+        for encode_tags in (False, True):
+            csv_bytes = tag_csv_bytes(osm_file, work_dir, encode_tags)
+            db_path = os.path.join(work_dir, 'encoded.db' if encode_tags else 'plain.db')
+            load_database(osm_file, db_path, cache=False, summaries=False, encode_tags=encode_tags)
+            db = sqlite3.connect(db_path)
+            db.execute("VACUUM")
+            sizes.append((csv_bytes, os.path.getsize(db_path)))
+            dbs.append(db)
+
+        print '\n%-24s %14s %14s %10s' % ('', 'Plain', 'Encoded', 'Change')
+        for label, plain, encoded in (('Tag csv files (MB)', sizes[0][0], sizes[1][0]),
+                                      ('Database (MB)', sizes[0][1], sizes[1][1])):
+            print '%-24s %14.2f %14.2f %+9.1f%%' % (label, plain / 1e6, encoded / 1e6,
+                                                   100.0 * (encoded - plain) / plain)
+        for label, sql in SCAN_QUERIES:
+            plain_rows, plain_seconds = time_query(dbs[0], sql)
+            encoded_rows, encoded_seconds = time_query(dbs[1], sql)
+            if plain_rows != encoded_rows:
+                raise Exception('%s gives different results with encoded tags' % label)
+            print '%-24s %14.4f %14.4f %+9.1f%%' % (label + ' (s)', plain_seconds, encoded_seconds,
+                                                   100.0 * (encoded_seconds - plain_seconds) / plain_seconds)
+        for db in dbs:
+            db.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    filename=sys.argv[1]
+    compare(filename)
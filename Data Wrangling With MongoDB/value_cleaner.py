@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Precompiled value cleaning rules.
+# The mappings and regular expressions are compiled once when the cleaner is
+# created, so cleaning a value costs a handful of regex passes rather than a
+# compile, search and sub for every mapping entry.
+# Output is identical to the original remove_unwanted/capitalise/update_abbr/
+# update_welsh sequence.
+
+import re
+
+class ValueCleaner(object):
+    """Clean tag values using rules compiled from the supplied tables"""
+
+    def __init__(self, abbr_mapping, welsh_mapping, unwanted_re, postcode_re, acceptable):
+        self.abbr_mapping = dict(abbr_mapping)
+        self.unwanted_re = unwanted_re
+        self.acceptable = frozenset(acceptable)
+
+        # Ignore rules: post codes and URLs in a single pass
+        # (post code pattern only uses \w, \d and \s so case is irrelevant)
+        self.ignore_re = re.compile(r'^(?:www|http)|' + postcode_re.pattern)
+
+        # Abbreviations: the expansions never contain another abbreviation and
+        # no two abbreviations overlap, so one alternation gives the same result
+        # as substituting each entry in turn
+        self.abbr_re = re.compile(r'\b(?:' + '|'.join(abbr_mapping.iterkeys()) + r')\b')
+
+        # Welsh hyphenation: the rules overlap (' Y ' and 'Y ') so they are
+        # applied in mapping order, but only after a single alternation has
+        # found that at least one of them matches
+        self.welsh_rules = [(re.compile(r'\b' + old_str + r'\b'), new_str)
+                            for old_str, new_str in welsh_mapping.iteritems()]
+        self.welsh_re = re.compile(r'\b(?:' + '|'.join(welsh_mapping.iterkeys()) + r')\b')
+
+    def expand_abbr(self, m):
+        return self.abbr_mapping[m.group()]
+
+    def ignore(self, v):
+        # Ignore post codes, URLs & acceptable abbreviations
+        return v in self.acceptable or self.ignore_re.search(v) is not None
+
+    def rules(self, v):
+        # Return names of the rules clean(v) applies (once for each substitution)
+        if self.ignore(v):
+            return ['value_ignored']
+        fired = []
+        v, n = self.unwanted_re.subn('', v)
+        fired += ['unwanted_removed'] * n
+        if v.title() != v:
+            fired.append('capitalised')
+            v = v.title()
+        v, n = self.abbr_re.subn(self.expand_abbr, v)
+        fired += ['abbreviation_expanded'] * n
+        for v_re, new_str in self.welsh_rules:
+            v, n = v_re.subn(new_str, v)
+            fired += ['welsh_hyphenated'] * n
+        return fired
+
+    def clean(self, v):
+        if self.ignore(v):
+            return v
+        v = self.unwanted_re.sub('', v).title()
+        if self.abbr_re.search(v):
+            v = self.abbr_re.sub(self.expand_abbr, v)
+        if self.welsh_re.search(v):
+            for v_re, new_str in self.welsh_rules:
+                v = v_re.sub(new_str, v)
+        return v
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Way geometry (length, centroid and bounding box) computed while the map is
+# processed, rather than with joins between ways_nodes and nodes afterwards.
+# Node coordinates are kept in a CoordStore as they stream past. Nodes arrive
+# in id order, so they are appended to fixed size segments of sorted arrays;
+# a segment whose ids are dense is stored as a plain array indexed by
+# id - first id instead. Once the segments in memory exceed a limit, they are
+# spilled to a temporary file and memory-mapped.
+# Ways come after the nodes, so each way's nodes can be looked up as it arrives.
+# In the database, the geometry is loaded into the ways_geometry table of
+# way_geometry_schema.sql.
+
+import array
+import bisect
+import csv
+import math
+import mmap
+import os
+import struct
+import tempfile
+from contextlib import closing
+from node_coords import ID_TYPECODE, COORD_TYPECODE, bisect_column
+from pipeline_stages import open_csv
+
+WAY_GEOMETRY_FIELDS = ['id', 'nodes', 'length', 'centroid_lat', 'centroid_lon',
+                       'min_lat', 'min_lon', 'max_lat', 'max_lon']
+GEOMETRY_SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "way_geometry_schema.sql")
+
+EARTH_RADIUS = 6371008.8 # Mean radius in metres
+
+SEGMENT_SIZE = 1<<16 # Nodes per segment
+MEMORY_LIMIT = 512 * 1024 * 1024 # Bytes of segments held in memory before spilling
+DENSITY = 0.66 # Minimum fraction of ids present for a segment to be stored densely
+
+MISSING = float('nan')
+
+class Segment(object):
+    """Coordinates of up to SEGMENT_SIZE nodes with consecutive ids"""
+
+    def __init__(self, ids, lats, lons):
+        self.first = ids[0]
+        self.last = ids[-1]
+        span = self.last - self.first + 1
+        if len(ids) >= DENSITY * span:
+            # Dense: coordinates indexed by id - first (missing ids are NaN)
+            self.ids = None
+            self.lats = array.array(COORD_TYPECODE, [MISSING]) * span
+            self.lons = array.array(COORD_TYPECODE, [MISSING]) * span
+            for node_id, lat, lon in zip(ids, lats, lons):
+                self.lats[node_id - self.first] = lat
+                self.lons[node_id - self.first] = lon
+        else:
+            self.ids, self.lats, self.lons = ids, lats, lons
+
+    def nbytes(self):
+        return sum(column.itemsize * len(column)
+                   for column in (self.ids, self.lats, self.lons) if column is not None)
+
+    def get(self, node_id):
+        if self.ids is None:
+            i = node_id - self.first
+            lat = self.lats[i]
+            if lat != lat:
+                # NaN: id not present
+                return None
+        else:
+            i = bisect_column(self.ids, node_id)
+            if i == len(self.ids) or self.ids[i] != node_id:
+                return None
+            lat = self.lats[i]
+        return lat, self.lons[i]
+
+    def spill(self, spill_file):
+        # Write columns to spill_file and replace them with memory-mapped views
+        columns = []
+        for column in (self.ids, self.lats, self.lons):
+            if column is None:
+                columns.append(None)
+            else:
+                offset = spill_file.tell()
+                column.tofile(spill_file)
+                columns.append((column.typecode, offset, len(column)))
+        self.spilled = columns
+
+    def map(self, mm):
+        # Read columns of a spilled segment from the spill file's memory map
+        views = [None if c is None else MappedColumn(mm, *c) for c in self.spilled]
+        self.ids, self.lats, self.lons = views
+
+class MappedColumn(object):
+    """Column of a spilled segment read from a memory map"""
+
+    def __init__(self, mm, typecode, offset, length):
+        self.mm = mm
+        self.offset = offset
+        self.length = length
+        self.itemsize = array.array(typecode).itemsize
+        self.fmt = typecode.replace('l', 'q')
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return struct.unpack_from(self.fmt, self.mm, self.offset + i * self.itemsize)[0]
+
+class CoordStore(object):
+    """Compact id -> (lat, lon) store filled in id order"""
+
+    def __init__(self, memory_limit=MEMORY_LIMIT, spill_dir=None):
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.segments = []
+        self.firsts = []
+        # Segments not yet spilled and their size in bytes
+        self.in_memory = []
+        self.memory = 0
+        self.spill_file = None
+        self.mm = None
+        self.last_id = None
+        # Nodes out of id order (rare) are kept in a dict
+        self.unordered = {}
+        self.new_segment()
+
+    def new_segment(self):
+        self.ids = array.array(ID_TYPECODE)
+        self.lats = array.array(COORD_TYPECODE)
+        self.lons = array.array(COORD_TYPECODE)
+
+    def add(self, node_id, lat, lon):
+        node_id, lat, lon = int(node_id), float(lat), float(lon)
+        if self.last_id is not None and node_id <= self.last_id:
+            self.unordered[node_id] = (lat, lon)
+            return
+        self.last_id = node_id
+        self.ids.append(node_id)
+        self.lats.append(lat)
+        self.lons.append(lon)
+        if len(self.ids) == SEGMENT_SIZE:
+            self.close_segment()
+
+    def close_segment(self):
+        if not self.ids:
+            return
+        segment = Segment(self.ids, self.lats, self.lons)
+        self.segments.append(segment)
+        self.firsts.append(segment.first)
+        self.in_memory.append(segment)
+        self.memory += segment.nbytes()
+        self.new_segment()
+        if self.memory > self.memory_limit:
+            self.spill()
+
+    def spill(self):
+        # Move the in-memory segments to the spill file
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(dir=self.spill_dir)
+        self.spill_file.seek(0, os.SEEK_END)
+        for segment in self.in_memory:
+            segment.spill(self.spill_file)
+        self.spill_file.flush()
+        # The file has grown, so map it again for all spilled segments
+        if self.mm is not None:
+            self.mm.close()
+        self.mm = mmap.mmap(self.spill_file.fileno(), 0, access=mmap.ACCESS_READ)
+        for segment in self.segments:
+            segment.map(self.mm)
+        self.in_memory = []
+        self.memory = 0
+
+    def get(self, node_id):
+        # Return (lat, lon) or None if the node has not been added
+        node_id = int(node_id)
+        if self.ids and node_id >= self.ids[0]:
+            i = bisect_column(self.ids, node_id)
+            if i < len(self.ids) and self.ids[i] == node_id:
+                return self.lats[i], self.lons[i]
+        else:
+            s = bisect.bisect_right(self.firsts, node_id) - 1
+            if s >= 0 and node_id <= self.segments[s].last:
+                coords = self.segments[s].get(node_id)
+                if coords is not None:
+                    return coords
+        return self.unordered.get(node_id)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        if self.spill_file is not None:
+            self.spill_file.close()
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Great circle distance in metres
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+def way_geometry(way_id, coords):
+    """Return geometry row for a way from the (lat, lon) of its nodes in order"""
+    if not coords:
+        return None
+    lats = [lat for lat, _ in coords]
+    lons = [lon for _, lon in coords]
+    length = 0.0
+    for i in xrange(1, len(coords)):
+        length += haversine(lats[i - 1], lons[i - 1], lats[i], lons[i])
+    # Closed ways repeat the first node, which should not count twice
+    if len(coords) > 1 and coords[0] == coords[-1]:
+        lats, lons = lats[:-1], lons[:-1]
+    return {'id': way_id,
+            'nodes': len(coords),
+            'length': round(length, 2),
+            'centroid_lat': round(sum(lats) / len(lats), 7),
+            'centroid_lon': round(sum(lons) / len(lons), 7),
+            'min_lat': min(lats), 'min_lon': min(lons),
+            'max_lat': max(lats), 'max_lon': max(lons)}
+
+class GeometryBuilder(object):
+    """
+    Store node coordinates and compute the geometry of ways as they arrive
+    (missing counts the way nodes not found, which are left out of the geometry)
+    """
+
+    def __init__(self, memory_limit=MEMORY_LIMIT):
+        self.store = CoordStore(memory_limit)
+        self.missing = 0
+
+    def add_node(self, node_id, lat, lon):
+        self.store.add(node_id, lat, lon)
+
+    def way_row(self, way_id, node_ids):
+        # Return geometry row for a way (None if none of its nodes are known)
+        coords = []
+        for node_id in node_ids:
+            c = self.store.get(node_id)
+            if c is None:
+                self.missing += 1
+            else:
+                coords.append(c)
+        return way_geometry(way_id, coords)
+
+    def close(self):
+        self.store.close()
+
+def print_geometry_stats(missing):
+    if missing:
+        print '\nWay geometry: %d way nodes not found (left out of the geometry of their ways)' % missing
+
+################################################################################
+# Database
+################################################################################
+
+def create_geometry_table(db):
+    with open(GEOMETRY_SCHEMA_PATH) as schema_file:
+        db.executescript(schema_file.read())
+
+def has_geometry(db):
+    # Return True if db has the ways_geometry table
+    return db.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' "
+                      "AND name = 'ways_geometry'").fetchone()[0] > 0
+
+def stored_way_geometry(db, way_id):
+    """
+    Return geometry row for a way from the nodes and ways_nodes tables of db
+    and the number of its nodes not found
+    """
+    coords = db.execute("SELECT n.lat, n.lon FROM ways_nodes w LEFT JOIN nodes n ON n.id = w.node_id "
+                        "WHERE w.id = ? ORDER BY w.position", (way_id,)).fetchall()
+    found = [c for c in coords if c[0] is not None and c[1] is not None]
+    return way_geometry(way_id, found), len(coords) - len(found)
+
+################################################################################
+# csv files
+################################################################################
+
+def geometry_from_csv(nodes_path, way_nodes_path, geometry_path, header=False,
+                      memory_limit=MEMORY_LIMIT):
+    # Compute way geometry from nodes.csv and ways_nodes.csv as written by process_map
+    # (which may be compressed), returning the number of way nodes not found
+    builder = GeometryBuilder(memory_limit)
+    with closing(open_csv(nodes_path)) as nodes_file:
+        reader = csv.reader(nodes_file)
+        if header:
+            next(reader, None)
+        for row in reader:
+            builder.store.add(row[0], row[1], row[2])
+    with closing(open_csv(way_nodes_path)) as way_nodes_file, open(geometry_path, 'wb') as geometry_file:
+        writer = csv.DictWriter(geometry_file, WAY_GEOMETRY_FIELDS)
+        reader = csv.reader(way_nodes_file)
+        if header:
+            next(reader, None)
+            writer.writeheader()
+        way_id, node_ids = None, []
+        for row in reader:
+            if row[0] != way_id:
+                if node_ids:
+                    geometry = builder.way_row(way_id, node_ids)
+                    if geometry:
+                        writer.writerow(geometry)
+                way_id, node_ids = row[0], []
+            node_ids.append(row[1])
+        if node_ids:
+            geometry = builder.way_row(way_id, node_ids)
+            if geometry:
+                writer.writerow(geometry)
+    builder.close()
+    return builder.missing
@@ -0,0 +1,16 @@
+-- Way geometry (see way_geometry.py), applied after data_wrangling_schema.sql
+-- when the geometry of each way is loaded (load_database.py with geometry=True,
+-- or .import ways_geometry.csv ways_geometry after reading this file).
+
+CREATE TABLE IF NOT EXISTS ways_geometry (
+    id INTEGER PRIMARY KEY NOT NULL,
+    nodes INTEGER,
+    length REAL,
+    centroid_lat REAL,
+    centroid_lon REAL,
+    min_lat REAL,
+    min_lon REAL,
+    max_lat REAL,
+    max_lon REAL,
+    FOREIGN KEY (id) REFERENCES ways(id)
+);